@@ -1,7 +1,53 @@
+from django.apps import apps
 from django.contrib import admin
+from django.contrib.auth import get_permission_codename, get_user_model
+from django.contrib.auth.admin import UserAdmin
+from django.db.models import ProtectedError
 from .models import Post, Group
+from . import purge, search
 
-class PostAdmin(admin.ModelAdmin):
+User = get_user_model()
+
+
+class PurgeAdminMixin:
+    """удаление из админки без загрузки зависимых записей в память
+    (posts.purge): и страница подтверждения, и само удаление"""
+
+    def get_deleted_objects(self, objs, request):
+        objs = list(objs)
+        try:
+            counts = purge.Purge(self.model, [obj.pk for obj in objs]).count()
+        except ProtectedError as error:
+            return [], {}, set(), [str(error.args[0])]
+        models = [apps.get_model(label) for label, count in counts.items() if count]
+        model_count = {model._meta.verbose_name_plural: counts[model._meta.label] for model in models}
+        perms_needed = {model._meta.verbose_name for model in models
+                        if not self._can_delete(request, model)}
+        return [str(obj) for obj in objs], model_count, perms_needed, []
+
+    def _can_delete(self, request, model):
+        """право удалять записи model — как у стандартного удаления: у
+        моделей админки его решает их ModelAdmin"""
+        model_admin = self.admin_site._registry.get(model)
+        if model_admin is not None:
+            return model_admin.has_delete_permission(request)
+        opts = model._meta
+        return request.user.has_perm("%s.%s" % (opts.app_label, get_permission_codename("delete", opts)))
+
+    def _purge(self, request, pks):
+        deleted = purge.purge(self.model, pks)
+        self.message_user(request, "Удалено строк: %s" % ", ".join(
+            "%s — %s" % (apps.get_model(label)._meta.verbose_name_plural, count)
+            for label, count in deleted.items()))
+
+    def delete_model(self, request, obj):
+        self._purge(request, [obj.pk])
+
+    def delete_queryset(self, request, queryset):
+        self._purge(request, list(queryset.values_list("pk", flat=True)))
+
+
+class PostAdmin(PurgeAdminMixin, admin.ModelAdmin):
     # перечисляем поля, которые должны отображаться в админке
     list_display = ("pk", "text", "pub_date", "author") 
     # добавляем интерфейс для поиска по тексту постов
@@ -10,10 +56,20 @@ class PostAdmin(admin.ModelAdmin):
     list_filter = ("pub_date",)
     empty_value_display = '-пусто-' # это свойство сработает для всех колонок: где пусто - там будет эта строка
 
+    def get_search_results(self, request, queryset, search_term):
+        #  ищем по полнотекстовому индексу, а не LIKE по всей таблице
+        expression = search.match_expression(search_term)
+        if not expression or not search.available():
+            return super().get_search_results(request, queryset, search_term)
+        #  не pk__in=RawSQL(...): Django 2.2 оборачивает его во вторые скобки,
+        #  и подзапрос становится скалярным — находится один пост
+        return queryset.extra(where=['"%s"."id" IN (%s)' % (Post._meta.db_table, search.MATCH_IDS_SQL)],
+                              params=[expression]), False
+
 # при регистрации модели Post источником конфигурации для неё назначаем класс PostAdmin
 admin.site.register(Post, PostAdmin)
 
-class GroupAdmin(admin.ModelAdmin):  
+class GroupAdmin(PurgeAdminMixin, admin.ModelAdmin):  
     list_display = ('title', 'slug', 'description')  
     list_filter = ('title',)  
     search_fields = ('title',)
@@ -21,5 +77,9 @@ class GroupAdmin(admin.ModelAdmin):
 admin.site.register(Group, GroupAdmin)
 
 
+class PurgeUserAdmin(PurgeAdminMixin, UserAdmin):
+    pass
 
 
+admin.site.unregister(User)
+admin.site.register(User, PurgeUserAdmin)
@@ -2,3 +2,7 @@ from django.apps import AppConfig
 
 class PostsConfig(AppConfig):
     name = 'posts'
+
+    def ready(self):
+        #  подключаем обработчики сигналов моделей
+        from . import signals  # noqa: F401
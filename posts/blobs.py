@@ -0,0 +1,175 @@
+"""Ссылки постов на файлы картинок.
+
+Картинки постов лежат в хранилище по содержимому (yatube.storage):
+одинаковые загрузки — один файл, на который ссылаются несколько постов.
+Blob.refs считает эти ссылки. Его меняют обработчики сигналов поста
+(posts.signals), а reconcile пересчитывает по таблице постов после
+записей в обход сигналов (импорт, массовое удаление).
+
+Файл без ссылок не удаляется сразу: его вместе с миниатюрами стирает
+manage.py collect_media (collect), когда файл не трогали GRACE_SECONDS.
+Загрузка того же содержимого обновляет дату файла, поэтому пост, который
+вот-вот на него сошлётся, файл не потеряет: collect проверяет ссылки и
+дату ещё раз, держа блокировку записи, а файл перед удалением
+переименовывает и смотрит дату уже у переименованного.
+"""
+import itertools
+import os
+import time
+
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from posts import thumbnails
+from posts.models import Post, Blob
+from yatube.storage import TEMP_PREFIX
+
+GRACE_SECONDS = 60 * 60
+#  имён в одном запросе: SQLite ограничивает число параметров 999
+CHUNK_SIZE = 500
+
+BLOBS = Blob._meta.db_table
+POSTS = Post._meta.db_table
+
+#  UPSERT (SQLite 3.24+, PostgreSQL) пересчитывает ссылки одним запросом:
+#  строка появляется у нового файла и меняется только у разошедшегося
+COUNT_SQL = ("INSERT INTO {blobs} (name, refs) "
+             "SELECT image, COUNT(*) FROM {posts} WHERE image <> '' {where} GROUP BY image "
+             "ON CONFLICT (name) DO UPDATE SET refs = excluded.refs WHERE refs <> excluded.refs")
+#  файлы, на которые больше никто не ссылается
+ORPHAN_SQL = ("UPDATE {blobs} SET refs = 0 WHERE refs > 0 {where} AND NOT EXISTS "
+              "(SELECT 1 FROM {posts} WHERE image = {blobs}.name)")
+
+
+def storage():
+    return Post._meta.get_field("image").storage
+
+
+def acquire(name):
+    if not name:
+        return
+    if not Blob.objects.filter(name=name).update(refs=F("refs") + 1):
+        #  строки ещё нет — считаем ссылки с нуля
+        reconcile([name])
+
+
+def release(name):
+    if name:
+        Blob.objects.filter(name=name).update(refs=Greatest(F("refs") - 1, 0))
+
+
+def _reconcile(names):
+    posts_where = blobs_where = ""
+    params = []
+    if names is not None:
+        placeholders = ", ".join(["%s"] * len(names))
+        posts_where = "AND image IN (%s)" % placeholders
+        blobs_where = "AND name IN (%s)" % placeholders
+        params = list(names)
+    with connection.cursor() as cursor:
+        cursor.execute(COUNT_SQL.format(blobs=BLOBS, posts=POSTS, where=posts_where), params)
+        fixed = cursor.rowcount
+        cursor.execute(ORPHAN_SQL.format(blobs=BLOBS, posts=POSTS, where=blobs_where), params)
+        return fixed + cursor.rowcount
+
+
+def reconcile(names=None):
+    """пересчитывает ссылки на файлы names (без names — на все);
+    возвращает число исправленных строк"""
+    if names is None:
+        return _reconcile(None)
+    names = sorted(set(name for name in names if name))
+    return sum(_reconcile(names[start:start + CHUNK_SIZE]) for start in range(0, len(names), CHUNK_SIZE))
+
+
+def _stale(name, cutoff):
+    try:
+        return os.path.getmtime(storage().path(name)) < cutoff
+    except FileNotFoundError:
+        return True
+
+
+def _unlink(name, cutoff):
+    """стирает файл, если его не трогали с cutoff; возвращает число
+    освобождённых байт или None, если файл оставлен"""
+    path = storage().path(name)
+    #  после переименования загрузка файл уже не найдёт и положит свой, а
+    #  дата покажет, не обновила ли она его до этого
+    aside = os.path.join(os.path.dirname(path), "%scollect-%s" % (TEMP_PREFIX, os.path.basename(path)))
+    try:
+        os.rename(path, aside)
+    except FileNotFoundError:
+        return 0
+    if os.path.getmtime(aside) >= cutoff:
+        os.replace(aside, path)
+        return None
+    freed = os.path.getsize(aside)
+    os.unlink(aside)
+    return freed
+
+
+def _remove(name, cutoff):
+    """стирает файл и его миниатюры; возвращает число освобождённых байт
+    или None, если файл оставлен"""
+    freed = _unlink(name, cutoff)
+    if freed is None:
+        return None
+    for variant in thumbnails.variant_names(name).values():
+        try:
+            freed += default_storage.size(variant)
+            default_storage.delete(variant)
+        except FileNotFoundError:
+            continue
+    return freed
+
+
+def collect(grace=GRACE_SECONDS, dry_run=False):
+    """стирает файлы без ссылок, которые не трогали grace секунд;
+    возвращает (число файлов, освобождено байт)"""
+    #  дрейф счётчика не должен стоить файла, на который ссылаются
+    reconcile()
+    cutoff = time.time() - grace
+    removed = freed = 0
+    for name in list(Blob.objects.filter(refs=0).values_list("name", flat=True)):
+        if not _stale(name, cutoff):
+            continue
+        if dry_run:
+            removed += 1
+            continue
+        with transaction.atomic():
+            #  удаление строки берёт блокировку записи: пока транзакция
+            #  открыта, новый пост на файл не сошлётся
+            if not Blob.objects.filter(name=name, refs=0).delete()[0]:
+                continue
+            #  ссылка могла появиться, пока шёл обход, а загрузка того же
+            #  содержимого — обновить дату
+            freed_now = None if Post.objects.filter(image=name).exists() else _remove(name, cutoff)
+            if freed_now is None:
+                transaction.set_rollback(True)
+                continue
+        freed += freed_now
+        removed += 1
+
+    for name in _untracked(cutoff):
+        if not dry_run:
+            freed_now = _remove(name, cutoff)
+            if freed_now is None:
+                continue
+            freed += freed_now
+        removed += 1
+    return removed, freed
+
+
+def _untracked(cutoff):
+    """файлы хранилища старше cutoff, у которых нет строки Blob: пост не
+    сохранился после загрузки или процесс прервался"""
+    directory = Post._meta.get_field("image").upload_to
+    old = (name for name, modified in storage().hashed_files(directory) if modified < cutoff)
+    while True:
+        batch = list(itertools.islice(old, CHUNK_SIZE))
+        if not batch:
+            return
+        tracked = set(Blob.objects.filter(name__in=batch).values_list("name", flat=True))
+        yield from (name for name in batch if name not in tracked)
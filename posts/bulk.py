@@ -0,0 +1,46 @@
+"""Вспомогательные средства для массовой загрузки данных."""
+from contextlib import contextmanager
+
+from posts import blobs, cache, counters, timeline, trending
+
+
+@contextmanager
+def keep_auto_now(model, *field_names):
+    """даёт bulk_create записать свои значения в поля auto_now_add:
+    иначе Django подставит текущее время во все строки"""
+    fields = [model._meta.get_field(name) for name in field_names]
+    saved = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, saved):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def batches(iterable, size):
+    """режет поток объектов на списки не длиннее size"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def rebuild_derived(log=lambda message: None):
+    """догоняет производные данные после вставок в обход сигналов
+    (bulk_create): счётчики, ленты подписок, популярность и кэш"""
+    log("Пересчёт счётчиков...")
+    counters.reconcile_users()
+    counters.reconcile_posts()
+    counters.reconcile_groups()
+    blobs.reconcile()
+    log("Сборка лент подписок...")
+    timeline.rebuild()
+    log("Расчёт популярности...")
+    trending.rebuild()
+    cache.bump("posts", "graph")
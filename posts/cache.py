@@ -0,0 +1,201 @@
+"""Версионированный кэш фрагментов лент.
+
+У каждой области данных ("posts", "group:<id>", "author:<id>",
+"post:<id>", "profile:<user_id>", "follow:<user_id>") есть счётчик
+поколений. Он входит в ключ кэша и увеличивается обработчиками сигналов
+при изменении постов, комментариев и подписок, поэтому записи кэша живут
+долго, но устаревают ровно в момент изменения данных.
+
+get_or_compute защищает дорогие значения от одновременного пересчёта:
+пересчитывает один запрос (блокировка через cache.add), остальные в это
+время получают прежнее значение или дожидаются нового: запросы того же
+процесса будит событие, чужого — редкий опрос кэша. Незадолго до
+истечения срока значение пересчитывается заранее с вероятностью, растущей
+к концу срока (XFetch), поэтому популярные записи не истекают все разом.
+"""
+import math
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from yatube import metrics, replicas
+
+FEED_TIMEOUT = getattr(settings, "FEED_CACHE_TIMEOUT", 60 * 60)
+#  сколько после истечения срока ещё можно отдавать прежнее значение
+STALE_TIMEOUT = 5 * 60
+#  блокировка пересчёта снимается сама, если посчитавший процесс упал
+LOCK_TIMEOUT = 30
+#  сколько ждать чужого пересчёта, когда отдать нечего: дольше воркер
+#  простаивает зря, проще посчитать самому
+WAIT_TIMEOUT = 0.5
+#  первый и самый длинный шаг опроса кэша; шаг растёт вдвое
+WAIT_STEP = 0.01
+WAIT_MAX_STEP = 0.1
+#  XFetch: чем больше, тем раньше начинается пересчёт
+EARLY_BETA = 1.0
+
+
+def _key(scope):
+    return "gen:%s" % scope
+
+
+def _changed_key(scope):
+    return "changed:%s" % scope
+
+
+def _seed():
+    #  счётчик стартует с текущего времени в микросекундах: если ключ
+    #  поколения вытеснят из кэша, новые значения не совпадут со старыми
+    return time.time_ns() // 1000
+
+
+def generations(*scopes):
+    """текущие поколения областей, в том же порядке"""
+    keys = [_key(scope) for scope in scopes]
+    found = cache.get_many(keys)
+    for scope, key in zip(scopes, keys):
+        if key not in found:
+            #  что менялось, пока поколения не было, неизвестно: считаем,
+            #  что данные изменились сейчас
+            if cache.add(key, _seed(), None):
+                cache.set(_changed_key(scope), time.time(), None)
+            found[key] = cache.get(key)
+    return [found[key] for key in keys]
+
+
+def bump(*scopes):
+    """объявляет данные областей изменившимися"""
+    for scope in scopes:
+        try:
+            cache.incr(_key(scope))
+        except ValueError:
+            cache.set(_key(scope), _seed(), None)
+    cache.set_many({_changed_key(scope): time.time() for scope in scopes}, None)
+
+
+def changed_at(*scopes):
+    """когда данные областей менялись последний раз; None, если время
+    вытеснено из кэша и неизвестно"""
+    found = cache.get_many([_changed_key(scope) for scope in scopes])
+    if not scopes or len(found) < len(scopes):
+        return None
+    return datetime.fromtimestamp(max(found.values()), tz=timezone.utc)
+
+
+def post_scopes(author_id, group_id, post_id=None):
+    scopes = ["posts", "author:%s" % author_id]
+    if group_id is not None:
+        scopes.append("group:%s" % group_id)
+    if post_id is not None:
+        scopes.append("post:%s" % post_id)
+    return scopes
+
+
+def _compute(scopes, compute):
+    #  только что изменённых данных на реплике может ещё не быть: значение
+    #  легло бы в кэш под ключом нового поколения и осталось бы старым
+    if replicas.aliases():
+        changed = changed_at(*scopes)
+        if changed is None or timezone.now() - changed < timedelta(seconds=replicas.pin_seconds()):
+            with replicas.use_primary():
+                return compute()
+    return compute()
+
+
+#  ключи, которые сейчас пересчитывает этот процесс: ключ -> событие
+_computing = {}
+_computing_lock = threading.Lock()
+
+
+def _poll(key, versions, deadline):
+    """опрашивает кэш с растущим шагом: пересчёт идёт в другом процессе"""
+    step = WAIT_STEP
+    while time.monotonic() + step < deadline:
+        time.sleep(step)
+        entry = cache.get(key)
+        if entry is not None and entry[0] == versions:
+            return entry
+        step = min(step * 2, WAIT_MAX_STEP)
+    return None
+
+
+def _wait(key, versions):
+    """ждёт значение, которое считает другой запрос"""
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    with _computing_lock:
+        event = _computing.get(key)
+    if event is None:
+        return _poll(key, versions, deadline)
+    event.wait(WAIT_TIMEOUT)
+    entry = cache.get(key)
+    if entry is not None and entry[0] == versions:
+        return entry
+    return None
+
+
+def get_or_compute(key, scopes, compute, timeout=FEED_TIMEOUT, versions=None):
+    """значение из кэша, пока не изменились области scopes и не вышел
+    срок, иначе compute(). Если compute() вернул None, значение не
+    сохраняется. versions — уже прочитанные поколения областей"""
+    if versions is None:
+        versions = generations(*scopes)
+    entry = cache.get(key)
+    if entry is not None:
+        entry_versions, value, expires, delta = entry
+        if entry_versions == versions:
+            #  XFetch: -log(random) изредка велик, и запрос пересчитывает
+            #  значение раньше срока, пока остальные ещё берут его из кэша
+            if time.time() - delta * EARLY_BETA * math.log(1 - random.random()) < expires:
+                return value
+
+    lock = "lock:%s" % key
+    locked = cache.add(lock, 1, LOCK_TIMEOUT)
+    if not locked:
+        if entry is not None:
+            #  пересчитывает другой запрос — отдаём то, что есть
+            if entry[0] != versions or entry[2] <= time.time():
+                metrics.stats.cache_stale += 1
+            return entry[1]
+        entry = _wait(key, versions)
+        if entry is not None:
+            metrics.stats.cache_collapsed += 1
+            return entry[1]
+        #  дождаться не удалось — считаем сами
+    elif entry is not None and entry[0] == versions and entry[2] > time.time():
+        metrics.stats.cache_early += 1
+    if locked:
+        with _computing_lock:
+            event = _computing.setdefault(key, threading.Event())
+    try:
+        started = time.monotonic()
+        value = _compute(scopes, compute)
+        if value is not None:
+            expires = math.inf if timeout is None else time.time() + timeout
+            cache.set(key, (versions, value, expires, time.monotonic() - started),
+                      None if timeout is None else timeout + STALE_TIMEOUT)
+    finally:
+        if locked:
+            cache.delete(lock)
+            with _computing_lock:
+                _computing.pop(key, None)
+            event.set()
+    return value
+
+
+def feed_cache(request, page, view, *scopes):
+    """параметры тега {% cached %} для ленты: ключ учитывает ленту,
+    страницу и пользователя (ему видны ссылки на редактирование своих
+    постов), а запись устаревает с поколениями областей, из которых
+    собрана лента. Ключ берётся из курсора, который проверил пагинатор, а
+    не из строки запроса: иначе любой клиент наплодил бы записей кэша и
+    вытеснил нужные. Страница по курсору, которого сайт не выдавал, не
+    кэшируется (None)"""
+    if page.cursor is None:
+        return None
+    parts = ["feed", view, str(request.user.pk), page.cursor]
+    return {"timeout": FEED_TIMEOUT, "key": ":".join(parts), "scopes": list(scopes)}
@@ -0,0 +1,111 @@
+"""Денормализованные счётчики постов, комментариев и подписок.
+
+Счётчики обновляются атомарным UPDATE ... SET n = n + 1 из обработчиков
+сигналов (posts.signals), а reconcile_* исправляют накопившийся дрейф
+массово — их вызывает команда manage.py recount.
+"""
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from posts.models import Post, Group, Comment, Follow, UserCounter
+
+User = get_user_model()
+
+BATCH_SIZE = 1000
+
+
+def _add(queryset, **deltas):
+    #  счётчики беззнаковые: уменьшение не опускает их ниже нуля
+    return queryset.update(**{
+        name: Greatest(F(name) + delta, 0) if delta < 0 else F(name) + delta
+        for name, delta in deltas.items()
+    })
+
+
+def add_to_user(user_id, **deltas):
+    updated = _add(UserCounter.objects.filter(user_id=user_id), **deltas)
+    if not updated and all(delta > 0 for delta in deltas.values()):
+        #  строки счётчиков ещё нет — считаем её с нуля; при уменьшении
+        #  этого не делаем: строка могла исчезнуть вместе с пользователем
+        reconcile_users(User.objects.filter(pk=user_id))
+
+
+def add_to_users(user_ids, **deltas):
+    """те же изменения для нескольких пользователей одним UPDATE"""
+    updated = _add(UserCounter.objects.filter(user_id__in=user_ids), **deltas)
+    if updated < len(user_ids) and all(delta > 0 for delta in deltas.values()):
+        reconcile_users(User.objects.filter(pk__in=user_ids, counter__isnull=True))
+
+
+def add_to_post(post_id, **deltas):
+    _add(Post.objects.filter(pk=post_id), **deltas)
+
+
+def add_to_group(group_id, **deltas):
+    if group_id is not None:
+        _add(Group.objects.filter(pk=group_id), **deltas)
+
+
+def for_user(user):
+    """счётчики пользователя; отсутствующая строка создаётся на лету"""
+    try:
+        return user.counter
+    except UserCounter.DoesNotExist:
+        reconcile_users(User.objects.filter(pk=user.pk))
+        return UserCounter.objects.get(user_id=user.pk)
+
+
+def _count(model, field):
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef("pk")}).order_by()
+        .values(field).annotate(n=Count("pk")).values("n")
+    ), 0)
+
+
+def _fix(queryset, model, fields):
+    """обновляет только разошедшиеся строки, пачками по диапазонам pk"""
+    fixed = 0
+    last_pk = None
+    while True:
+        chunk = queryset.order_by("pk")
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        batch = list(chunk[:BATCH_SIZE])
+        if not batch:
+            return fixed
+        for obj in batch:
+            for name in fields:
+                setattr(obj, name, getattr(obj, "real_" + name))
+        model.objects.bulk_update(batch, fields)
+        fixed += len(batch)
+        last_pk = batch[-1].pk
+
+
+def reconcile_users(users=None):
+    """пересчитывает счётчики пользователей; возвращает число исправленных"""
+    users = User.objects.all() if users is None else users
+    UserCounter.objects.bulk_create(
+        [UserCounter(user_id=pk) for pk in users.filter(counter__isnull=True).values_list("pk", flat=True)],
+        ignore_conflicts=True)
+    drifted = (UserCounter.objects.filter(user__in=users.values("pk"))
+               .annotate(real_posts=_count(Post, "author"),
+                         real_followers=_count(Follow, "author"),
+                         real_following=_count(Follow, "user"))
+               .exclude(posts=F("real_posts"), followers=F("real_followers"),
+                        following=F("real_following")))
+    return _fix(drifted, UserCounter, ["posts", "followers", "following"])
+
+
+def reconcile_posts(posts=None):
+    posts = Post.objects.all() if posts is None else posts
+    drifted = (posts.annotate(real_comment_count=_count(Comment, "post"))
+               .exclude(comment_count=F("real_comment_count")).only("pk", "comment_count"))
+    return _fix(drifted, Post, ["comment_count"])
+
+
+def reconcile_groups(groups=None):
+    groups = Group.objects.all() if groups is None else groups
+    drifted = (groups.annotate(real_post_count=_count(Post, "group"))
+               .exclude(post_count=F("real_post_count")).only("pk", "post_count"))
+    return _fix(drifted, Group, ["post_count"])
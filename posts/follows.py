@@ -0,0 +1,108 @@
+"""Подписки.
+
+follow/unfollow пишут в posts_follow одним запросом: INSERT, который
+молча пропускает уже существующую пару (user, author), и DELETE.
+Уникальный индекс (user, author) не даёт двойному клику создать дубликат,
+а *_many подписывают и отписывают от сотен авторов парой запросов.
+
+Сигналы post_save/post_delete при этом не посылаются — счётчики, ленты,
+граф подписок (posts.graph), очередь рекомендаций и кэш обновляют
+followed/unfollowed. Их же вызывают обработчики сигналов,
+когда Follow создают или удаляют через ORM (админка, тесты).
+"""
+from django.db import connection, transaction
+from django.utils import timezone
+
+from posts import cache, counters, graph, recommendations, timeline, trending
+from posts.models import Follow
+
+#  пар в одном запросе: SQLite ограничивает число параметров 999
+CHUNK_SIZE = 400
+
+TABLE = Follow._meta.db_table
+
+#  RETURNING (SQLite 3.35+, PostgreSQL) сообщает, какие пары реально
+#  добавлены или удалены, — счётчики не разойдутся и при параллельных запросах
+INSERT_SQL = ("INSERT INTO %s (user_id, author_id, created) VALUES %%s ON CONFLICT DO NOTHING RETURNING author_id"
+              % TABLE)
+DELETE_SQL = "DELETE FROM %s WHERE user_id = %%%%s AND author_id IN (%%s) RETURNING author_id" % TABLE
+
+
+def _write(sql, placeholders, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql % placeholders, params)
+        return [author_id for author_id, in cursor.fetchall()]
+
+
+def _insert(user_id, author_ids):
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    return _write(INSERT_SQL, ", ".join(["(%s, %s, %s)"] * len(author_ids)),
+                  [value for author_id in author_ids for value in (user_id, author_id, now)])
+
+
+def _delete(user_id, author_ids):
+    return _write(DELETE_SQL, ", ".join(["%s"] * len(author_ids)), [user_id, *author_ids])
+
+
+def _bump_profiles(user_id, author_ids):
+    #  на страницах пользователей видны числа подписок и подписчиков
+    cache.bump("follow:%s" % user_id, "profile:%s" % user_id,
+               *("profile:%s" % author_id for author_id in author_ids))
+
+
+def followed(user_id, author_ids):
+    """производные данные после новых подписок user_id на author_ids"""
+    if not author_ids:
+        return
+    counters.add_to_user(user_id, following=len(author_ids))
+    counters.add_to_users(author_ids, followers=1)
+    trending.authors_followed(author_ids)
+    timeline.backfill(user_id, author_ids)
+    graph.changed("follow", user_id, author_ids)
+    recommendations.enqueue(user_id)
+    _bump_profiles(user_id, author_ids)
+
+
+def unfollowed(user_id, author_ids):
+    """производные данные после отписки user_id от author_ids"""
+    if not author_ids:
+        return
+    counters.add_to_user(user_id, following=-len(author_ids))
+    counters.add_to_users(author_ids, followers=-1)
+    timeline.prune(user_id, author_ids)
+    graph.changed("unfollow", user_id, author_ids)
+    recommendations.enqueue(user_id)
+    _bump_profiles(user_id, author_ids)
+
+
+def follow(user_id, author_id):
+    """подписывает; False, если подписка уже была или это сам автор"""
+    return bool(follow_many(user_id, [author_id]))
+
+
+def unfollow(user_id, author_id):
+    """отписывает; False, если подписки не было"""
+    return bool(unfollow_many(user_id, [author_id]))
+
+
+def follow_many(user_id, author_ids):
+    """подписывает на авторов пачками INSERT-ов;
+    возвращает id авторов, подписка на которых появилась"""
+    author_ids = sorted(set(author_ids) - {user_id})
+    created = []
+    with transaction.atomic():
+        for start in range(0, len(author_ids), CHUNK_SIZE):
+            created += _insert(user_id, author_ids[start:start + CHUNK_SIZE])
+        followed(user_id, created)
+    return created
+
+
+def unfollow_many(user_id, author_ids):
+    """отписывает от авторов; возвращает id тех, от кого отписал"""
+    author_ids = sorted(set(author_ids))
+    deleted = []
+    with transaction.atomic():
+        for start in range(0, len(author_ids), CHUNK_SIZE):
+            deleted += _delete(user_id, author_ids[start:start + CHUNK_SIZE])
+        unfollowed(user_id, deleted)
+    return deleted
@@ -0,0 +1,482 @@
+"""Граф подписок в памяти процесса.
+
+Подписки хранятся в формате CSR в обе стороны: для пользователя v его
+авторы — это targets[offsets[v]:offsets[v + 1]], отсортированные по id.
+Проверка "подписан ли X на Y" — двоичный поиск в этом отрезке, число
+подписок и подписчиков — разность двух смещений; к базе при этом
+обращаться не нужно.
+
+CSR не меняется на месте: подписки и отписки после сборки копятся в
+небольших наборах поверх него и время от времени вливаются в новый CSR.
+Каждое изменение после коммита получает номер поколения "graph"
+(posts.cache) и кладётся в кэш под этим номером, поэтому остальные
+процессы доигрывают чужие изменения по порядку, а не пересобирают граф.
+Пересборка из базы нужна, только если изменения успели вытеснить из кэша
+или ещё не положили в него.
+
+Граф и его наборы изменений меняются под блокировкой _lock, а наборы
+при этом заменяются целиком — читатели обходятся без блокировки.
+
+Собранный граф сохраняется в файл GRAPH_SNAPSHOT; другие воркеры
+отображают его в память (mmap) и делят одну копию страниц.
+
+Сборка из базы проходит все подписки, поэтому запросы к сайту её не
+ждут: пока графа нет (первый запрос воркера, поколение без изменения в
+кэше, истёкший граф без общего кэша), он собирается в фоновом потоке, а
+is_following и остальные функции модуля отвечают индексными запросами к
+таблице подписок. С GRAPH_ASYNC = False граф собирается сразу.
+"""
+import bisect
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.db import connection, transaction
+
+from posts import cache
+from posts.models import Follow
+from yatube import replicas
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT = getattr(settings, "GRAPH_SNAPSHOT", None)
+#  сколько изменений держать поверх CSR, прежде чем влить их в него
+COMPACT_AFTER = 10000
+#  сколько изменений других процессов доигрывать, а не пересобирать граф
+MAX_REPLAY = 1000
+DELTA_TIMEOUT = 60 * 60
+#  без общего кэша (DummyCache) процессы не согласовать: граф процесса
+#  пересобирается из базы не чаще раза в столько секунд
+UNSHARED_TTL = 5
+
+MAGIC = b"YTG1"
+HEADER = struct.Struct("<4sqqq")
+
+
+def _delta_key(version):
+    return "graph:delta:%s" % version
+
+
+class Adjacency:
+    """одно направление графа в формате CSR"""
+
+    def __init__(self, offsets, targets):
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def from_rows(cls, rows, size):
+        """rows — пары (v, w), отсортированные по v, затем по w"""
+        counts = array("q", bytes(8 * (size + 1)))
+        targets = array("q")
+        for v, w in rows:
+            counts[v + 1] += 1
+            targets.append(w)
+        for v in range(size):
+            counts[v + 1] += counts[v]
+        return cls(counts, targets)
+
+    def transpose(self, size):
+        """то же отношение в обратную сторону (сортировка подсчётом)"""
+        offsets = array("q", bytes(8 * (size + 1)))
+        for w in self.targets:
+            offsets[w + 1] += 1
+        for v in range(size):
+            offsets[v + 1] += offsets[v]
+        position = array("q", offsets)
+        targets = array("q", bytes(8 * len(self.targets)))
+        #  строки исходного CSR идут по возрастанию v, поэтому и в новых
+        #  строках v окажутся отсортированными
+        for v in range(len(self.offsets) - 1):
+            for index in range(self.offsets[v], self.offsets[v + 1]):
+                w = self.targets[index]
+                targets[position[w]] = v
+                position[w] += 1
+        return Adjacency(offsets, targets)
+
+    @property
+    def size(self):
+        return len(self.offsets) - 1
+
+    def _row(self, v):
+        if 0 <= v < self.size:
+            return self.offsets[v], self.offsets[v + 1]
+        return 0, 0
+
+    def contains(self, v, w):
+        lo, hi = self._row(v)
+        index = bisect.bisect_left(self.targets, w, lo, hi)
+        return index < hi and self.targets[index] == w
+
+    def degree(self, v):
+        lo, hi = self._row(v)
+        return hi - lo
+
+    def neighbors(self, v, limit=None):
+        """соседи по возрастанию id; из строки длиннее limit — limit
+        соседей, взятых с равным шагом по всей строке"""
+        lo, hi = self._row(v)
+        if limit is not None and hi - lo > limit:
+            step = (hi - lo) / limit
+            return [self.targets[lo + int(i * step)] for i in range(limit)]
+        return self.targets[lo:hi]
+
+
+class Direction:
+    """CSR плюс изменения, ещё не влитые в него"""
+
+    def __init__(self, csr):
+        self.csr = csr
+        self.added = {}
+        self.removed = {}
+
+    def contains(self, v, w):
+        if w in self.added.get(v, ()):
+            return True
+        if w in self.removed.get(v, ()):
+            return False
+        return self.csr.contains(v, w)
+
+    def degree(self, v):
+        return self.csr.degree(v) + len(self.added.get(v, ())) - len(self.removed.get(v, ()))
+
+    def neighbors(self, v, limit=None):
+        """соседи по возрастанию id; limit ограничивает выборку из CSR
+        (см. Adjacency.neighbors)"""
+        removed = self.removed.get(v, ())
+        result = [w for w in self.csr.neighbors(v, limit) if w not in removed]
+        added = self.added.get(v)
+        if added:
+            result = sorted(result + list(added))
+            #  не влитые подписки не должны раздувать выборку
+            if limit is not None and len(result) > limit:
+                step = len(result) / limit
+                result = [result[int(i * step)] for i in range(limit)]
+        return result
+
+    def link(self, v, w):
+        if self.csr.contains(v, w):
+            _discard(self.removed, v, w)
+        else:
+            _add(self.added, v, w)
+
+    def unlink(self, v, w):
+        if self.csr.contains(v, w):
+            _add(self.removed, v, w)
+        else:
+            _discard(self.added, v, w)
+
+    def rows(self, size):
+        for v in range(size):
+            for w in self.neighbors(v):
+                yield v, w
+
+
+#  набор не меняется на месте, а заменяется новым: читатель, который
+#  обходит старый набор в другом потоке, не получит RuntimeError
+
+def _add(sets, v, w):
+    sets[v] = sets.get(v, frozenset()) | {w}
+
+
+def _discard(sets, v, w):
+    items = sets.get(v)
+    if items is not None and w in items:
+        items = items - {w}
+        if items:
+            sets[v] = items
+        else:
+            del sets[v]
+
+
+class FollowGraph:
+    def __init__(self, following, followers, version):
+        #  following: пользователь -> авторы, followers: автор -> подписчики
+        self.following = Direction(following)
+        self.followers = Direction(followers)
+        self.version = version
+        self.pending = 0
+
+    @classmethod
+    def from_database(cls, version):
+        pairs = (Follow.objects.order_by("user_id", "author_id")
+                 .values_list("user_id", "author_id").iterator())
+        last = Follow.objects.order_by("-user_id").values_list("user_id", flat=True).first() or 0
+        last_author = Follow.objects.order_by("-author_id").values_list("author_id", flat=True).first() or 0
+        size = max(last, last_author) + 1
+        following = Adjacency.from_rows(pairs, size)
+        return cls(following, following.transpose(size), version)
+
+    def is_following(self, user_id, author_id):
+        return self.following.contains(user_id, author_id)
+
+    def following_count(self, user_id):
+        return self.following.degree(user_id)
+
+    def followers_count(self, author_id):
+        return self.followers.degree(author_id)
+
+    def followees(self, user_id, limit=None):
+        """id авторов, на которых подписан пользователь, по возрастанию"""
+        return self.following.neighbors(user_id, limit)
+
+    def follower_ids(self, author_id, limit=None):
+        return self.followers.neighbors(author_id, limit)
+
+    def apply(self, op, user_id, author_ids):
+        """применяет изменение; повторное применение ничего не меняет"""
+        for author_id in author_ids:
+            if op == "follow":
+                self.following.link(user_id, author_id)
+                self.followers.link(author_id, user_id)
+            else:
+                self.following.unlink(user_id, author_id)
+                self.followers.unlink(author_id, user_id)
+        self.pending += len(author_ids)
+        if self.pending > COMPACT_AFTER:
+            self.compact()
+
+    def compact(self):
+        """вливает накопленные изменения в новый CSR"""
+        size = 1 + max([self.following.csr.size - 1, self.followers.csr.size - 1,
+                        *self.following.added, *self.followers.added])
+        following = Adjacency.from_rows(self.following.rows(size), size)
+        self.following = Direction(following)
+        self.followers = Direction(following.transpose(size))
+        self.pending = 0
+        save(self)
+
+
+def save(graph, path=None):
+    """сохраняет влитый граф в файл для других процессов"""
+    path = path or SNAPSHOT
+    if not path or graph.pending:
+        return
+    following, followers = graph.following.csr, graph.followers.csr
+    temporary = "%s.%s" % (path, os.getpid())
+    with open(temporary, "wb") as fp:
+        fp.write(HEADER.pack(MAGIC, graph.version or 0, following.size, len(following.targets)))
+        for values in (following.offsets, following.targets, followers.offsets, followers.targets):
+            fp.write(values.tobytes())
+    os.replace(temporary, path)
+
+
+def load(path=None):
+    """граф из файла, отображённого в память, или None"""
+    path = path or SNAPSHOT
+    if not path:
+        return None
+    try:
+        with open(path, "rb") as fp:
+            buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size, edges = HEADER.unpack_from(buffer)
+    except (OSError, ValueError, struct.error):
+        return None
+    if magic != MAGIC or len(buffer) != HEADER.size + 8 * (2 * (size + 1) + 2 * edges):
+        return None
+    view = memoryview(buffer)[HEADER.size:].cast("q")
+    parts, start = [], 0
+    for length in (size + 1, edges, size + 1, edges):
+        parts.append(view[start:start + length])
+        start += length
+    return FollowGraph(Adjacency(parts[0], parts[1]), Adjacency(parts[2], parts[3]), version)
+
+
+_graph = None
+_built_at = 0
+#  граф меняют потоки пула миниатюр, потока записи и многопоточного сервера
+_lock = threading.RLock()
+#  идёт ли фоновая сборка
+_building = False
+
+
+def _replay(graph, current):
+    """доигрывает изменения других процессов; False, если их нет в кэше"""
+    if current - graph.version > MAX_REPLAY or current < graph.version:
+        return False
+    keys = [_delta_key(version) for version in range(graph.version + 1, current + 1)]
+    deltas = django_cache.get_many(keys)
+    if len(deltas) < len(keys):
+        return False
+    for key in keys:
+        graph.apply(*deltas[key])
+    graph.version = current
+    return True
+
+
+def _fresh(current):
+    """граф процесса, если он уже догнан до current, иначе None"""
+    graph = _graph
+    if current is None:
+        if graph is not None and graph.version is None and time.monotonic() - _built_at < UNSHARED_TTL:
+            return graph
+    elif graph is not None and graph.version == current:
+        return graph
+    return None
+
+
+def _caught_up(current):
+    """граф, догнанный до current без сборки из базы: доигрыванием
+    изменений или из файла GRAPH_SNAPSHOT; None, если так не выйдет"""
+    global _graph
+    graph = _graph
+    if graph is not None and graph.version is not None and (
+            graph.version == current or _replay(graph, current)):
+        return graph
+    graph = load()
+    if graph is not None and _replay(graph, current):
+        _graph = graph
+        return graph
+    return None
+
+
+def _build(current):
+    """собирает граф из основной базы: граф с реплики сохранился бы без
+    последних подписок под поколением, которое их уже учитывает"""
+    global _graph, _built_at
+    #  поколение растёт только после коммита изменения, поэтому база,
+    #  прочитанная после поколения, содержит все изменения до current
+    #  включительно; доигрывание более поздних ничего не испортит
+    with replicas.use_primary():
+        graph = FollowGraph.from_database(current)
+    save(graph)
+    with _lock:
+        _graph, _built_at = graph, time.monotonic()
+    return graph
+
+
+def get():
+    """граф текущего процесса, догнанный до последнего изменения; при
+    необходимости собирается из базы сразу — для команд и фоновых задач"""
+    [current] = cache.generations("graph")
+    graph = _fresh(current)
+    if graph is not None:
+        return graph
+    with _lock:
+        graph = _fresh(current) or (_caught_up(current) if current is not None else None)
+    #  сборка идёт без блокировки: изменения тем временем доходят до
+    #  кэша, и собранный граф их доиграет
+    return graph or _build(current)
+
+
+def ready():
+    """граф, если его не нужно собирать из базы, иначе None — тогда он
+    собирается в фоне; для запросов к сайту"""
+    if not getattr(settings, "GRAPH_ASYNC", True):
+        return get()
+    [current] = cache.generations("graph")
+    graph = _fresh(current)
+    if graph is not None:
+        return graph
+    #  блокировку держит сборка или доигрывание — не ждём их
+    if current is not None and _lock.acquire(blocking=False):
+        try:
+            graph = _caught_up(current)
+        finally:
+            _lock.release()
+        if graph is not None:
+            return graph
+    _build_later()
+    return None
+
+
+def _build_later():
+    global _building
+    with _lock:
+        if _building:
+            return
+        _building = True
+    threading.Thread(target=_build_in_background, name="graph", daemon=True).start()
+
+
+def _build_in_background():
+    global _building
+    try:
+        get()
+    except Exception:
+        logger.exception("Не удалось собрать граф подписок")
+    finally:
+        _building = False
+        #  у потока своё соединение с базой
+        connection.close()
+
+
+def changed(op, user_id, author_ids):
+    """сообщает о подписке ("follow") или отписке ("unfollow")"""
+    global _graph
+    author_ids = list(author_ids)
+    with _lock:
+        if _graph is not None and _graph.version is None:
+            #  граф без общего кэша соберётся заново при обращении
+            _graph = None
+    #  до коммита другой процесс, не найдя изменения в базе, собрал бы
+    #  граф без него под новым поколением
+    transaction.on_commit(lambda: _publish(op, user_id, author_ids))
+
+
+def _publish(op, user_id, author_ids):
+    global _graph
+    with _lock:
+        try:
+            version = django_cache.incr(cache._key("graph"))
+        except ValueError:
+            #  поколения нет: граф соберут из базы при первом обращении
+            _graph = None
+            return
+        django_cache.set(_delta_key(version), (op, user_id, author_ids), DELTA_TIMEOUT)
+        if _graph is not None and _graph.version == version - 1:
+            _graph.apply(op, user_id, author_ids)
+            _graph.version = version
+
+
+def reset():
+    """забывает граф процесса, например между тестами"""
+    global _graph
+    with _lock:
+        _graph = None
+
+
+#  пока граф собирается, ответы дают индексы таблицы подписок
+
+def is_following(user_id, author_id):
+    graph = ready()
+    if graph is None:
+        return Follow.objects.filter(user_id=user_id, author_id=author_id).exists()
+    return graph.is_following(user_id, author_id)
+
+
+def followed_among(user_id, author_ids):
+    """те из author_ids, на кого подписан пользователь"""
+    graph = ready()
+    if graph is None:
+        return set(Follow.objects.filter(user_id=user_id, author_id__in=author_ids)
+                   .values_list("author_id", flat=True))
+    return {author_id for author_id in author_ids if graph.is_following(user_id, author_id)}
+
+
+def following_count(user_id):
+    graph = ready()
+    if graph is None:
+        return Follow.objects.filter(user_id=user_id).count()
+    return graph.following_count(user_id)
+
+
+def followers_count(author_id):
+    graph = ready()
+    if graph is None:
+        return Follow.objects.filter(author_id=author_id).count()
+    return graph.followers_count(author_id)
+
+
+def followees(user_id):
+    graph = ready()
+    if graph is None:
+        return list(Follow.objects.filter(user_id=user_id).order_by("author_id")
+                    .values_list("author_id", flat=True))
+    return graph.followees(user_id)
@@ -0,0 +1,66 @@
+"""Кэш "имя пользователя -> пользователь" для адресов вида /<username>/.
+
+Почти каждая страница находит пользователя по имени из URL. Имя
+сопоставляется с id и полями, которые показывают страницы, через общий
+кэш, так что на горячем пути база не нужна. Записи удаляют обработчики
+сигналов при сохранении и удалении пользователя (posts.signals); массовые
+UPDATE имён мимо save() кэш не увидит.
+"""
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.http import Http404
+
+from yatube import replicas
+
+User = get_user_model()
+
+#  поля, которые есть у пользователя из кэша; остальные догрузятся из
+#  базы при первом обращении
+FIELDS = ("id", "username", "first_name", "last_name")
+TIMEOUT = 24 * 60 * 60
+#  несуществующие имена тоже запоминаются, но ненадолго
+MISSING_TIMEOUT = 60
+MISSING = "-"
+
+
+def _key(username):
+    return "user:%s" % username
+
+
+def _user(row):
+    #  как загруженный из базы: незаданные поля отложены (deferred)
+    return User.from_db(None, FIELDS, row)
+
+
+def get_many(usernames):
+    """пользователи по именам: {username: User}; ненайденных нет в ответе"""
+    usernames = set(usernames)
+    found = cache.get_many([_key(username) for username in usernames])
+    rows = {username: found.get(_key(username)) for username in usernames}
+    missing = [username for username, row in rows.items() if row is None]
+    if missing:
+        #  запись кэша живёт сутки — дольше любого отставания реплики
+        with replicas.use_primary():
+            loaded = {row[1]: tuple(row) for row in User.objects.filter(username__in=missing).values_list(*FIELDS)}
+        cache.set_many({_key(username): row for username, row in loaded.items()}, TIMEOUT)
+        cache.set_many({_key(username): MISSING for username in missing if username not in loaded},
+                       MISSING_TIMEOUT)
+        rows.update(loaded)
+    return {username: _user(row) for username, row in rows.items() if row and row != MISSING}
+
+
+def get(username):
+    """пользователь по имени или None"""
+    return get_many([username]).get(username)
+
+
+def get_or_404(username):
+    user = get(username)
+    if user is None:
+        raise Http404("Пользователь не найден")
+    return user
+
+
+def forget(*usernames):
+    """удаляет записи кэша, например после изменения пользователя"""
+    cache.delete_many([_key(username) for username in usernames if username])
@@ -0,0 +1,118 @@
+import json
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from posts.models import Post, Group, UserCounter
+from posts.urls import app_name, urlpatterns
+
+User = get_user_model()
+
+#  эти адреса меняют данные — их не замеряем
+SKIP = {"profile_follow", "profile_unfollow", "follow_bulk"}
+
+
+def percentile(values, fraction):
+    """перцентиль по ближайшему рангу"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = ("Замеряет время ответа и число запросов для каждого адреса posts/urls.py "
+            "на текущих данных и сохраняет результат в JSON")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=50, help="запросов на адрес")
+        parser.add_argument("--warmup", type=int, default=3)
+        parser.add_argument("--cold", action="store_true", help="очищать кэш перед каждым запросом")
+        parser.add_argument("--output", default="bench_output.json")
+        parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+
+    def sample_kwargs(self):
+        """самый популярный автор, его свежий пост и самое крупное сообщество"""
+        counter = UserCounter.objects.select_related("user").order_by("-followers").first()
+        if counter is None:
+            raise CommandError("Нет данных: сначала запустите generate_data")
+        author = counter.user
+        post = Post.objects.filter(author=author).order_by("-pub_date").first()
+        group = Group.objects.order_by("-post_count").first()
+        reader = (User.objects.filter(counter__following__gt=0)
+                  .order_by("-counter__following").first() or author)
+        return reader, {
+            "username": author.username,
+            "post_id": post.id if post else 0,
+            "slug": group.slug if group else "",
+        }
+
+    def measure(self, client, url, options):
+        timings, query_counts, statuses = [], [], set()
+        for attempt in range(options["warmup"] + options["requests"]):
+            if options["cold"]:
+                cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = client.get(url)
+                elapsed = time.perf_counter() - started
+            if attempt < options["warmup"]:
+                continue
+            timings.append(elapsed * 1000)
+            query_counts.append(len(queries))
+            statuses.add(response.status_code)
+        return {
+            "url": url,
+            "status": sorted(statuses),
+            "p50_ms": round(percentile(timings, 0.50), 3),
+            "p95_ms": round(percentile(timings, 0.95), 3),
+            "p99_ms": round(percentile(timings, 0.99), 3),
+            "queries_p50": percentile(query_counts, 0.50),
+            "queries_max": max(query_counts),
+        }
+
+    def handle(self, *args, **options):
+        reader, sample = self.sample_kwargs()
+        #  адрес не из INTERNAL_IPS, чтобы не включалась панель отладки
+        client = Client(REMOTE_ADDR="10.0.0.1")
+        client.force_login(reader)
+
+        results = {}
+        for pattern in urlpatterns:
+            if not pattern.name or pattern.name in SKIP:
+                continue
+            kwargs = {name: sample[name] for name in pattern.pattern.converters}
+            url = reverse("%s:%s" % (app_name, pattern.name), kwargs=kwargs)
+            results[pattern.name] = self.measure(client, url, options)
+            row = results[pattern.name]
+            self.stdout.write("%-16s p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  queries %s" % (
+                pattern.name, row["p50_ms"], row["p95_ms"], row["p99_ms"], row["queries_p50"]))
+
+        report = {
+            "created": timezone.now().isoformat(),
+            "options": {name: options[name] for name in ("requests", "warmup", "cold")},
+            "dataset": {
+                "users": User.objects.count(),
+                "groups": Group.objects.count(),
+                "posts": Post.objects.count(),
+            },
+            "results": results,
+        }
+        with open(options["output"], "w") as fp:
+            json.dump(report, fp, indent=2, ensure_ascii=False)
+        self.stdout.write("Результаты сохранены в %s" % options["output"])
+
+        if options["compare"]:
+            with open(options["compare"]) as fp:
+                previous = json.load(fp)["results"]
+            for name, row in results.items():
+                if name in previous:
+                    before = previous[name]
+                    self.stdout.write("%-16s p95 %8.2f -> %8.2f ms  queries %s -> %s" % (
+                        name, before["p95_ms"], row["p95_ms"], before["queries_p50"], row["queries_p50"]))
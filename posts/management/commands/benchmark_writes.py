@@ -0,0 +1,159 @@
+import json
+import multiprocessing
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from posts.management.commands.benchmark_feeds import percentile
+from posts.models import Post
+
+User = get_user_model()
+
+
+def _client(user):
+    #  адрес не из INTERNAL_IPS, чтобы не включалась панель отладки
+    client = Client(REMOTE_ADDR="10.0.0.1")
+    client.force_login(user)
+    return client
+
+
+def _thread(users, posts, options, until, results):
+    rng = random.Random()
+    client = _client(rng.choice(users))
+    reads, writes, errors = [], [], 0
+    while time.monotonic() < until:
+        author, post_id = rng.choice(posts)
+        write = rng.random() < options["write_ratio"]
+        started = time.perf_counter()
+        try:
+            if not write:
+                response = client.get(rng.choice((
+                    reverse("posts:index"),
+                    reverse("posts:post", kwargs={"username": author, "post_id": post_id}))))
+            elif rng.random() < options["follow_ratio"]:
+                response = client.get(reverse("posts:profile_follow", kwargs={"username": author}))
+            else:
+                response = client.post(
+                    reverse("posts:add_comment", kwargs={"username": author, "post_id": post_id}),
+                    {"text": "benchmark %s" % rng.random()})
+            failed = response.status_code >= 400
+        except Exception:
+            failed = True
+        elapsed = (time.perf_counter() - started) * 1000
+        if failed:
+            errors += 1
+        else:
+            (writes if write else reads).append(elapsed)
+    connection.close()
+    results.append((reads, writes, errors))
+
+
+def _worker(args):
+    """один процесс: options["threads"] потоков до момента until"""
+    users, posts, options, until = args
+    results = []
+    threads = [threading.Thread(target=_thread, args=(users, posts, options, until, results))
+               for _ in range(options["threads"])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class Command(BaseCommand):
+    help = ("Нагружает сайт смешанными чтениями лент и записями комментариев и "
+            "подписок из нескольких процессов и потоков; сохраняет пропускную "
+            "способность и задержки в JSON. Для сравнения с обычным бэкендом: "
+            "YATUBE_DB_ENGINE=django.db.backends.sqlite3 ... --journal-mode delete")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=4)
+        parser.add_argument("--threads", type=int, default=4, help="потоков в процессе")
+        parser.add_argument("--seconds", type=float, default=10)
+        parser.add_argument("--write-ratio", type=float, default=0.3, help="доля записей")
+        parser.add_argument("--follow-ratio", type=float, default=0.2, help="доля подписок среди записей")
+        parser.add_argument("--journal-mode", help="переключить режим журнала файла базы перед замером")
+        parser.add_argument("--output", default="bench_writes.json")
+        parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+
+    def handle(self, *args, **options):
+        users = list(User.objects.order_by("?").values_list("username", flat=True)[:200])
+        posts = list(Post.objects.order_by("-pub_date").values_list("author__username", "id")[:500])
+        if not users or not posts:
+            raise CommandError("Нет данных: сначала запустите generate_data")
+        users = list(User.objects.filter(username__in=users))
+        with connection.cursor() as cursor:
+            if options["journal_mode"]:
+                cursor.execute("PRAGMA journal_mode = %s" % options["journal_mode"])
+            cursor.execute("PRAGMA journal_mode")
+            journal_mode = cursor.fetchone()[0]
+        #  дочерние процессы откроют свои соединения
+        connections.close_all()
+
+        until = time.monotonic() + options["seconds"]
+        context = multiprocessing.get_context("fork")
+        with context.Pool(options["processes"]) as pool:
+            chunks = pool.map(_worker, [(users, posts, options, until)] * options["processes"])
+        reads, writes, errors = [], [], 0
+        for thread_reads, thread_writes, thread_errors in (row for chunk in chunks for row in chunk):
+            reads += thread_reads
+            writes += thread_writes
+            errors += thread_errors
+        if not reads and not writes:
+            raise CommandError("Ни один запрос не выполнен")
+
+        def summary(timings):
+            if not timings:
+                return {"count": 0}
+            return {
+                "count": len(timings),
+                "per_second": round(len(timings) / options["seconds"], 1),
+                "p50_ms": round(percentile(timings, 0.50), 3),
+                "p95_ms": round(percentile(timings, 0.95), 3),
+                "p99_ms": round(percentile(timings, 0.99), 3),
+            }
+
+        results = {
+            "total_per_second": round((len(reads) + len(writes)) / options["seconds"], 1),
+            "reads": summary(reads),
+            "writes": summary(writes),
+            "errors": errors,
+        }
+        report = {
+            "created": timezone.now().isoformat(),
+            "engine": settings.DATABASES["default"]["ENGINE"],
+            "journal_mode": journal_mode,
+            "write_coalescing": getattr(settings, "WRITE_COALESCING", False),
+            "options": {name: options[name] for name in
+                        ("processes", "threads", "seconds", "write_ratio", "follow_ratio")},
+            "results": results,
+        }
+        self.stdout.write("%s, журнал %s: %s запросов/с, ошибок %s" % (
+            report["engine"], journal_mode, results["total_per_second"], errors))
+        for kind in ("reads", "writes"):
+            row = results[kind]
+            if row["count"]:
+                self.stdout.write("%-6s %8.1f/с  p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms" % (
+                    kind, row["per_second"], row["p50_ms"], row["p95_ms"], row["p99_ms"]))
+        with open(options["output"], "w") as fp:
+            json.dump(report, fp, indent=2, ensure_ascii=False)
+        self.stdout.write("Результаты сохранены в %s" % options["output"])
+
+        if options["compare"]:
+            with open(options["compare"]) as fp:
+                previous = json.load(fp)["results"]
+            self.stdout.write("всего  %8.1f -> %8.1f запросов/с, ошибок %s -> %s" % (
+                previous["total_per_second"], results["total_per_second"], previous["errors"], errors))
+            for kind in ("reads", "writes"):
+                before, after = previous[kind], results[kind]
+                if before["count"] and after["count"]:
+                    self.stdout.write("%-6s p95 %8.2f -> %8.2f ms" % (kind, before["p95_ms"], after["p95_ms"]))
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from posts import cache, graph
+
+
+class Command(BaseCommand):
+    help = ("Собирает граф подписок из базы и сохраняет его в файл GRAPH_SNAPSHOT, "
+            "который воркеры отображают в память вместо сборки своей копии")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default=graph.SNAPSHOT, help="путь к файлу графа")
+
+    def handle(self, *args, **options):
+        if not options["output"]:
+            raise CommandError("Укажите --output или настройку GRAPH_SNAPSHOT")
+        started = time.perf_counter()
+        [version] = cache.generations("graph")
+        built = graph.FollowGraph.from_database(version)
+        graph.save(built, options["output"])
+        self.stdout.write("Подписок: %s, за %.2f с, файл %s" % (
+            len(built.following.csr.targets), time.perf_counter() - started, options["output"]))
@@ -0,0 +1,34 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from posts import graph, recommendations
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = ("Пересчитывает рекомендации \"кого почитать\": для всех пользователей "
+            "или (--incremental) только для тех, чьи подписки изменились")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--incremental", action="store_true",
+                            help="только пользователи из очереди и их подписчики")
+        parser.add_argument("--top", type=int, default=recommendations.TOP_N)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        users, queued = recommendations.claim()
+        if not options["incremental"]:
+            #  полный пересчёт заодно обслуживает очередь
+            users = list(User.objects.order_by("pk").values_list("pk", flat=True).iterator())
+        scorer = recommendations.Scorer(graph.get())
+        stored = 0
+        size = recommendations.BATCH_SIZE
+        for start in range(0, len(users), size):
+            stored += recommendations.refresh(users[start:start + size], scorer, options["top"])
+        #  после сбоя очередь не потеряна: следующий запуск посчитает её снова
+        recommendations.done(queued)
+        self.stdout.write("Пользователей: %s, рекомендаций: %s, за %.2f с" % (
+            len(users), stored, time.perf_counter() - started))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from posts import thumbnails
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = "Готовит миниатюры для постов, у которых их ещё нет"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="пересобрать миниатюры всех постов")
+
+    def handle(self, *args, **options):
+        posts = Post.objects.exclude(image="").exclude(image__isnull=True)
+        if not options["all"]:
+            posts = posts.filter(image_thumb__isnull=True)
+        done = 0
+        for post_id in posts.values_list("pk", flat=True).iterator():
+            thumbnails.build(post_id)
+            done += 1
+        self.stdout.write("Обработано постов: %s" % done)
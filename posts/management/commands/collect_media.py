@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from posts import blobs
+
+
+class Command(BaseCommand):
+    help = ("Стирает картинки постов, на которые больше никто не ссылается, "
+            "вместе с их миниатюрами; ссылки предварительно пересчитываются")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grace", type=float, default=blobs.GRACE_SECONDS,
+                            help="не трогать файлы, загруженные или изменённые за столько секунд")
+        parser.add_argument("--dry-run", action="store_true", help="только посчитать файлы")
+
+    def handle(self, *args, **options):
+        removed, freed = blobs.collect(options["grace"], options["dry_run"])
+        if options["dry_run"]:
+            self.stdout.write("Можно стереть файлов: %s" % removed)
+            return
+        self.stdout.write("Стёрто файлов: %s, освобождено %.1f МБ" % (removed, freed / 2 ** 20))
@@ -0,0 +1,32 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from posts import transfer
+
+
+class Command(BaseCommand):
+    help = ("Выгружает пользователей, сообщества, посты, комментарии и подписки в NDJSON "
+            "(строка — запись); память не зависит от объёма данных")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default="-", help="файл; по умолчанию stdout")
+        parser.add_argument("--batch", type=int, default=transfer.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        output = (sys.stdout if options["output"] == "-"
+                  else open(options["output"], "w", encoding="utf-8"))
+        count = 0
+        try:
+            for line in transfer.export(options["batch"]):
+                output.write(line)
+                count += 1
+                if count % 10000 == 0:
+                    self.stderr.write("\rЗаписей: %s" % count, ending="")
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        elapsed = time.perf_counter() - started
+        self.stderr.write("\rЗаписей: %s за %.1f с (%.0f в секунду)" % (count, elapsed, count / max(elapsed, 1e-9)))
@@ -0,0 +1,142 @@
+import bisect
+import random
+from array import array
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from posts.bulk import batches, keep_auto_now, rebuild_derived
+from posts.models import Post, Group, Comment, Follow
+
+User = get_user_model()
+
+WORDS = (
+    "блог пост лента подписка автор новости фото кот сообщество мнение обзор "
+    "путешествие музыка кино книга код python django погода город утро вечер"
+).split()
+
+
+def power_law_weights(count, alpha):
+    """накопленные веса Ципфа: k-й по популярности получает вес 1 / k^alpha"""
+    total = 0.0
+    cumulative = []
+    for rank in range(1, count + 1):
+        total += 1.0 / rank ** alpha
+        cumulative.append(total)
+    return cumulative
+
+
+def pick(rng, items, cumulative):
+    return items[bisect.bisect(cumulative, rng.random() * cumulative[-1])]
+
+
+def new_ids(model, before):
+    """id строк, вставленных после before; SQLite не возвращает их из bulk_create"""
+    return array("q", model.objects.filter(pk__gt=before).order_by("pk").values_list("pk", flat=True).iterator())
+
+
+class Command(BaseCommand):
+    help = ("Генерирует синтетические данные для нагрузочных замеров: пользователей, "
+            "сообщества, посты, комментарии и граф подписок со степенным распределением")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--groups", type=int, default=20)
+        parser.add_argument("--posts", type=int, default=10000)
+        parser.add_argument("--comments", type=int, default=20000)
+        parser.add_argument("--follows", type=int, default=20, help="среднее число подписок пользователя")
+        parser.add_argument("--alpha", type=float, default=1.1, help="показатель степенного распределения")
+        parser.add_argument("--days", type=int, default=365, help="за сколько дней раскидать даты постов")
+        parser.add_argument("--prefix", default="gen", help="префикс имён пользователей и сообществ")
+        parser.add_argument("--batch", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=None)
+
+    def progress(self, label, done, total):
+        self.stderr.write("\r%s: %s/%s" % (label, done, total), ending="")
+        if done >= total:
+            self.stderr.write("")
+
+    def insert(self, label, model, objects, total, batch_size):
+        done = 0
+        for batch in batches(objects, batch_size):
+            with transaction.atomic():
+                #  размер INSERT-а подбирает сам Django под ограничения СУБД
+                model.objects.bulk_create(batch)
+            done += len(batch)
+            self.progress(label, done, total)
+
+    def text(self, rng, words):
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(*words)))
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        prefix = options["prefix"]
+        size = options["batch"]
+        now = timezone.now()
+        span = options["days"] * 24 * 3600
+
+        #  у всех сгенерированных пользователей пароль "password"
+        password = make_password("password")
+        start = User.objects.aggregate(last=Max("pk"))["last"] or 0
+        self.insert("Пользователи", User, (
+            User(username="%s%s_%s" % (prefix, start, n), password=password)
+            for n in range(options["users"])
+        ), options["users"], size)
+        users = new_ids(User, start)
+
+        start = Group.objects.aggregate(last=Max("pk"))["last"] or 0
+        self.insert("Сообщества", Group, (
+            Group(title="Сообщество %s" % n, slug="%s%s-%s" % (prefix, start, n), description=self.text(rng, (5, 20)))
+            for n in range(options["groups"])
+        ), options["groups"], size)
+        groups = list(new_ids(Group, start)) + [None]
+
+        #  популярность авторов и подписок следует закону Ципфа:
+        #  немногие пишут и собирают подписчиков больше всех остальных
+        popularity = power_law_weights(len(users), options["alpha"])
+
+        start = Post.objects.aggregate(last=Max("pk"))["last"] or 0
+        with keep_auto_now(Post, "pub_date"):
+            self.insert("Посты", Post, (
+                Post(text=self.text(rng, (5, 60)), author_id=pick(rng, users, popularity),
+                     group_id=rng.choice(groups), pub_date=now - timedelta(seconds=rng.randrange(span)))
+                for _ in range(options["posts"])
+            ), options["posts"], size)
+        posts = new_ids(Post, start)
+
+        if posts:
+            #  обсуждают в основном свежие посты — они в конце списка id
+            recency = power_law_weights(len(posts), options["alpha"])
+            newest_first = posts[::-1]
+            with keep_auto_now(Comment, "created"):
+                self.insert("Комментарии", Comment, (
+                    Comment(post_id=pick(rng, newest_first, recency), author_id=pick(rng, users, popularity),
+                            text=self.text(rng, (2, 20)), created=now - timedelta(seconds=rng.randrange(span)))
+                    for _ in range(options["comments"])
+                ), options["comments"], size)
+
+        def follows():
+            for user_id in users:
+                #  число подписок тоже с тяжёлым хвостом, среднее около --follows
+                degree = min(len(users) - 1, int(rng.paretovariate(2.0) * options["follows"] / 2))
+                authors = set()
+                for _ in range(degree * 2):
+                    if len(authors) >= degree:
+                        break
+                    author_id = pick(rng, users, popularity)
+                    if author_id != user_id:
+                        authors.add(author_id)
+                for author_id in authors:
+                    yield Follow(user_id=user_id, author_id=author_id)
+
+        self.insert("Подписки", Follow, follows(), len(users) * options["follows"], size)
+        self.stderr.write("")
+
+        #  bulk_create не посылает сигналы — догоняем производные данные
+        rebuild_derived(self.stdout.write)
+        self.stdout.write(self.style.SUCCESS("Готово"))
@@ -0,0 +1,44 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from posts import transfer
+from posts.bulk import rebuild_derived
+
+
+class Command(BaseCommand):
+    help = ("Загружает NDJSON, выгруженный export_content: пользователи и сообщества "
+            "связываются по имени и slug, посты получают новые id. Скорость на SQLite — "
+            "около 25–30 тысяч строк в секунду (190 тысяч строк за 6–7.5 с): дальше "
+            "упирается в разбор JSON и триггер полнотекстового индекса постов")
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="файл или - для stdin")
+        parser.add_argument("--batch", type=int, default=transfer.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+
+        def progress(kind, done):
+            elapsed = time.perf_counter() - started
+            self.stderr.write("\r%s: %s (%.1f с)" % (kind, done, elapsed), ending="")
+
+        importer = transfer.Importer(options["batch"], progress)
+        source = (sys.stdin if options["input"] == "-"
+                  else open(options["input"], encoding="utf-8"))
+        try:
+            importer.run(source)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        self.stderr.write("")
+        elapsed = time.perf_counter() - started
+        total = sum(importer.created.values())
+        for kind in transfer.TYPES:
+            self.stdout.write("%s: загружено %s, пропущено %s" % (
+                kind, importer.created[kind], importer.skipped[kind]))
+        self.stdout.write("Всего %s за %.1f с (%.0f в секунду)" % (total, elapsed, total / max(elapsed, 1e-9)))
+        #  bulk_create не посылает сигналы — догоняем производные данные
+        rebuild_derived(self.stdout.write)
+        self.stdout.write(self.style.SUCCESS("Готово"))
@@ -0,0 +1,52 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from posts import purge
+from posts.models import Post, Group
+
+User = get_user_model()
+
+#  тип удаляемого -> модель и поле, по которому его называют
+TARGETS = {
+    "user": (User, "username"),
+    "group": (Group, "slug"),
+    "post": (Post, "pk"),
+}
+
+
+class Command(BaseCommand):
+    help = ("Удаляет пользователей, сообщества или посты вместе со всем, что на них "
+            "ссылается, порциями в отдельных транзакциях; стирает ненужные файлы картинок")
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=sorted(TARGETS))
+        parser.add_argument("names", nargs="+", help="имена пользователей, slug сообществ или id постов")
+        parser.add_argument("--chunk", type=int, default=purge.CHUNK_SIZE)
+        parser.add_argument("--dry-run", action="store_true", help="только посчитать, что будет удалено")
+
+    def handle(self, *args, **options):
+        model, field = TARGETS[options["kind"]]
+        pks = list(model.objects.filter(**{"%s__in" % field: options["names"]}).values_list("pk", flat=True))
+        if len(pks) < len(set(options["names"])):
+            raise CommandError("Найдено %s из %s" % (len(pks), len(set(options["names"]))))
+        job = purge.Purge(model, pks, options["chunk"])
+
+        if options["dry_run"]:
+            for label, count in job.count().items():
+                self.stdout.write("%s: %s" % (label, count))
+            return
+
+        started = time.perf_counter()
+
+        def progress(label, deleted):
+            elapsed = time.perf_counter() - started
+            self.stderr.write("\r%s: %s (%.1f с)" % (label, deleted, elapsed), ending="")
+
+        job.progress = progress
+        deleted = job.run()
+        self.stderr.write("")
+        for label, count in deleted.items():
+            self.stdout.write("%s: удалено %s" % (label, count))
+        self.stdout.write(self.style.SUCCESS("Готово за %.1f с" % (time.perf_counter() - started)))
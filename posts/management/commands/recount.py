@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from posts import counters, trending
+
+
+class Command(BaseCommand):
+    help = ("Пересчитывает денормализованные счётчики постов, комментариев и подписок "
+            "и популярность постов и сообществ")
+
+    def handle(self, *args, **options):
+        fixed = counters.reconcile_users()
+        self.stdout.write("Пользователей исправлено: %s" % fixed)
+        fixed = counters.reconcile_posts()
+        self.stdout.write("Постов исправлено: %s" % fixed)
+        fixed = counters.reconcile_groups()
+        self.stdout.write("Групп исправлено: %s" % fixed)
+        trending.rebuild()
+        self.stdout.write("Популярность постов и сообществ пересчитана")
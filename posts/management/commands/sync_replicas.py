@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from yatube import replicas
+
+
+class Command(BaseCommand):
+    help = ("Копирует основную базу в файлы реплик DATABASE_REPLICAS; "
+            "с --interval повторяет копирование, пока его не остановят")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, help="секунд между копированиями")
+
+    def handle(self, *args, **options):
+        aliases = replicas.aliases()
+        if not aliases:
+            raise CommandError("Реплики не настроены: задайте YATUBE_DB_REPLICAS")
+        while True:
+            for alias in aliases:
+                started = time.monotonic()
+                replicas.sync(alias)
+                self.stdout.write("%s: %s за %.2f с" % (
+                    alias, connections.databases[alias]["NAME"], time.monotonic() - started))
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,43 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:29
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count, Min, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def _count(model, field):
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef('pk')}).order_by()
+        .values(field).annotate(n=Count('pk')).values('n')
+    ), 0)
+
+
+def remove_duplicates(apps, schema_editor):
+    Follow = apps.get_model('posts', 'Follow')
+    UserCounter = apps.get_model('posts', 'UserCounter')
+
+    # из повторных подписок остаётся самая ранняя
+    keep = (Follow.objects.order_by().values('user', 'author')
+            .annotate(first=Min('pk')).values('first'))
+    duplicates = Follow.objects.exclude(pk__in=keep)
+    if duplicates.exists():
+        duplicates.delete()
+        UserCounter.objects.update(
+            followers=_count(Follow, 'author'), following=_count(Follow, 'user'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('posts', '0012_post_image_variants'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='follow',
+            unique_together={('user', 'author')},
+        ),
+    ]
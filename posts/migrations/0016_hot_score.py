@@ -0,0 +1,73 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:42
+
+import math
+from datetime import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+#  формула posts.trending на момент миграции: исторические миграции не
+#  должны зависеть от того, как модуль изменится потом
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+POST_WEIGHT = 1.0
+COMMENT_WEIGHT = 2.0
+BATCH_SIZE = 1000
+
+
+def _logaddexp(a, b):
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+
+def _store(model, scores):
+    items = sorted(scores.items())
+    for start in range(0, len(items), BATCH_SIZE):
+        model.objects.bulk_update([model(pk=pk, hot_score=score) for pk, score in items[start:start + BATCH_SIZE]],
+                                  ['hot_score'])
+
+
+def fill_hot_scores(apps, schema_editor):
+    Post = apps.get_model('posts', 'Post')
+    Group = apps.get_model('posts', 'Group')
+    Comment = apps.get_model('posts', 'Comment')
+    decay = math.log(2) / getattr(settings, 'TRENDING_HALF_LIFE', 24 * 60 * 60)
+
+    def score(weight, when):
+        return math.log(weight) + decay * (when - EPOCH).total_seconds()
+
+    scores, groups = {}, {}
+    for pk, group_id, pub_date in Post.objects.values_list('pk', 'group_id', 'pub_date').iterator():
+        scores[pk] = score(POST_WEIGHT, pub_date)
+        groups[pk] = group_id
+    for post_id, created in Comment.objects.values_list('post_id', 'created').iterator():
+        scores[post_id] = _logaddexp(scores[post_id], score(COMMENT_WEIGHT, created))
+    group_scores = {}
+    for pk, value in scores.items():
+        group_id = groups[pk]
+        if group_id is not None:
+            group_scores[group_id] = (_logaddexp(group_scores[group_id], value)
+                                      if group_id in group_scores else value)
+    _store(Post, scores)
+    _store(Group, group_scores)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0015_recommendations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='hot_score',
+            field=models.FloatField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='hot_score',
+            field=models.FloatField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(fill_hot_scores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+COLUMNS = ("author_id", "group_id")
+
+
+def _index_names(schema_editor):
+    #  имена, которые Django дал индексам db_index у внешних ключей
+    return [(schema_editor._create_index_name("posts_post", [column]), column) for column in COLUMNS]
+
+
+def drop_fk_indexes(apps, schema_editor):
+    # AlterField(db_index=False) в SQLite пересоздал бы всю таблицу постов
+    for name, column in _index_names(schema_editor):
+        schema_editor.execute("DROP INDEX IF EXISTS %s" % schema_editor.quote_name(name))
+
+
+def create_fk_indexes(apps, schema_editor):
+    for name, column in _index_names(schema_editor):
+        schema_editor.execute("CREATE INDEX IF NOT EXISTS %s ON posts_post (%s)" % (
+            schema_editor.quote_name(name), schema_editor.quote_name(column)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0016_hot_score'),
+    ]
+
+    operations = [
+        #  сначала новые индексы, чтобы выборки по автору и группе ни
+        #  минуты не шли без индекса
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['group', '-pub_date', '-id'], name='posts_post_group_feed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['author', '-pub_date', '-id'], name='posts_post_author_feed_idx'),
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(drop_fk_indexes, create_fk_indexes)],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='post',
+                    name='author',
+                    field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE,
+                                            related_name='posts', to=settings.AUTH_USER_MODEL),
+                ),
+                migrations.AlterField(
+                    model_name='post',
+                    name='group',
+                    field=models.ForeignKey(blank=True, db_index=False, null=True,
+                                            on_delete=django.db.models.deletion.CASCADE, related_name='group',
+                                            to='posts.Group'),
+                ),
+            ],
+        ),
+    ]
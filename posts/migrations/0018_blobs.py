@@ -0,0 +1,46 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:52
+
+from django.db import migrations, models
+from django.db.models import Count
+import yatube.storage
+
+
+def fill_blobs(apps, schema_editor):
+    Post = apps.get_model('posts', 'Post')
+    Blob = apps.get_model('posts', 'Blob')
+    images = (Post.objects.exclude(image='').exclude(image__isnull=True)
+              .order_by().values_list('image').annotate(n=Count('pk')))
+    Blob.objects.bulk_create([Blob(name=name, refs=n) for name, n in images.iterator()], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0017_post_feed_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('refs', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        #  AlterField в SQLite пересоздал бы всю таблицу постов; индексу
+        #  хватает CREATE INDEX, а хранилище в базе не видно
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL('CREATE INDEX "posts_post_image_8dac554f" ON "posts_post" ("image")',
+                                  'DROP INDEX "posts_post_image_8dac554f"'),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='post',
+                    name='image',
+                    field=models.ImageField(blank=True, db_index=True, null=True, storage=yatube.storage.ContentAddressedStorage(), upload_to='posts/'),
+                ),
+            ],
+        ),
+        migrations.RunPython(fill_blobs, migrations.RunPython.noop),
+    ]
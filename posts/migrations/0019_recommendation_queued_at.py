@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:20
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0018_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendationqueue',
+            name='queued_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:41
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0019_recommendation_queued_at'),
+    ]
+
+    operations = [
+        #  AddField в SQLite пересоздал бы всю таблицу подписок; столбец без
+        #  значения по умолчанию добавляется мгновенно, а дату новым строкам
+        #  ставит код
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL('ALTER TABLE posts_follow ADD COLUMN created datetime NULL',
+                                  'ALTER TABLE posts_follow DROP COLUMN created'),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='follow',
+                    name='created',
+                    field=models.DateTimeField(default=django.utils.timezone.now, editable=False, null=True),
+                ),
+            ],
+        ),
+    ]
@@ -1,5 +1,8 @@
 from django.db import models
 from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from yatube.storage import post_images
 
 User = get_user_model()
 
@@ -7,6 +10,10 @@ class Group(models.Model):
     title = models.CharField(max_length=200)
     slug = models.SlugField(unique=True)
     description = models.TextField()
+    #  денормализованный счётчик, поддерживается posts.counters
+    post_count = models.PositiveIntegerField(default=0)
+    #  логарифм затухающей популярности, поддерживается posts.trending
+    hot_score = models.FloatField(default=0, db_index=True, editable=False)
 
     def __str__(self):
         return self.title
@@ -14,10 +21,30 @@ class Group(models.Model):
 class Post(models.Model):
     text = models.TextField(max_length=600)
     pub_date = models.DateTimeField("date published", auto_now_add=True, db_index=True)
-    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name="posts")
+    #  одиночные индексы не нужны: их заменяют составные индексы лент в Meta
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name="posts", db_index=False)
     group = models.ForeignKey(Group, on_delete=models.CASCADE, blank=True,
-    null=True, related_name="group") 
-    image = models.ImageField(upload_to='posts/', blank=True, null=True)  #  поле для картинки
+    null=True, related_name="group", db_index=False) 
+    #  поле для картинки; одинаковые картинки хранятся одним файлом, индекс
+    #  нужен для подсчёта ссылок на него (posts.blobs)
+    image = models.ImageField(upload_to='posts/', storage=post_images, blank=True, null=True, db_index=True)
+    #  готовые варианты картинки, их строит posts.thumbnails в фоне
+    image_thumb = models.ImageField(blank=True, null=True, editable=False)
+    image_webp = models.ImageField(blank=True, null=True, editable=False)
+    image_preview = models.ImageField(blank=True, null=True, editable=False)
+    #  денормализованный счётчик, поддерживается posts.counters
+    comment_count = models.PositiveIntegerField(default=0)
+    #  логарифм затухающей популярности, поддерживается posts.trending
+    hot_score = models.FloatField(default=0, db_index=True, editable=False)
+
+    class Meta:
+        #  ленты сообщества и автора читаются страницами по (pub_date, id)
+        #  в обратном порядке: без этих индексов SQLite выбирает все посты
+        #  группы или автора и сортирует их во временном B-дереве
+        indexes = [
+            models.Index(fields=["group", "-pub_date", "-id"], name="posts_post_group_feed_idx"),
+            models.Index(fields=["author", "-pub_date", "-id"], name="posts_post_author_feed_idx"),
+        ]
 
     def __str__ (self):
         #  выводим текст поста
@@ -29,13 +56,77 @@ class Comment(models.Model):
     text = models.TextField(max_length=200)
     created = models.DateTimeField(auto_now=False, auto_now_add=True)
 
+    class Meta:
+        #  комментарии поста читаются страницами по (created, id)
+        indexes = [models.Index(fields=["post", "created"], name="posts_comment_post_idx")]
+
 
 class Follow(models.Model):
     #  пользователь, который подписывается
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="follower")
     #  пользователь, на которого подписываются
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name="following")
-    
+    #  когда подписались — нужно для пересчёта популярности (posts.trending);
+    #  у подписок, сделанных до появления поля, дата неизвестна
+    created = models.DateTimeField(default=timezone.now, null=True, editable=False)
+
+    class Meta:
+        #  индекс (user, author) обслуживает и проверку подписки, и ленту
+        #  /follow/; уникальность не даёт подписаться дважды
+        unique_together = ("user", "author")
+
+
+class UserCounter(models.Model):
+    """денормализованные счётчики пользователя, поддерживаются posts.counters"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="counter")
+    posts = models.PositiveIntegerField(default=0)
+    #  сколько пользователей подписано на него
+    followers = models.PositiveIntegerField(default=0)
+    #  на скольких авторов подписан он сам
+    following = models.PositiveIntegerField(default=0)
+
+
+class Blob(models.Model):
+    """сколько постов ссылается на файл картинки, поддерживается posts.blobs"""
+    name = models.CharField(max_length=100, primary_key=True)
+    refs = models.PositiveIntegerField(default=0)
+
+
+class Timeline(models.Model):
+    """материализованная лента подписок: по записи на пару (подписчик, пост)"""
+    #  владелец ленты
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="timeline")
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name="timeline")
+    #  автор и дата поста продублированы, чтобы лента читалась одним
+    #  диапазоном по индексу, а отписка удаляла записи без JOIN
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    pub_date = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("user", "post")
+        indexes = [
+            models.Index(fields=["user", "-pub_date", "-post"], name="posts_timeline_feed_idx"),
+            models.Index(fields=["user", "author"], name="posts_timeline_author_idx"),
+        ]
+
+
+class Recommendation(models.Model):
+    """кого почитать: лучшие кандидаты для пользователя, их пересчитывает
+    manage.py build_recommendations"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="recommendations")
+    candidate = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    score = models.FloatField()
+    #  сколько авторов пользователя уже подписаны на кандидата
+    mutual = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("user", "candidate")
+        indexes = [models.Index(fields=["user", "-score"], name="posts_recommendation_idx")]
 
-    
 
+class RecommendationQueue(models.Model):
+    """пользователи, чьи подписки изменились после расчёта рекомендаций"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="+")
+    #  когда подписки менялись последний раз: расчёт снимает с очереди
+    #  только строки, которые были в ней до его начала
+    queued_at = models.DateTimeField(default=timezone.now)
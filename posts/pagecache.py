@@ -0,0 +1,164 @@
+"""Кэш целых страниц для анонимных читателей и условные запросы.
+
+Страница помечается областями данных (posts.cache), из которых она
+собрана: их называет функция, переданная в conditional, до выполнения
+view. Вместе со страницей сохраняются поколения этих областей на момент
+чтения данных. Отдавать сохранённую страницу можно, пока ни одно
+поколение не сдвинулось: сигналы постов, комментариев и подписок
+увеличивают их, и страница "вычищается" в момент изменения, без перебора
+ключей кэша. Пока новую версию считает один запрос, остальные получают
+прежнюю (posts.cache.get_or_compute).
+
+Те же области уходят в заголовке Surrogate-Key, а Cache-Control разрешает
+прокси перед сайтом держать анонимные страницы PAGE_CACHE_MAX_AGE секунд.
+
+Поколения служат и валидатором для условных запросов (conditional): ETag
+собран из них, Last-Modified — время последнего изменения областей. Если
+страница не менялась, клиент получает 304 без выполнения view. Валидаторы
+получают только ответы 200.
+"""
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
+from django.views.decorators.http import condition
+
+from posts import cache
+
+TIMEOUT = getattr(settings, "PAGE_CACHE_TIMEOUT", 10 * 60)
+MAX_AGE = getattr(settings, "PAGE_CACHE_MAX_AGE", 30)
+
+
+def _page_key(request):
+    url = request.build_absolute_uri()
+    return "page:%s" % hashlib.md5(url.encode()).hexdigest()
+
+
+def tag(request, *scopes):
+    """отмечает области, из которых собрана страница; вызывать до того,
+    как view прочитает данные, чтобы не сохранить их под новым поколением.
+    Повторные вызовы добавляют области"""
+    request._page_scopes = getattr(request, "_page_scopes", []) + list(scopes)
+    request._page_versions = getattr(request, "_page_versions", []) + cache.generations(*scopes)
+
+
+def _etag(request, versions):
+    #  страницы читателей различаются, поэтому пользователь входит в ETag
+    value = "%s:%s" % (request.user.pk, ":".join(map(str, versions)))
+    return hashlib.md5(value.encode()).hexdigest()
+
+
+def _cacheable(request):
+    return request.method in ("GET", "HEAD") and not request.user.is_authenticated
+
+
+def _cache_headers(request, response):
+    if not request.user.is_authenticated:
+        patch_cache_control(response, public=True, max_age=MAX_AGE)
+        scopes = getattr(request, "_page_scopes", None)
+        if scopes:
+            response["Surrogate-Key"] = " ".join(scopes)
+    else:
+        patch_cache_control(response, private=True)
+    patch_vary_headers(response, ("Cookie",))
+    return response
+
+
+def _stored(request, response, status):
+    response["X-Cache"] = status
+    _cache_headers(request, response)
+    if status == "STALE":
+        #  прежнюю версию уже пересчитывают — прокси не должен её хранить
+        patch_cache_control(response, max_age=0)
+    return response
+
+
+def anonymous_cache(view):
+    """отдаёт анонимным читателям сохранённую страницу, пока данные не
+    изменились; области страницы отмечает conditional. Пересчитывает
+    страницу один запрос, остальные в это время получают прежнюю версию"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        scopes = getattr(request, "_page_scopes", None)
+        if not _cacheable(request) or not scopes:
+            return _cache_headers(request, view(request, *args, **kwargs))
+
+        rendered = []
+
+        def render():
+            response = view(request, *args, **kwargs)
+            rendered.append(response)
+            if response.status_code == 200 and not response.streaming and not response.cookies:
+                return request._page_versions, response.content, response["Content-Type"], time.time()
+            return None
+
+        page = cache.get_or_compute(_page_key(request), scopes, render, TIMEOUT,
+                                    versions=request._page_versions)
+        if rendered:
+            response = rendered[0]
+            return _stored(request, response, "MISS") if page is not None else _cache_headers(request, response)
+
+        versions, content, content_type, _ = page
+        response = HttpResponse(content, content_type=content_type)
+        if versions != request._page_versions:
+            #  валидатор должен описывать отданную, прежнюю версию; даты её
+            #  последнего изменения нет, поэтому без Last-Modified
+            response["ETag"] = quote_etag(_etag(request, versions))
+            return _stored(request, response, "STALE")
+        return _stored(request, response, "HIT")
+    return wrapper
+
+
+def conditional(scopes):
+    """отвечает 304, если страница не менялась с прошлого запроса клиента.
+    scopes(request, *args, **kwargs) возвращает области страницы (или None,
+    если её объекта нет) и должна обходиться одним запросом по индексу:
+    только он и выполняется на повторный запрос без изменений"""
+    def prepare(request, args, kwargs):
+        #  condition спрашивает и ETag, и дату — области ищутся один раз
+        if not hasattr(request, "_page_found"):
+            found = scopes(request, *args, **kwargs)
+            request._page_found = found is not None
+            if found is not None:
+                if request.user.is_authenticated:
+                    #  кнопки подписки и рекомендации зависят от подписок читателя
+                    found.append("follow:%s" % request.user.id)
+                tag(request, *found)
+        return request._page_found
+
+    def etag(request, *args, **kwargs):
+        if prepare(request, args, kwargs):
+            return _etag(request, request._page_versions)
+
+    def last_modified(request, *args, **kwargs):
+        if prepare(request, args, kwargs):
+            changed = cache.changed_at(*request._page_scopes)
+            #  у Last-Modified точность в секунду: пока идёт секунда
+            #  изменения, в неё может попасть следующее, и дата его не
+            #  покажет — до её конца клиенту остаётся только ETag
+            if changed is not None and int(changed.timestamp()) < int(time.time()):
+                return changed
+
+    def decorator(view):
+        validated = condition(etag_func=etag, last_modified_func=last_modified)(view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = validated(request, *args, **kwargs)
+            if response.status_code == 304:
+                _cache_headers(request, response)
+            elif response.status_code != 200:
+                #  с валидатором от 404 клиент получал бы 304 на страницу,
+                #  которой нет
+                del response["ETag"]
+                del response["Last-Modified"]
+            elif response.get("X-Cache") == "STALE":
+                #  condition проставил дату текущей версии, а отдана прежняя
+                del response["Last-Modified"]
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,190 @@
+"""Курсорная (keyset) пагинация лент.
+
+В отличие от django.core.paginator.Paginator не делает COUNT(*) и OFFSET:
+страница выбирается условием по ключу сортировки (по умолчанию
+(pub_date, id)) от курсора, поэтому сотая страница стоит столько же,
+сколько первая.
+
+Курсор подписан: страницы по курсорам, выданным сайтом, можно кэшировать,
+а курсоров с придуманными значениями клиент наберёт сколько угодно —
+по ним страница строится, но в кэш не попадает (CursorPage.cursor).
+"""
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+SIGNATURE_LENGTH = 16
+
+
+def _signature(data):
+    return salted_hmac("posts.paginator.cursor", data).hexdigest()[:SIGNATURE_LENGTH]
+
+
+def encode_cursor(values):
+    data = base64.urlsafe_b64encode(json.dumps([str(value) for value in values]).encode()).decode().rstrip("=")
+    return "%s.%s" % (data, _signature(data))
+
+
+def issued(cursor):
+    """выдан ли курсор сайтом: подпись сходится"""
+    data, _, signature = cursor.partition(".")
+    return bool(signature) and constant_time_compare(signature, _signature(data))
+
+
+def decode_cursor(cursor):
+    """список строковых значений курсора или None для испорченного курсора"""
+    #  курсоры без подписи (ссылки, выданные до неё) тоже читаются
+    cursor = cursor.partition(".")[0]
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(data.decode())
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list):
+        return None
+    return values
+
+
+def keyset_filter(ordering, values):
+    """условие "строго после values" для сортировки ordering.
+
+    Первое поле сравнивается нестрого, чтобы условие раскрывалось в поиск
+    по диапазону индекса, а не в OR по всей таблице.
+    """
+    field, value = ordering[0], values[0]
+    descending = field.startswith("-")
+    name = field.lstrip("-")
+    if len(ordering) == 1:
+        return Q(**{"%s__%s" % (name, "lt" if descending else "gt"): value})
+    rest = keyset_filter(ordering[1:], values[1:])
+    return (Q(**{"%s__%s" % (name, "lte" if descending else "gte"): value})
+            & ~(Q(**{name: value}) & ~rest))
+
+
+def reverse_ordering(ordering):
+    return tuple(field[1:] if field.startswith("-") else "-" + field for field in ordering)
+
+
+class CursorPage:
+    """страница ленты; интерфейс повторяет django.core.paginator.Page там,
+    где это возможно без подсчёта общего числа записей.
+
+    Записи выбираются при первом обращении, поэтому страница, которую
+    шаблон берёт из кэша фрагментов, не делает запросов к базе.
+
+    cursor — ключ страницы для кэша: "" у первой, "after:<курсор>" или
+    "before:<курсор>" у страницы по выданному сайтом курсору и None у
+    страницы по курсору, которого сайт не выдавал.
+    """
+
+    def __init__(self, paginator, after=None, before=None, cursor=""):
+        self.paginator = paginator
+        self._after = after
+        self._before = before
+        self._object_list = None
+        self.cursor = cursor
+
+    def __repr__(self):
+        return "<CursorPage of %s items>" % len(self.object_list)
+
+    def _load(self):
+        paginator = self.paginator
+        if self._before is not None:
+            items = paginator._window(reverse_ordering(paginator.ordering), self._before, paginator.per_page + 1)
+            self._has_previous = len(items) > paginator.per_page
+            self._has_next = True
+            self._object_list = items[:paginator.per_page][::-1]
+        else:
+            items = paginator._window(paginator.ordering, self._after, paginator.per_page + 1)
+            self._has_next = len(items) > paginator.per_page
+            self._has_previous = self._after is not None
+            self._object_list = items[:paginator.per_page]
+
+    @property
+    def object_list(self):
+        if self._object_list is None:
+            self._load()
+        return self._object_list
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        if self._object_list is None:
+            self._load()
+        return self._has_next
+
+    def has_previous(self):
+        if self._object_list is None:
+            self._load()
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def next_cursor(self):
+        """курсор на более старые записи"""
+        if self.has_next() and self.object_list:
+            return self.paginator.cursor_for(self.object_list[-1])
+        return None
+
+    @property
+    def previous_cursor(self):
+        """курсор на более новые записи"""
+        if self.has_previous() and self.object_list:
+            return self.paginator.cursor_for(self.object_list[0])
+        return None
+
+
+class CursorPaginator:
+    def __init__(self, object_list, per_page, ordering=("-pub_date", "-id")):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        self.ordering = tuple(ordering)
+        self.fields = [field.lstrip("-") for field in self.ordering]
+
+    def cursor_for(self, obj):
+        return encode_cursor([getattr(obj, name) for name in self.fields])
+
+    def _values(self, cursor):
+        """значения курсора, приведённые к типам полей модели"""
+        values = decode_cursor(cursor) if cursor else None
+        if values is None or len(values) != len(self.fields):
+            return None
+        opts = self.object_list.model._meta
+        try:
+            return [opts.get_field(name).to_python(value) for name, value in zip(self.fields, values)]
+        except Exception:
+            return None
+
+    def _window(self, ordering, values, limit):
+        """limit записей после values в порядке ordering"""
+        queryset = self.object_list.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(keyset_filter(ordering, values))
+        return list(queryset[:limit])
+
+    def get_page(self, after=None, before=None):
+        """страница старше курсора after или новее курсора before;
+        без курсоров (или с испорченным курсором) — первая страница"""
+        before_values = self._values(before)
+        if before_values is not None:
+            return CursorPage(self, before=before_values, cursor=_page_cursor("before", before))
+        after_values = self._values(after)
+        if after_values is not None:
+            return CursorPage(self, after=after_values, cursor=_page_cursor("after", after))
+        #  испорченный курсор даёт первую страницу — её ключ общий
+        return CursorPage(self)
+
+
+def _page_cursor(direction, cursor):
+    return "%s:%s" % (direction, cursor) if issued(cursor) else None
@@ -0,0 +1,221 @@
+"""Массовое удаление пользователей, сообществ и постов.
+
+Обычное удаление через ORM собирает в память все зависимые объекты
+(Collector), чтобы послать по сигналу на каждый, — у автора с сотнями
+тысяч постов и комментариев это минуты и таймаут админки. Здесь зависимые
+строки удаляются множествами: для каждой связи с on_delete=CASCADE
+выбирается до CHUNK_SIZE первичных ключей по вложенному подзапросу и
+удаляется одним DELETE, каждая порция — в своей транзакции, так что
+блокировка записи держится недолго. Порядок — от листьев к корню, поэтому
+прерванное удаление можно просто запустить снова.
+
+Сигналы не посылаются. Что они поддерживали бы, исправляется после:
+затронутые пользователи, посты и сообщества запоминаются во временной
+таблице до удаления, их счётчики пересчитываются, области кэша
+объявляются изменившимися. Файлы удалённых строк стираются из хранилища,
+если на них больше никто не ссылается; у картинок постов только
+пересчитываются ссылки (posts.blobs), стирает их manage.py collect_media.
+"""
+from django.contrib.auth import get_user_model
+from django.db import connection, models, transaction
+from django.db.models import Q
+
+from posts import blobs, cache, counters, identity
+from posts.models import Post, Group, Comment, Follow
+from yatube.storage import ContentAddressedStorage
+
+User = get_user_model()
+
+#  коммит порции дорог: удалённые строки разбросаны по страницам индексов,
+#  и каждая порция переписывает их в журнал заново
+CHUNK_SIZE = 5000
+AFFECTED_TABLE = "purge_affected"
+#  вид затронутой записи -> модель, пересчёт её счётчиков и области кэша
+#  (posts.cache), которые у неё устаревают
+KINDS = {
+    "user": (User, counters.reconcile_users, ("author:%s", "profile:%s", "follow:%s")),
+    "group": (Group, counters.reconcile_groups, ("group:%s",)),
+    "post": (Post, counters.reconcile_posts, ("post:%s",)),
+}
+
+
+class Purge:
+    """удаляет строки model с первичными ключами pks вместе со всем, что
+    на них ссылается; progress(label, deleted) вызывается после каждой
+    порции"""
+
+    def __init__(self, model, pks, chunk_size=CHUNK_SIZE, progress=None):
+        self.model = model
+        self.pks = list(pks)
+        self.chunk_size = chunk_size
+        self.progress = progress or (lambda label, deleted: None)
+        #  "app_label.Model" -> сколько строк удалено
+        self.deleted = {}
+
+    def queryset(self):
+        return self.model._base_manager.filter(pk__in=self.pks)
+
+    def count(self):
+        """сколько строк каждой модели будет удалено, без удаления"""
+        #  до одной строки можно дойти несколькими путями (лента — и через
+        #  владельца, и через автора), поэтому пути объединяются
+        paths = {}
+        for model, queryset, nullify in self._plan(self.model, self.queryset()):
+            if nullify is None:
+                paths.setdefault(model, Q())
+                paths[model] |= Q(pk__in=queryset.values("pk"))
+        return {model._meta.label: model._base_manager.filter(condition).count()
+                for model, condition in paths.items()}
+
+    def run(self):
+        if not self.pks:
+            return self.deleted
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS %s "
+                           "(kind TEXT NOT NULL, id INTEGER NOT NULL, PRIMARY KEY (kind, id))" % AFFECTED_TABLE)
+            cursor.execute("DELETE FROM temp.%s" % AFFECTED_TABLE)
+        try:
+            self._remember_affected()
+            usernames = (list(self.queryset().values_list("username", flat=True))
+                         if self.model is User else [])
+            for model, queryset, nullify in self._plan(self.model, self.queryset()):
+                if nullify is None:
+                    self._delete(model, queryset)
+                else:
+                    self._nullify(queryset, nullify)
+            self._repair(usernames)
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("DROP TABLE IF EXISTS temp.%s" % AFFECTED_TABLE)
+        return self.deleted
+
+    def _plan(self, model, queryset):
+        """(модель, выборка, поле) в порядке обработки: сначала зависимые.
+        Поле задано для ссылок с on_delete=SET_NULL — их обнуляют, а не
+        удаляют строки"""
+        for relation in model._meta.get_fields(include_hidden=True):
+            if not (relation.auto_created and not relation.concrete
+                    and (relation.one_to_many or relation.one_to_one)):
+                continue
+            related = relation.related_model
+            children = related._base_manager.filter(**{"%s__in" % relation.field.name: queryset.values("pk")})
+            if relation.on_delete is models.CASCADE:
+                yield from self._plan(related, children)
+            elif relation.on_delete is models.SET_NULL:
+                yield related, children, relation.field.name
+            elif relation.on_delete is models.PROTECT and children.exists():
+                raise models.ProtectedError(
+                    "Нельзя удалить: на записи ссылается %s" % related._meta.verbose_name, children)
+        yield model, queryset, None
+
+    def _chunk(self, queryset):
+        return list(queryset.values_list("pk", flat=True)[:self.chunk_size])
+
+    def _nullify(self, queryset, field):
+        while True:
+            with transaction.atomic():
+                pks = self._chunk(queryset)
+                if not pks:
+                    return
+                queryset.model._base_manager.filter(pk__in=pks).update(**{field: None})
+
+    def _delete(self, model, queryset):
+        label = model._meta.label
+        file_fields = [field for field in model._meta.concrete_fields if isinstance(field, models.FileField)]
+        while True:
+            files = {}
+            with transaction.atomic():
+                pks = self._chunk(queryset)
+                if not pks:
+                    return
+                if file_fields:
+                    rows = model._base_manager.filter(pk__in=pks).values_list(*(f.name for f in file_fields))
+                    for row in rows:
+                        for field, name in zip(file_fields, row):
+                            if name:
+                                files.setdefault(field, set()).add(name)
+                self._raw_delete(model, pks)
+                #  файлы в хранилище по содержимому стирает collect_media,
+                #  здесь только пересчитываются ссылки на них
+                blobs.reconcile(name for field, names in files.items()
+                                if isinstance(field.storage, ContentAddressedStorage) for name in names)
+            #  файлы стираются только после коммита порции
+            self._delete_files(model, files)
+            self.deleted[label] = self.deleted.get(label, 0) + len(pks)
+            self.progress(label, self.deleted[label])
+
+    def _raw_delete(self, model, pks):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+                connection.ops.quote_name(model._meta.db_table), connection.ops.quote_name(model._meta.pk.column),
+                ", ".join(["%s"] * len(pks))), pks)
+
+    def _delete_files(self, model, files):
+        files = {field: names for field, names in files.items()
+                 if not isinstance(field.storage, ContentAddressedStorage)}
+        if not files:
+            return
+        #  одинаковый файл могут делить несколько строк (например, после
+        #  повторной загрузки выгрузки)
+        names = set().union(*files.values())
+        condition = Q()
+        for field in files:
+            condition |= Q(**{"%s__in" % field.name: names})
+        used = set()
+        for row in model._base_manager.filter(condition).values_list(*(field.name for field in files)):
+            used.update(row)
+        for field, field_names in files.items():
+            for name in field_names - used:
+                field.storage.delete(name)
+
+    def _affected(self, kind, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT OR IGNORE INTO temp.%s (kind, id) SELECT %%s, * FROM (%s)"
+                           % (AFFECTED_TABLE, sql), [kind, *params])
+
+    def _remember_affected(self):
+        """кого удаление заденет, не удаляя: их счётчики и кэш поправим после"""
+        kind = next((kind for kind, (model, *_) in KINDS.items() if model is self.model), None)
+        if kind is None:
+            return
+        self._affected(kind, self.queryset().values_list("pk"))
+        if self.model is User:
+            users = self.queryset().values("pk")
+            posts = Post.objects.filter(author__in=users)
+            self._affected("user", Follow.objects.filter(user__in=users).values_list("author_id"))
+            self._affected("user", Follow.objects.filter(author__in=users).values_list("user_id"))
+            self._affected("post", Comment.objects.filter(author__in=users).values_list("post_id"))
+        elif self.model is Group:
+            posts = Post.objects.filter(group__in=self.queryset().values("pk"))
+        else:
+            posts = self.queryset()
+        self._affected("user", posts.values_list("author_id"))
+        self._affected("group", posts.exclude(group=None).values_list("group_id"))
+        if self.model is not Post:
+            self._affected("post", posts.values_list("id"))
+
+    def _affected_ids(self, kind):
+        """ключи затронутых записей вида kind пачками"""
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id FROM temp.%s WHERE kind = %%s" % AFFECTED_TABLE, [kind])
+            while True:
+                rows = cursor.fetchmany(counters.BATCH_SIZE)
+                if not rows:
+                    return
+                yield [pk for pk, in rows]
+
+    def _repair(self, usernames):
+        for kind, (model, reconcile, scopes) in KINDS.items():
+            for pks in self._affected_ids(kind):
+                reconcile(model.objects.filter(pk__in=pks))
+                cache.bump(*(scope % pk for pk in pks for scope in scopes))
+        identity.forget(*usernames)
+        #  граф подписок соберётся из базы заново
+        cache.bump("posts", "graph")
+
+
+def purge(model, pks, chunk_size=CHUNK_SIZE, progress=None):
+    """удаляет строки model с ключами pks и всё, что на них ссылается;
+    возвращает число удалённых строк по моделям"""
+    return Purge(model, pks, chunk_size, progress).run()
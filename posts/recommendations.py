@@ -0,0 +1,177 @@
+"""Рекомендации "кого почитать".
+
+Кандидаты для пользователя u считаются по графу подписок (posts.graph):
+
+* друзья друзей — авторы, на которых подписаны авторы u; вклад автора
+  тем меньше, чем на большее число людей он подписан сам;
+* схожесть по подписчикам — авторы, которых читают те же люди, что и
+  авторов u (косинусная мера по общим подписчикам).
+
+Это строки произведений разреженных матриц смежности (A·A и Aᵀ·A),
+посчитанные обходом CSR; похожие авторы (строки Aᵀ·A) считаются один раз
+за прогон. Каждый обход ограничен выборкой, взятой с равным шагом по
+строке CSR: у пользователя — FOLLOWEES_SAMPLE подписок, у автора — SAMPLE
+подписок и SAMPLE подписчиков. Расчёт для пользователя проходит не
+больше FOLLOWEES_SAMPLE · (SAMPLE + SIMILAR_N) рёбер, а похожие авторы
+одного автора — не больше SAMPLE² рёбер, сколько бы подписчиков ни было
+у звезды и на сколько бы авторов ни был подписан пользователь.
+
+Считает команда manage.py build_recommendations: целиком или только для
+пользователей из очереди RecommendationQueue, куда попадают изменившие
+подписки. Страницы читают готовые строки Recommendation одним запросом.
+"""
+import heapq
+import math
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.utils import timezone
+
+from posts import cache, graph
+from posts.models import Recommendation, RecommendationQueue, UserCounter
+
+User = get_user_model()
+
+#  сколько кандидатов хранить на пользователя
+TOP_N = 20
+#  сколько подписчиков и подписок брать у одного автора
+SAMPLE = 100
+#  сколько подписок пользователя обходить при расчёте его кандидатов
+FOLLOWEES_SAMPLE = 200
+#  сколько похожих авторов помнить для каждого автора
+SIMILAR_N = 50
+FOF_WEIGHT = 1.0
+COFOLLOW_WEIGHT = 2.0
+#  при изменении подписок пользователя пересчитываются и его подписчики:
+#  у них поменялись друзья друзей
+FOLLOWERS_REFRESH = 1000
+BATCH_SIZE = 200
+
+QUEUE = RecommendationQueue._meta.db_table
+#  повторная постановка в очередь сдвигает отметку: изменение, случившееся
+#  во время расчёта, дождётся следующего запуска
+ENQUEUE_SQL = ("INSERT INTO %s (user_id, queued_at) VALUES (%%s, %%s) "
+               "ON CONFLICT (user_id) DO UPDATE SET queued_at = excluded.queued_at" % QUEUE)
+
+
+class Scorer:
+    """считает кандидатов по графу; похожие авторы запоминаются, поэтому
+    за один прогон каждый автор обходится один раз"""
+
+    def __init__(self, follow_graph):
+        self.graph = follow_graph
+        self._similar = {}
+
+    def similar(self, author_id):
+        """авторы с общими подписчиками: список (id, косинусная мера)"""
+        result = self._similar.get(author_id)
+        if result is None:
+            follow_graph = self.graph
+            overlap = defaultdict(int)
+            for reader in follow_graph.follower_ids(author_id, SAMPLE):
+                for candidate in follow_graph.followees(reader, SAMPLE):
+                    overlap[candidate] += 1
+            overlap.pop(author_id, None)
+            norm = max(follow_graph.followers_count(author_id), 1)
+            result = heapq.nlargest(SIMILAR_N, (
+                (candidate, common / math.sqrt(norm * max(follow_graph.followers_count(candidate), 1)))
+                for candidate, common in overlap.items()
+            ), key=lambda item: item[1])
+            self._similar[author_id] = result
+        return result
+
+    def score(self, user_id, limit=TOP_N):
+        """лучшие кандидаты: список (candidate_id, score, mutual)"""
+        follow_graph = self.graph
+        followees = follow_graph.followees(user_id, FOLLOWEES_SAMPLE)
+        if not followees:
+            return []
+        scores = defaultdict(float)
+        mutual = defaultdict(int)
+        for author_id in followees:
+            authors = follow_graph.followees(author_id, SAMPLE)
+            #  кто подписан на всех подряд, рекомендует слабее
+            weight = FOF_WEIGHT / math.log(2 + len(authors))
+            for candidate in authors:
+                scores[candidate] += weight
+                mutual[candidate] += 1
+            for candidate, cosine in self.similar(author_id):
+                scores[candidate] += COFOLLOW_WEIGHT * cosine / len(followees)
+        #  подписки пользователя могли не попасть в выборку, поэтому
+        #  исключаются проверкой по графу, а не по ней
+        scores.pop(user_id, None)
+        scores = ((candidate, value) for candidate, value in scores.items()
+                  if not follow_graph.is_following(user_id, candidate))
+        best = heapq.nlargest(limit, scores, key=lambda item: (item[1], -item[0]))
+        return [(candidate, value, mutual.get(candidate, 0)) for candidate, value in best]
+
+
+def _popular(limit):
+    """самые читаемые авторы — для тех, кто ещё ни на кого не подписан"""
+    return list(UserCounter.objects.filter(followers__gt=0).order_by("-followers")
+                .values_list("user_id", "followers")[:limit + 1])
+
+
+def refresh(user_ids, scorer=None, limit=TOP_N):
+    """пересчитывает и сохраняет рекомендации пользователей"""
+    scorer = scorer or Scorer(graph.get())
+    popular = None
+    rows = []
+    for user_id in user_ids:
+        ranked = scorer.score(user_id, limit)
+        if not ranked:
+            if popular is None:
+                popular = _popular(limit)
+            ranked = [(candidate, math.log(1 + followers) / 100, 0)
+                      for candidate, followers in popular if candidate != user_id][:limit]
+        rows.extend(Recommendation(user_id=user_id, candidate_id=candidate, score=value, mutual=common)
+                    for candidate, value, common in ranked)
+    with transaction.atomic():
+        Recommendation.objects.filter(user_id__in=user_ids).delete()
+        Recommendation.objects.bulk_create(rows)
+    #  рекомендации видны на /follow/ и в профилях, которые смотрит пользователь
+    cache.bump(*("follow:%s" % user_id for user_id in user_ids))
+    return len(rows)
+
+
+def enqueue(user_id):
+    """ставит пользователя в очередь на пересчёт"""
+    with connection.cursor() as cursor:
+        cursor.execute(ENQUEUE_SQL, [user_id, connection.ops.adapt_datetimefield_value(timezone.now())])
+
+
+def claim():
+    """пользователи из очереди вместе с их подписчиками и отметка очереди
+    для done(); строки остаются в очереди, пока расчёт не закончится"""
+    queued = list(RecommendationQueue.objects.values_list("user_id", "queued_at"))
+    follow_graph = graph.get()
+    users = set(user_id for user_id, _ in queued)
+    for user_id, _ in queued:
+        users.update(follow_graph.follower_ids(user_id, FOLLOWERS_REFRESH))
+    return sorted(users), queued
+
+
+def done(queued):
+    """снимает с очереди пересчитанных пользователей; попавшие в очередь
+    заново во время расчёта дождутся следующего запуска"""
+    if not queued:
+        return
+    user_ids = [user_id for user_id, _ in queued]
+    claimed_at = max(queued_at for _, queued_at in queued)
+    for start in range(0, len(user_ids), BATCH_SIZE):
+        RecommendationQueue.objects.filter(user_id__in=user_ids[start:start + BATCH_SIZE],
+                                           queued_at__lte=claimed_at).delete()
+
+
+def for_user(user, limit=5, exclude=()):
+    """рекомендации для страницы: кандидаты, на которых пользователь
+    ещё не подписан"""
+    if not user.is_authenticated:
+        return []
+    rows = (Recommendation.objects.filter(user=user).select_related("candidate")
+            .order_by("-score")[:limit + len(exclude) + 5])
+    rows = [row for row in rows if row.candidate_id not in exclude]
+    followed = graph.followed_among(user.id, [row.candidate_id for row in rows])
+    result = [row for row in rows if row.candidate_id not in followed]
+    return result[:limit]
@@ -0,0 +1,152 @@
+"""Полнотекстовый поиск по постам.
+
+На SQLite текст постов индексируется виртуальной таблицей FTS5 с внешним
+содержимым (content='posts_post'). Индекс поддерживают триггеры на
+posts_post, поэтому он не расходится с таблицей даже при bulk_create и
+update(). На других СУБД поиск деградирует до icontains.
+"""
+from django.db import connection
+
+from posts.paginator import encode_cursor, decode_cursor
+
+CREATE_TABLE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS posts_post_fts USING fts5("
+    "text, content='posts_post', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+)
+
+#  при пересоздании posts_post (ALTER в SQLite делается копированием
+#  таблицы) триггеры пропадают, поэтому install() вызывается после каждой
+#  миграции (posts.signals) и создаёт их заново
+CREATE_TRIGGERS = (
+    "CREATE TRIGGER IF NOT EXISTS posts_post_fts_insert AFTER INSERT ON posts_post BEGIN "
+    "INSERT INTO posts_post_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS posts_post_fts_delete AFTER DELETE ON posts_post BEGIN "
+    "INSERT INTO posts_post_fts(posts_post_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS posts_post_fts_update AFTER UPDATE OF text ON posts_post BEGIN "
+    "INSERT INTO posts_post_fts(posts_post_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO posts_post_fts(rowid, text) VALUES (new.id, new.text); END",
+)
+
+
+def available(using=connection):
+    return using.vendor == "sqlite"
+
+
+def install(using=connection, rebuild=False):
+    """создаёт индекс и триггеры; rebuild переиндексирует все посты"""
+    if not available(using):
+        return
+    with using.cursor() as cursor:
+        cursor.execute(CREATE_TABLE)
+        for sql in CREATE_TRIGGERS:
+            cursor.execute(sql)
+        if rebuild:
+            cursor.execute("INSERT INTO posts_post_fts(posts_post_fts) VALUES ('rebuild')")
+
+
+def match_expression(query):
+    """экранирует пользовательский запрос: каждое слово ищется как фраза,
+    все слова должны встретиться в посте"""
+    terms = ['"%s"' % term.replace('"', '""') for term in query.split()]
+    return " ".join(terms)
+
+
+#  подзапрос id подходящих постов для фильтра pk__in (см. PostAdmin)
+MATCH_IDS_SQL = "SELECT rowid FROM posts_post_fts WHERE posts_post_fts MATCH %s"
+
+
+class SearchPage:
+    """страница результатов с тем же интерфейсом, что и CursorPage"""
+
+    def __init__(self, object_list, has_next, has_previous, cursors):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self._cursors = cursors
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        return self._cursors[-1] if self._has_next and self._cursors else None
+
+    @property
+    def previous_cursor(self):
+        return self._cursors[0] if self._has_previous and self._cursors else None
+
+
+def _cursor_values(cursor):
+    values = decode_cursor(cursor) if cursor else None
+    try:
+        return float(values[0]), int(values[1])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def search(queryset, query, group_id=None, author_id=None, per_page=10, after=None, before=None):
+    """страница постов, подходящих под запрос, по убыванию релевантности
+    (bm25); сами посты загружаются из queryset"""
+    expression = match_expression(query)
+    if not expression:
+        return SearchPage([], False, False, [])
+    if not available():
+        posts = queryset.filter(text__icontains=query)
+        if group_id is not None:
+            posts = posts.filter(group_id=group_id)
+        if author_id is not None:
+            posts = posts.filter(author_id=author_id)
+        return SearchPage(list(posts.order_by("-pub_date")[:per_page]), False, False, [])
+
+    before_values = _cursor_values(before)
+    after_values = None if before_values else _cursor_values(after)
+    #  чем меньше bm25, тем релевантнее; id разводит одинаковый rank
+    descending = before_values is not None
+    keyset = before_values or after_values
+
+    inner = ["SELECT p.id AS id, bm25(posts_post_fts) AS rank FROM posts_post_fts "
+             "JOIN posts_post p ON p.id = posts_post_fts.rowid WHERE posts_post_fts MATCH %s"]
+    params = [expression]
+    if group_id is not None:
+        inner.append("AND p.group_id = %s")
+        params.append(group_id)
+    if author_id is not None:
+        inner.append("AND p.author_id = %s")
+        params.append(author_id)
+    sql = ["SELECT id, rank FROM (%s)" % " ".join(inner)]
+    if keyset:
+        op = "<" if descending else ">"
+        sql.append("WHERE rank %s %%s OR (rank = %%s AND id %s %%s)" % (op, op))
+        params += [keyset[0], keyset[0], keyset[1]]
+    direction = "DESC" if descending else "ASC"
+    sql.append("ORDER BY rank %s, id %s LIMIT %%s" % (direction, direction))
+    params.append(per_page + 1)
+
+    with connection.cursor() as cursor:
+        cursor.execute(" ".join(sql), params)
+        rows = cursor.fetchall()
+
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if descending:
+        rows.reverse()
+        has_next, has_previous = True, more
+    else:
+        has_next, has_previous = more, after_values is not None
+
+    posts = queryset.in_bulk([post_id for post_id, rank in rows])
+    object_list = [posts[post_id] for post_id, rank in rows if post_id in posts]
+    cursors = [encode_cursor([rank, post_id]) for post_id, rank in rows]
+    return SearchPage(object_list, has_next, has_previous, cursors)
@@ -0,0 +1,131 @@
+from django.contrib.auth import get_user_model
+from django.db import connections
+from django.db.models.signals import pre_save, post_save, post_delete, post_migrate
+from django.dispatch import receiver
+
+from posts import blobs, cache, counters, follows, identity, search, thumbnails, timeline, trending
+from posts.models import Post, Group, Comment, Follow, RecommendationQueue, UserCounter
+
+User = get_user_model()
+
+
+def _identity_changed(update_fields):
+    return update_fields is None or bool(set(update_fields) & set(identity.FIELDS))
+
+
+@receiver(pre_save, sender=User)
+def user_changing(sender, instance, update_fields=None, **kwargs):
+    #  после смены имени старое не должно находиться через кэш; вход на
+    #  сайт сохраняет только last_login и сюда не доходит
+    instance._old_username = None
+    if instance.pk is not None and _identity_changed(update_fields):
+        instance._old_username = (User.objects.filter(pk=instance.pk)
+                                  .values_list("username", flat=True).first())
+
+
+@receiver(post_save, sender=User)
+def user_created(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        UserCounter.objects.get_or_create(user=instance)
+    if _identity_changed(update_fields):
+        identity.forget(instance.username, getattr(instance, "_old_username", None))
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    identity.forget(instance.username)
+    #  удаление его подписок, идущее раньше, снова ставит его в очередь
+    #  рекомендаций; строка ссылалась бы на удалённого пользователя
+    RecommendationQueue.objects.filter(user_id=instance.pk).delete()
+
+
+@receiver(post_save, sender=Group)
+def group_saved(sender, instance, created, **kwargs):
+    if not created:
+        cache.bump("group:%s" % instance.pk)
+
+
+@receiver(pre_save, sender=Post)
+def post_changing(sender, instance, **kwargs):
+    #  запоминаем прежние группу и картинку, чтобы перенести счётчик
+    #  и пересобрать миниатюры при редактировании
+    old_group_id, old_image = None, None
+    if instance.pk is None:
+        #  новый пост сразу получает оценку популярности
+        instance.hot_score = trending.event_score(trending.POST_WEIGHT)
+    else:
+        old_group_id, old_image = (Post.objects.filter(pk=instance.pk)
+                                   .values_list("group_id", "image").first() or (None, None))
+    instance._old_group_id = old_group_id
+    instance._old_image = old_image
+    instance._image_changed = (instance.image.name or None) != (old_image or None)
+    if instance._image_changed:
+        instance.image_thumb = instance.image_webp = instance.image_preview = None
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, **kwargs):
+    if created:
+        counters.add_to_user(instance.author_id, posts=1)
+        counters.add_to_group(instance.group_id, post_count=1)
+        trending.post_created(instance)
+        timeline.fan_out(instance)
+    elif instance._old_group_id != instance.group_id:
+        counters.add_to_group(instance._old_group_id, post_count=-1)
+        counters.add_to_group(instance.group_id, post_count=1)
+        cache.bump("group:%s" % instance._old_group_id)
+    if instance._image_changed:
+        #  файл картинки могут делить несколько постов
+        blobs.acquire(instance.image.name)
+        blobs.release(instance._old_image)
+        thumbnails.schedule(instance)
+    cache.bump(*cache.post_scopes(instance.author_id, instance.group_id, instance.pk))
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    counters.add_to_user(instance.author_id, posts=-1)
+    counters.add_to_group(instance.group_id, post_count=-1)
+    blobs.release(instance.image.name)
+    cache.bump(*cache.post_scopes(instance.author_id, instance.group_id, instance.pk))
+
+
+@receiver(post_save, sender=Comment)
+def comment_created(sender, instance, created, **kwargs):
+    if created:
+        counters.add_to_post(instance.post_id, comment_count=1)
+    post = _bump_comment_scopes(instance)
+    if created and post is not None:
+        trending.comment_created(instance, post[1])
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    counters.add_to_post(instance.post_id, comment_count=-1)
+    _bump_comment_scopes(instance)
+
+
+def _bump_comment_scopes(comment):
+    #  число комментариев видно в ленте, поэтому устаревают ленты поста
+    post = (Post.objects.filter(pk=comment.post_id)
+            .values_list("author_id", "group_id").first())
+    if post is not None:
+        cache.bump(*cache.post_scopes(*post, comment.post_id))
+    return post
+
+
+@receiver(post_save, sender=Follow)
+def follow_created(sender, instance, created, **kwargs):
+    if created:
+        follows.followed(instance.user_id, [instance.author_id])
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    follows.unfollowed(instance.user_id, [instance.author_id])
+
+
+@receiver(post_migrate)
+def install_search_index(sender, using, **kwargs):
+    if sender.name == "posts":
+        search.install(connections[using])
@@ -0,0 +1,32 @@
+from django import template
+
+from posts.cache import get_or_compute
+
+register = template.Library()
+
+
+class CachedNode(template.Node):
+    def __init__(self, nodelist, params):
+        self.nodelist = nodelist
+        self.params = params
+
+    def render(self, context):
+        params = self.params.resolve(context)
+        if params is None:
+            return self.nodelist.render(context)
+        return get_or_compute(params["key"], params["scopes"], lambda: self.nodelist.render(context),
+                              params["timeout"])
+
+
+@register.tag
+def cached(parser, token):
+    """{% cached feed_cache %}...{% endcached %} — как {% cache %}, но
+    фрагмент пересчитывает один запрос, а остальные в это время получают
+    прежнюю версию (posts.cache.get_or_compute); параметры задаёт
+    posts.cache.feed_cache"""
+    bits = token.split_contents()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError("'%s' принимает один аргумент" % bits[0])
+    nodelist = parser.parse(("endcached",))
+    parser.delete_first_token()
+    return CachedNode(nodelist, parser.compile_filter(bits[1]))
@@ -1,8 +1,39 @@
-from django.test import TestCase, Client, override_settings
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.core import mail
 from django.contrib.auth import get_user_model
-from posts.models import Post, Group, Follow
+from django.contrib.auth.models import Permission
+from posts.models import (Post, Group, Comment, Follow, Timeline, UserCounter, Blob,
+                          Recommendation, RecommendationQueue)
+from posts import (blobs, bulk, cache as cache_scopes, follows, graph, identity, pagecache, paginator, purge,
+                   recommendations, thumbnails, timeline, trending, writes)
+from PIL import Image
+from posts.paginator import CursorPaginator
+from posts.urls import app_name, urlpatterns
+from yatube import metrics, replicas
+from yatube.db.base import DatabaseWrapper
+from yatube.sharedcache import SQLiteCache
+from yatube.storage import post_images
 from django.urls import reverse
+from django.utils import timezone
+from datetime import timedelta
 
 User = get_user_model()
 
@@ -23,6 +54,18 @@ class UnloginTest(TestCase):
         self.assertRedirects(response, '/auth/login/?next=/new/')
     
 
+@override_settings(CACHES=TEST_CACHE)
+class ServiceUrlTest(TestCase):
+    """служебные страницы не занимают адреса профилей"""
+    def test_profiles_not_shadowed(self):
+        for name in ("search", "trending", "metrics", "_"):
+            User.objects.create_user(username=name, password="12345")
+            response = self.client.get(reverse("posts:profile", kwargs={"username": name}))
+            self.assertEqual(response.resolver_match.view_name, "posts:profile")
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse("posts:search")).resolver_match.view_name, "posts:search")
+
+
 class PostNewTest(TestCase):
     def setUp(self):
         self.client = Client() 
@@ -160,4 +203,1811 @@ class CommentsTest(TestCase):
         response = self.client.post(reverse('posts:add_comment', args=('sarah',1)), follow=True)
         #  редирект на страницу входа, а затем на страницу создания комментария
         #  так работает декоратор @login_required
-        self.assertRedirects(response, '/auth/login/?next=/sarah/1/comment/')
\ No newline at end of file
+        self.assertRedirects(response, '/auth/login/?next=/sarah/1/comment/')
+
+
+
+@override_settings(CACHES=TEST_CACHE)
+class CommentPaginationTest(TestCase):
+    """проверка постраничного вывода комментариев"""
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username="sarah", password="12345")
+        self.post = Post.objects.create(text="My post!", author=self.user)
+        readers = [User.objects.create_user(username="reader%s" % n, password="12345") for n in range(5)]
+        for n in range(25):
+            Comment.objects.create(post=self.post, author=readers[n % 5], text="comment %02d" % n)
+
+    def test_first_page_bounded(self):
+        response = self.client.get("/sarah/%s/" % self.post.id)
+        self.assertContains(response, "comment 00")
+        self.assertContains(response, "comment 19")
+        self.assertNotContains(response, "comment 20")
+        self.assertContains(response, "Показать ещё")
+
+    def test_load_more(self):
+        response = self.client.get("/sarah/%s/" % self.post.id)
+        cursor = response.context["comments"].next_cursor
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/sarah/%s/comments/" % self.post.id, {"after": cursor})
+        #  комментарии вместе с авторами — одним запросом
+        self.assertEqual(len([query for query in queries if "posts_comment" in query["sql"]]), 1)
+        self.assertContains(response, "comment 20")
+        self.assertContains(response, "comment 24")
+        self.assertNotContains(response, "comment 19")
+        self.assertNotContains(response, "Показать ещё")
+        self.assertNotContains(response, "<html")
+
+    def test_load_more_not_found(self):
+        User.objects.create_user(username="john", password="12345")
+        self.assertEqual(self.client.get("/sarah/%s/comments/" % (self.post.id + 1)).status_code, 404)
+        self.assertEqual(self.client.get("/john/%s/comments/" % self.post.id).status_code, 404)
+        self.assertEqual(self.client.get("/nobody/%s/comments/" % self.post.id).status_code, 404)
+
+class TimelineTest(TestCase):
+    """проверка материализованной ленты подписок"""
+    def setUp(self):
+        self.client = Client()
+        self.reader = User.objects.create_user(
+                username="sarah", email="connor.s@skynet.com", password="12345")
+        self.author = User.objects.create_user(
+                username="arny", email="arny.s@skynet.com", password="12345")
+        self.client.login(username="sarah", password="12345")
+        #  отметки подтягивания остаются в кэше от других тестов
+        cache.clear()
+
+    def test_fan_out_on_write(self):
+        Follow.objects.create(user=self.reader, author=self.author)
+        post = Post.objects.create(text="Fresh post", author=self.author)
+
+        self.assertTrue(Timeline.objects.filter(user=self.reader, post=post).exists())
+        self.assertContains(self.client.get("/follow/"), "Fresh post")
+
+    def test_backfill_and_prune(self):
+        """при подписке старые посты автора попадают в ленту, при отписке — исчезают"""
+        Post.objects.create(text="Old post", author=self.author)
+
+        self.client.get("/arny/follow/")
+        self.assertContains(self.client.get("/follow/"), "Old post")
+
+        self.client.get("/arny/unfollow/")
+        self.assertFalse(Timeline.objects.filter(user=self.reader).exists())
+        self.assertNotContains(self.client.get("/follow/"), "Old post")
+
+    def test_celebrity_fan_out_on_read(self):
+        """посты звёзд не раскладываются при записи, а подтягиваются при чтении"""
+        Follow.objects.create(user=self.reader, author=self.author)
+        with mock.patch.object(timeline, "CELEBRITY_FOLLOWERS", 0):
+            post = Post.objects.create(text="Star post", author=self.author)
+            self.assertFalse(Timeline.objects.filter(post=post).exists())
+
+            self.assertContains(self.client.get("/follow/"), "Star post")
+            self.assertTrue(Timeline.objects.filter(user=self.reader, post=post).exists())
+
+            #  до конца интервала лента читается без подтягивания
+            Post.objects.create(text="Next star post", author=self.author)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertNotContains(self.client.get("/follow/"), "Next star post")
+            self.assertFalse([q for q in queries.captured_queries if "posts_follow" in q["sql"]])
+
+            cache.delete("timeline:pulling:%s" % self.reader.id)
+            self.assertContains(self.client.get("/follow/"), "Next star post")
+
+
+class CursorPaginatorTest(TestCase):
+    """проверка курсорной пагинации ленты"""
+    def setUp(self):
+        self.user = User.objects.create_user(
+                username="sarah", email="connor.s@skynet.com", password="12345")
+        Post.objects.bulk_create([Post(text="post %s" % i, author=self.user) for i in range(25)])
+        #  у части постов одинаковая дата — порядок держится на id
+        self.posts = list(Post.objects.order_by("-pub_date", "-id"))
+
+    def test_walk_forward_and_back(self):
+        paginator = CursorPaginator(Post.objects.all(), 10)
+        page = paginator.get_page()
+        self.assertFalse(page.has_previous())
+        seen = list(page)
+        while page.has_next():
+            page = paginator.get_page(after=page.next_cursor)
+            seen.extend(page)
+        self.assertEqual(seen, self.posts)
+
+        back = paginator.get_page(before=page.previous_cursor)
+        self.assertEqual(list(back), self.posts[10:20])
+        self.assertTrue(back.has_next())
+
+    def test_broken_cursor(self):
+        page = CursorPaginator(Post.objects.all(), 10).get_page(after="garbage")
+        self.assertEqual(list(page), self.posts[:10])
+
+    @override_settings(CACHES=TEST_CACHE)
+    def test_index_pages(self):
+        response = self.client.get("/")
+        page = response.context["page"]
+        response = self.client.get("/", {"after": page.next_cursor})
+        self.assertEqual(list(response.context["page"]), self.posts[10:20])
+
+
+@override_settings(CACHES=TEST_CACHE)
+class FeedQueryCountTest(TestCase):
+    """число запросов ленты не должно зависеть от числа постов на странице"""
+    def setUp(self):
+        self.client = Client()
+        self.reader = User.objects.create_user(
+                username="sarah", email="connor.s@skynet.com", password="12345")
+        self.group = Group.objects.create(title='super', slug='super', description='description')
+        Follow.objects.create(user=self.reader, author=self.reader)
+        self.client.login(username="sarah", password="12345")
+
+    def add_posts(self, count):
+        for i in range(count):
+            author = User.objects.create_user(username="author%s" % User.objects.count())
+            Follow.objects.create(user=self.reader, author=author)
+            post = Post.objects.create(text="post", author=author, group=self.group)
+            Comment.objects.create(post=post, author=author, text="comment")
+            Post.objects.create(text="own post", author=self.reader, group=self.group)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_constant_queries(self):
+        urls = ("/", "/group/super/", "/sarah/", "/follow/")
+        self.add_posts(1)
+        few = {url: self.count_queries(url) for url in urls}
+        self.add_posts(4)
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertEqual(self.count_queries(url), few[url])
+
+    def test_post_view(self):
+        post = Post.objects.create(text="post", author=self.reader, group=self.group)
+        url = "/sarah/%s/" % post.id
+        for i in range(5):
+            author = User.objects.create_user(username="commenter%s" % i)
+            Comment.objects.create(post=post, author=author, text="comment %s" % i)
+        #  проверка поста для 304, сессия и пользователь запроса, пост с
+        #  автором и сообществом, автор по имени (дважды: в тестах кэш
+        #  пустой), счётчики и комментарии вместе с их авторами — сколько
+        #  бы комментариев ни было
+        with self.assertNumQueries(8):
+            response = self.client.get(url)
+        self.assertContains(response, "comment 4")
+
+    def test_comment_count_on_list(self):
+        self.add_posts(1)
+        self.assertContains(self.client.get("/"), "1 комментариев")
+
+
+@override_settings(CACHES=TEST_CACHE)
+class CounterTest(TestCase):
+    """проверка денормализованных счётчиков"""
+    def setUp(self):
+        self.client = Client()
+        self.user1 = User.objects.create_user(
+                username="sarah", email="connor.s@skynet.com", password="12345")
+        self.user2 = User.objects.create_user(
+                username="arny", email="arny.s@skynet.com", password="12345")
+        self.group = Group.objects.create(title='super', slug='super', description='description')
+        self.post = Post.objects.create(text="My post!", author=self.user1, group=self.group)
+        self.comment = Comment.objects.create(post=self.post, author=self.user2, text="comment")
+        self.follow = Follow.objects.create(user=self.user2, author=self.user1)
+
+    def counter(self, user):
+        return UserCounter.objects.get(user=user)
+
+    def test_kept_in_sync(self):
+        self.post.refresh_from_db()
+        self.group.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 1)
+        self.assertEqual(self.group.post_count, 1)
+        self.assertEqual(self.counter(self.user1).posts, 1)
+        self.assertEqual(self.counter(self.user1).followers, 1)
+        self.assertEqual(self.counter(self.user2).following, 1)
+
+        self.comment.delete()
+        self.follow.delete()
+        self.post.delete()
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.post_count, 0)
+        self.assertEqual(self.counter(self.user1).posts, 0)
+        self.assertEqual(self.counter(self.user1).followers, 0)
+        self.assertEqual(self.counter(self.user2).following, 0)
+
+    def test_reconcile(self):
+        UserCounter.objects.filter(user=self.user1).update(posts=42, followers=0)
+        UserCounter.objects.filter(user=self.user2).delete()
+        Post.objects.update(comment_count=7)
+        call_command("recount", stdout=io.StringIO())
+
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 1)
+        self.assertEqual(self.counter(self.user1).posts, 1)
+        self.assertEqual(self.counter(self.user1).followers, 1)
+        self.assertEqual(self.counter(self.user2).following, 1)
+
+    def test_profile_counts(self):
+        response = self.client.get("/sarah/")
+        self.assertContains(response, "Подписчиков: 1")
+        self.assertContains(response, "Записей: 1")
+
+
+class FeedCacheTest(TestCase):
+    """проверка версионированного кэша лент"""
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(
+                username="sarah", email="connor.s@skynet.com", password="12345")
+        self.group = Group.objects.create(title='super', slug='super', description='description')
+        self.post = Post.objects.create(text="First post", author=self.user, group=self.group)
+
+    def test_invalidated_on_change(self):
+        urls = ("/", "/group/super/", "/sarah/")
+        for url in urls:
+            self.assertContains(self.client.get(url), "First post")
+
+        Post.objects.create(text="Second post", author=self.user, group=self.group)
+        for url in urls:
+            self.assertContains(self.client.get(url), "Second post")
+
+        Comment.objects.create(post=self.post, author=self.user, text="comment")
+        for url in urls:
+            self.assertContains(self.client.get(url), "1 комментариев")
+
+    def test_served_from_cache(self):
+        self.client.get("/")
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get("/")
+        self.assertFalse([q for q in queries if "posts_post" in q["sql"]])
+
+    def test_pages_cached_separately(self):
+        Post.objects.bulk_create([Post(text="bulk post", author=self.user) for i in range(12)])
+        page = self.client.get("/").context["page"]
+        response = self.client.get("/", {"after": page.next_cursor})
+        self.assertContains(response, "First post")
+
+    def test_key_from_checked_cursor(self):
+        Post.objects.bulk_create([Post(text="bulk post", author=self.user) for i in range(12)])
+        self.client.force_login(self.user)
+        response = self.client.get("/")
+        first_key = response.context["feed_cache"]["key"]
+        cursor = response.context["page"].next_cursor
+        self.assertIn(cursor, self.client.get("/", {"after": cursor}).context["feed_cache"]["key"])
+        #  испорченный курсор даёт первую страницу под её же ключом
+        self.assertEqual(self.client.get("/", {"after": "garbage"}).context["feed_cache"]["key"], first_key)
+        #  курсор, которого сайт не выдавал, работает, но мимо кэша
+        forged = paginator.encode_cursor([timezone.now(), 10 ** 6]).partition(".")[0]
+        response = self.client.get("/", {"after": forged})
+        self.assertIsNone(response.context["feed_cache"])
+        self.assertEqual(len(response.context["page"]), 10)
+
+
+class PageCacheTest(TestCase):
+    """проверка кэша страниц для анонимных читателей"""
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(
+                username="sarah", email="connor.s@skynet.com", password="12345")
+        self.reader = User.objects.create_user(
+                username="kyle", email="kyle.r@skynet.com", password="12345")
+        self.group = Group.objects.create(title='super', slug='super', description='description')
+        self.post = Post.objects.create(text="First post", author=self.user, group=self.group)
+        self.urls = ("/", "/group/super/", "/sarah/", "/sarah/%s/" % self.post.id)
+
+    def test_anonymous_hit(self):
+        for url in self.urls:
+            self.assertEqual(self.client.get(url)["X-Cache"], "MISS")
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response["X-Cache"], "HIT")
+            self.assertContains(response, "First post")
+            #  остаётся только поиск сообщества или автора для валидатора
+            self.assertLessEqual(len(queries), 1)
+
+    def test_headers(self):
+        response = self.client.get("/sarah/%s/" % self.post.id)
+        self.assertIn("public", response["Cache-Control"])
+        self.assertIn("max-age", response["Cache-Control"])
+        self.assertIn("Cookie", response["Vary"])
+        self.assertEqual(set(response["Surrogate-Key"].split()),
+                         {"post:%s" % self.post.id, "author:%s" % self.user.id, "profile:%s" % self.user.id})
+
+        self.client.force_login(self.reader)
+        response = self.client.get("/sarah/%s/" % self.post.id)
+        self.assertIn("private", response["Cache-Control"])
+        self.assertNotIn("X-Cache", response)
+
+    def test_purged_on_change(self):
+        for url in self.urls:
+            self.client.get(url)
+
+        Comment.objects.create(post=self.post, author=self.reader, text="new comment")
+        for url in self.urls:
+            self.assertEqual(self.client.get(url)["X-Cache"], "MISS")
+        self.assertContains(self.client.get("/sarah/%s/" % self.post.id), "new comment")
+
+        follows.follow(self.reader.id, self.user.id)
+        self.assertEqual(self.client.get("/").get("X-Cache"), "HIT")
+        response = self.client.get("/sarah/")
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertContains(response, "Подписчиков: 1")
+
+    def test_other_pages_kept(self):
+        other = Group.objects.create(title='other', slug='other', description='description')
+        self.client.get("/group/super/")
+        self.client.get("/group/other/")
+        Post.objects.create(text="Second post", author=self.user, group=self.group)
+        self.assertEqual(self.client.get("/group/super/")["X-Cache"], "MISS")
+        self.assertEqual(self.client.get("/group/other/")["X-Cache"], "HIT")
+        other.description = "changed"
+        other.save()
+        self.assertContains(self.client.get("/group/other/"), "changed")
+
+
+class ConditionalGetTest(TestCase):
+    """проверка ответов 304 по ETag и Last-Modified"""
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = User.objects.create_user(
+                username="sarah", email="connor.s@skynet.com", password="12345")
+        self.group = Group.objects.create(title='super', slug='super', description='description')
+        self.post = Post.objects.create(text="First post", author=self.user, group=self.group)
+        self.urls = ("/", "/group/super/", "/sarah/", "/sarah/%s/" % self.post.id)
+
+    def test_not_modified(self):
+        for url in self.urls:
+            etag = self.client.get(url)["ETag"]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertLessEqual(len(queries), 1)
+            self.assertIn("public", response["Cache-Control"])
+
+    def test_modified_after_change(self):
+        etags = {url: self.client.get(url)["ETag"] for url in self.urls}
+        Comment.objects.create(post=self.post, author=self.user, text="comment")
+        for url in self.urls:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response["ETag"], etags[url])
+
+    def test_last_modified(self):
+        #  пока не кончилась секунда изменения, даты нет: следующее
+        #  изменение в ту же секунду её бы не сдвинуло
+        self.assertFalse(self.client.get("/sarah/").has_header("Last-Modified"))
+        with mock.patch("posts.pagecache.time.time", return_value=time.time() + 2):
+            last_modified = self.client.get("/sarah/")["Last-Modified"]
+            response = self.client.get("/sarah/", HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        changed = timezone.now() + timedelta(seconds=5)
+        with mock.patch("posts.cache.time.time", return_value=changed.timestamp()):
+            Post.objects.create(text="Second post", author=self.user)
+        with mock.patch("posts.pagecache.time.time", return_value=changed.timestamp() + 2):
+            response = self.client.get("/sarah/", HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+
+    def test_per_user(self):
+        etag = self.client.get("/").get("ETag")
+        self.client.force_login(self.user)
+        response = self.client.get("/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("private", response["Cache-Control"])
+        response = self.client.get("/", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_missing_page(self):
+        self.assertEqual(self.client.get("/group/nothing/").status_code, 404)
+        self.assertEqual(self.client.get("/nobody/1/").status_code, 404)
+        #  автор есть, поста нет: без валидатора не будет и 304
+        response = self.client.get("/sarah/%s/" % (self.post.id + 1))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.has_header("ETag"))
+        self.assertFalse(response.has_header("Last-Modified"))
+        response = self.client.get("/sarah/%s/" % (self.post.id + 1), HTTP_IF_NONE_MATCH="*")
+        self.assertEqual(response.status_code, 404)
+
+    def test_recommendations_refreshed(self):
+        self.client.force_login(self.user)
+        etag = self.client.get("/sarah/")["ETag"]
+        recommendations.refresh([self.user.id])
+        self.assertEqual(self.client.get("/sarah/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class SearchTest(TestCase):
+    """проверка полнотекстового поиска"""
+    def setUp(self):
+        self.client = Client()
+        self.user1 = User.objects.create_user(
+                username="sarah", email="connor.s@skynet.com", password="12345")
+        self.user2 = User.objects.create_user(
+                username="arny", email="arny.s@skynet.com", password="12345")
+        self.group = Group.objects.create(title='super', slug='super', description='description')
+        self.post = Post.objects.create(text="I'll be back", author=self.user2, group=self.group)
+        Post.objects.create(text="Come with me if you want to live", author=self.user1)
+        Post.objects.create(text="Back to the future, back again", author=self.user1)
+
+    def found(self, **params):
+        response = self.client.get(reverse('posts:search'), params)
+        return [post.text for post in response.context['page']]
+
+    def test_ranked_search(self):
+        self.assertEqual(self.found(q="back"), ["Back to the future, back again", "I'll be back"])
+        self.assertEqual(self.found(q="live"), ["Come with me if you want to live"])
+        self.assertEqual(self.found(q='"unbalanced'), [])
+
+    def test_filters(self):
+        self.assertEqual(self.found(q="back", group="super"), ["I'll be back"])
+        self.assertEqual(self.found(q="back", author="sarah"), ["Back to the future, back again"])
+
+    def test_index_follows_changes(self):
+        self.post.text = "Hasta la vista"
+        self.post.save()
+        self.assertEqual(self.found(q="vista"), ["Hasta la vista"])
+        self.post.delete()
+        self.assertEqual(self.found(q="vista"), [])
+
+    def test_cursor_pagination(self):
+        Post.objects.bulk_create([Post(text="back %s" % i, author=self.user1) for i in range(15)])
+        first = self.client.get(reverse('posts:search'), {"q": "back"}).context['page']
+        second = self.client.get(reverse('posts:search'), {"q": "back", "after": first.next_cursor}).context['page']
+        self.assertEqual(len(first) + len(second), 17)
+        self.assertFalse(set(p.id for p in first) & set(p.id for p in second))
+
+    def test_admin_search(self):
+        User.objects.create_superuser(username="admin", email="admin@yatube.ru", password="12345")
+        self.client.login(username="admin", password="12345")
+        Post.objects.create(text="Live and let die", author=self.user1)
+        response = self.client.get("/admin/posts/post/", {"q": "live"})
+        self.assertContains(response, "Come with me")
+        self.assertContains(response, "let die")
+        self.assertNotContains(response, "Hasta")
+        self.assertNotContains(response, "be back")
+
+
+def make_image(name="photo.png", size=(1200, 800), color="red"):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type="image/png")
+
+
+class ThumbnailTest(TestCase):
+    """проверка подготовки миниатюр после загрузки картинки"""
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media, THUMBNAIL_ASYNC=False, CACHES=TEST_CACHE)
+        self.settings_override.enable()
+        self.client = Client()
+        self.user = User.objects.create_user(
+                username="sarah", email="connor.s@skynet.com", password="12345")
+        self.client.login(username="sarah", password="12345")
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media, ignore_errors=True)
+
+    def test_variants_built(self):
+        self.client.post('/new/', {'text': 'Text', 'image': make_image()})
+        post = Post.objects.get()
+        with Image.open(post.image_thumb.path) as thumb:
+            self.assertEqual(thumb.size, (960, 339))
+        with Image.open(post.image_webp.path) as webp:
+            self.assertEqual(webp.format, "WEBP")
+        with Image.open(post.image_preview.path) as preview:
+            self.assertEqual(preview.size, (1200, 800))
+
+        response = self.client.get("/")
+        self.assertContains(response, post.image_thumb.url)
+        self.assertContains(response, 'type="image/webp"')
+
+    def test_rebuilt_on_edit(self):
+        self.client.post('/new/', {'text': 'Text', 'image': make_image()})
+        post = Post.objects.get()
+        old_thumb = post.image_thumb.name
+        self.client.post('/sarah/%s/edit/' % post.id, {'text': 'Text', 'image': make_image("other.png", color="blue")})
+        post.refresh_from_db()
+        self.assertNotEqual(post.image_thumb.name, old_thumb)
+        #  имена вариантов выводятся из имени картинки — хэша содержимого
+        stem = os.path.splitext(os.path.basename(post.image.name))[0]
+        self.assertIn(stem, post.image_thumb.name)
+
+    def test_reused_name(self):
+        """картинка со старым именем, занятым заново после удаления, не
+        получает чужие миниатюры"""
+        os.makedirs(os.path.join(self.media, "posts"))
+        path = os.path.join(self.media, "posts", "legacy.png")
+        for color in ("red", "blue"):
+            Image.new("RGB", (1200, 800), color).save(path)
+            post = Post.objects.create(text="Text", author=self.user, image="posts/legacy.png")
+            post.refresh_from_db()
+            with Image.open(post.image_thumb.path) as thumb:
+                self.assertEqual(thumb.convert("RGB").getpixel((0, 0))[2] > 128, color == "blue")
+            post.delete()
+
+    def test_extension_in_variant_names(self):
+        """<хэш>.jpg и <хэш>.jpeg — разные файлы, и миниатюры у них свои"""
+        os.makedirs(os.path.join(self.media, "posts", "ab"))
+        digest = "ab" + "0" * 62
+        for extension, color in ((".jpg", "red"), (".jpeg", "blue")):
+            Image.new("RGB", (1200, 800), color).save(os.path.join(self.media, "posts", "ab", digest + extension),
+                                                      format="JPEG")
+        names = ["posts/ab/%s%s" % (digest, extension) for extension in (".jpg", ".jpeg")]
+        self.assertEqual(len(set(thumbnails.variant_names(names[0]).values())
+                             | set(thumbnails.variant_names(names[1]).values())),
+                         2 * len(thumbnails.variant_names(names[0])))
+        for name, color in zip(names, ("red", "blue")):
+            post = Post.objects.create(text="Text", author=self.user, image=name)
+            post.refresh_from_db()
+            with Image.open(post.image_thumb.path) as thumb:
+                self.assertEqual(thumb.convert("RGB").getpixel((0, 0))[2] > 128, color == "blue")
+
+
+@override_settings(CACHES=TEST_CACHE)
+class FollowServiceTest(TestCase):
+    """проверка подписок одним запросом"""
+    def setUp(self):
+        self.client = Client()
+        self.reader = User.objects.create_user(username="sarah", password="12345")
+        self.authors = [User.objects.create_user(username="author%s" % n, password="12345") for n in range(3)]
+        Post.objects.create(text="Author post", author=self.authors[0])
+        self.client.force_login(self.reader)
+
+    def counter(self, user):
+        return UserCounter.objects.get(user=user)
+
+    def test_follow_twice(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get("/author0/follow/")
+        #  ни предварительного count(), ни SELECT перед вставкой
+        self.assertEqual([sql["sql"].split()[0] for sql in queries if "posts_follow " in sql["sql"]], ["INSERT"])
+        self.client.get("/author0/follow/")
+        self.assertEqual(Follow.objects.count(), 1)
+        self.assertEqual(self.counter(self.authors[0]).followers, 1)
+        self.assertEqual(self.counter(self.reader).following, 1)
+        self.assertEqual(Timeline.objects.filter(user=self.reader).count(), 1)
+
+        self.client.get("/author0/unfollow/")
+        self.client.get("/author0/unfollow/")
+        self.assertFalse(Follow.objects.exists())
+        self.assertEqual(self.counter(self.authors[0]).followers, 0)
+        self.assertEqual(self.counter(self.reader).following, 0)
+        self.assertFalse(Timeline.objects.exists())
+
+    def test_follow_self(self):
+        self.client.get("/sarah/follow/")
+        self.assertFalse(Follow.objects.exists())
+
+    def test_bulk(self):
+        Follow.objects.create(user=self.reader, author=self.authors[0])
+        response = self.client.post(reverse("posts:follow_bulk"), json.dumps(
+            {"action": "follow", "authors": ["author0", "author1", "author2", "sarah", "nobody"]}),
+            content_type="application/json")
+        self.assertEqual(response.json(), {"followed": ["author1", "author2"], "not_found": ["nobody"]})
+        self.assertEqual(self.counter(self.reader).following, 3)
+        self.assertEqual(self.counter(self.authors[2]).followers, 1)
+
+        response = self.client.post(reverse("posts:follow_bulk"),
+                                    {"action": "unfollow", "authors": ["author0", "author1"]})
+        self.assertEqual(response.json(), {"unfollowed": ["author0", "author1"], "not_found": []})
+        self.assertEqual(list(Follow.objects.values_list("author__username", flat=True)), ["author2"])
+        self.assertEqual(self.counter(self.reader).following, 1)
+        self.assertFalse(Timeline.objects.exists())
+        self.assertEqual(self.client.get(reverse("posts:follow_bulk")).status_code, 405)
+
+
+class FollowGraphTest(TransactionTestCase):
+    """проверка графа подписок в памяти; изменения публикуются после
+    коммита, поэтому тесты идут без общей транзакции"""
+    def setUp(self):
+        cache.clear()
+        graph.reset()
+        self.users = [User.objects.create_user(username="user%s" % n, password="12345") for n in range(4)]
+        ids = [user.id for user in self.users]
+        self.ids = ids
+        for user_id, author_id in ((ids[0], ids[1]), (ids[0], ids[2]), (ids[1], ids[2]), (ids[3], ids[0])):
+            Follow.objects.create(user_id=user_id, author_id=author_id)
+
+    def tearDown(self):
+        graph.reset()
+
+    def test_queries(self):
+        a, b, c, d = self.ids
+        graph.get()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(graph.is_following(a, b))
+            self.assertFalse(graph.is_following(b, a))
+            self.assertEqual(graph.following_count(a), 2)
+            self.assertEqual(graph.followers_count(c), 2)
+            self.assertEqual(graph.followees(a), [b, c])
+        self.assertEqual(len(queries), 0)
+
+    def test_incremental(self):
+        a, b, c, d = self.ids
+        built = graph.get()
+        follows.follow(d, b)
+        follows.unfollow(a, b)
+        #  изменения применены к тому же графу, без пересборки
+        self.assertIs(graph.get(), built)
+        self.assertTrue(graph.is_following(d, b))
+        self.assertFalse(graph.is_following(a, b))
+        self.assertEqual(graph.followees(d), [a, b])
+        self.assertEqual(graph.followers_count(b), 1)
+
+    def test_replay(self):
+        a, b, c, d = self.ids
+        [version] = cache_scopes.generations("graph")
+        #  граф другого процесса, собранный до изменений
+        other = graph.FollowGraph.from_database(version)
+        follows.follow_many(b, [a, d])
+        self.assertTrue(graph._replay(other, graph.get().version))
+        self.assertEqual(other.followees(b), [a, c, d])
+
+    def test_rolled_back(self):
+        a, b, c, d = self.ids
+        [version] = cache_scopes.generations("graph")
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            follows.follow(d, b)
+            raise RuntimeError
+        #  откаченная подписка не получила поколения и не попала в граф
+        self.assertEqual(cache_scopes.generations("graph"), [version])
+        self.assertFalse(graph.is_following(d, b))
+
+    def test_unshared(self):
+        a, b, c, d = self.ids
+        with override_settings(CACHES=TEST_CACHE):
+            built = graph.get()
+            #  без общего кэша граф не пересобирается на каждом обращении
+            self.assertIs(graph.get(), built)
+            follows.follow(d, b)
+            self.assertTrue(graph.is_following(d, b))
+
+    @override_settings(GRAPH_ASYNC=True)
+    def test_built_in_background(self):
+        a, b, c, d = self.ids
+        release, built = threading.Event(), threading.Event()
+        build = graph._build
+
+        def slow(current):
+            release.wait(5)
+            try:
+                return build(current)
+            finally:
+                built.set()
+
+        with mock.patch.object(graph, "_build", slow):
+            #  граф ещё собирается — отвечают индексы таблицы подписок
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(graph.is_following(a, b))
+                self.assertEqual(graph.following_count(a), 2)
+                self.assertEqual(graph.followed_among(a, [b, c, d]), {b, c})
+            self.assertEqual(len(queries), 3)
+            release.set()
+            self.assertTrue(built.wait(5))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(graph.is_following(a, b))
+        self.assertEqual(len(queries), 0)
+
+    def test_snapshot(self):
+        a, b, c, d = self.ids
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, "graph.bin")
+        graph.save(graph.get(), path)
+        loaded = graph.load(path)
+        self.assertIsInstance(loaded.following.csr.targets, memoryview)
+        self.assertEqual(loaded.followees(a), [b, c])
+        self.assertEqual(loaded.follower_ids(a), [d])
+
+    def test_compact(self):
+        a, b, c, d = self.ids
+        with mock.patch.object(graph, "COMPACT_AFTER", 1):
+            follows.follow_many(d, [b, c])
+        current = graph.get()
+        self.assertEqual(current.pending, 0)
+        self.assertEqual(current.followees(d), [a, b, c])
+        self.assertEqual(current.follower_ids(c), [a, b, d])
+
+
+@override_settings(CACHES=TEST_CACHE)
+class RecommendationTest(TestCase):
+    """проверка рекомендаций "кого почитать" """
+    def setUp(self):
+        graph.reset()
+        self.client = Client()
+        names = ("reader", "alice", "bob", "carol", "dave", "newbie")
+        self.users = {name: User.objects.create_user(username=name, password="12345") for name in names}
+        for user, author in (("reader", "alice"), ("alice", "bob"), ("alice", "carol"),
+                             ("dave", "alice"), ("dave", "carol"), ("bob", "carol")):
+            Follow.objects.create(user=self.users[user], author=self.users[author])
+        self.client.force_login(self.users["reader"])
+
+    def tearDown(self):
+        graph.reset()
+
+    def test_deleted_user_dequeued(self):
+        #  удаление подписок пользователя снова ставит его в очередь
+        dave = self.users["dave"]
+        dave_id = dave.id
+        dave.delete()
+        self.assertFalse(RecommendationQueue.objects.filter(user_id=dave_id).exists())
+
+    def test_score(self):
+        u = self.users
+        ranked = recommendations.Scorer(graph.get()).score(u["reader"].id)
+        candidates = [candidate for candidate, value, mutual in ranked]
+        #  carol читают и alice, и её читатели, поэтому она выше bob
+        self.assertEqual(candidates, [u["carol"].id, u["bob"].id])
+        self.assertEqual(ranked[0][2], 1)
+
+    def test_build_and_show(self):
+        call_command("build_recommendations", stdout=io.StringIO())
+        self.assertFalse(RecommendationQueue.objects.exists())
+        #  кто ни на кого не подписан, получает самых читаемых авторов
+        self.assertEqual(Recommendation.objects.filter(user=self.users["newbie"]).order_by("-score")
+                         .values_list("candidate__username", flat=True)[0], "carol")
+
+        response = self.client.get("/follow/")
+        self.assertContains(response, "Кого почитать")
+        self.assertContains(response, "@carol")
+        #  на профиле кандидата сам кандидат не предлагается
+        shown = self.client.get("/carol/").context["recommendations"]
+        self.assertEqual([row.candidate.username for row in shown], ["bob"])
+
+        self.client.get("/carol/follow/")
+        self.assertNotContains(self.client.get("/follow/"), "@carol")
+        self.assertTrue(RecommendationQueue.objects.filter(user=self.users["reader"]).exists())
+
+        call_command("build_recommendations", incremental=True, stdout=io.StringIO())
+        self.assertFalse(RecommendationQueue.objects.exists())
+        self.assertFalse(Recommendation.objects.filter(user=self.users["reader"], candidate=self.users["carol"]).exists())
+
+    def test_queue_kept_until_done(self):
+        reader = self.users["reader"]
+        recommendations.enqueue(reader.id)
+        users, queued = recommendations.claim()
+        self.assertIn(reader.id, users)
+        #  расчёт может упасть — строка остаётся в очереди до done
+        self.assertTrue(RecommendationQueue.objects.filter(user=reader).exists())
+        #  подписки изменились во время расчёта
+        RecommendationQueue.objects.filter(user=reader).update(queued_at=timezone.now() + timedelta(seconds=1))
+        recommendations.done(queued)
+        self.assertTrue(RecommendationQueue.objects.filter(user=reader).exists())
+        recommendations.done(recommendations.claim()[1])
+        self.assertFalse(RecommendationQueue.objects.exists())
+
+    def test_score_bounded(self):
+        u = self.users
+        follows.follow_many(u["reader"].id, [u["dave"].id, u["newbie"].id])
+        follow_graph = graph.get()
+        walked = []
+        followees = follow_graph.followees
+
+        def counted(user_id, limit=None):
+            result = followees(user_id, limit)
+            walked.append((limit, len(result)))
+            return result
+
+        with mock.patch.object(recommendations, "FOLLOWEES_SAMPLE", 2), \
+                mock.patch.object(recommendations, "SAMPLE", 1), \
+                mock.patch.object(follow_graph, "followees", counted), \
+                mock.patch.object(follow_graph, "follower_ids",
+                                  lambda author_id, limit=None: walked.append((limit, 0)) or []):
+            ranked = recommendations.Scorer(follow_graph).score(u["reader"].id)
+        #  каждый обход ограничен выборкой
+        self.assertTrue(walked)
+        self.assertTrue(all(limit is not None and count <= limit for limit, count in walked))
+        #  подписки вне выборки всё равно не рекомендуются
+        followed = {u[name].id for name in ("alice", "dave", "newbie")}
+        self.assertFalse(followed & {candidate for candidate, value, mutual in ranked})
+
+    def test_sample(self):
+        adjacency = graph.Adjacency.from_rows(((0, w) for w in range(1, 1001)), 1001)
+        sample = list(adjacency.neighbors(0, 10))
+        #  выборка идёт по всей строке, а не с её начала
+        self.assertEqual(len(sample), 10)
+        self.assertEqual(sample, sorted(sample))
+        self.assertGreater(sample[-1], 900)
+        self.assertEqual(list(adjacency.neighbors(0, 2000)), list(range(1, 1001)))
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TrendingTest(TestCase):
+    """проверка популярных постов и сообществ"""
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username="sarah", password="12345")
+        self.quiet = Group.objects.create(title="quiet", slug="quiet", description="description")
+        self.loud = Group.objects.create(title="loud", slug="loud", description="description")
+        self.old = Post.objects.create(text="Discussed post", author=self.user, group=self.loud)
+        self.new = Post.objects.create(text="Fresh post", author=self.user, group=self.quiet)
+
+    def test_ranking(self):
+        #  без обсуждения свежий пост выше
+        self.assertEqual(list(trending.trending_posts()), [self.new, self.old])
+        for n in range(2):
+            Comment.objects.create(post=self.old, author=self.user, text="comment %s" % n)
+        self.assertEqual(list(trending.trending_posts()), [self.old, self.new])
+        self.assertEqual(trending.hot_groups(), [self.loud, self.quiet])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/_/trending/")
+        self.assertEqual([post.id for post in response.context["page"]], [self.old.id, self.new.id])
+        self.assertFalse([query for query in queries if "posts_comment" in query["sql"]])
+
+    def test_decay(self):
+        day = 24 * 60 * 60
+        #  событие, случившееся на период полураспада раньше, весит вдвое меньше
+        now = timezone.now()
+        self.assertAlmostEqual(trending.event_score(2, now - timedelta(seconds=trending.HALF_LIFE)),
+                               trending.event_score(1, now))
+        self.assertAlmostEqual(trending.logaddexp(math.log(1), math.log(3)), math.log(4))
+        self.assertGreater(trending.event_score(1), trending.event_score(100, now - timedelta(seconds=30 * day)))
+
+    def test_rebuild_matches_incremental(self):
+        Comment.objects.create(post=self.old, author=self.user, text="comment")
+        #  подписки поднимают и посты автора, и их сообщества
+        readers = [User.objects.create_user(username="reader%s" % n, password="12345") for n in range(2)]
+        loud = Group.objects.get(pk=self.loud.pk).hot_score
+        follows.follow(readers[0].id, self.user.id)
+        Follow.objects.create(user=readers[1], author=self.user)
+        self.assertGreater(Group.objects.get(pk=self.loud.pk).hot_score, loud)
+        incremental = dict(Post.objects.values_list("pk", "hot_score"))
+        groups = dict(Group.objects.values_list("pk", "hot_score"))
+        Post.objects.update(hot_score=0)
+        trending.rebuild()
+        for pk, score in Post.objects.values_list("pk", "hot_score"):
+            self.assertAlmostEqual(score, incremental[pk], places=3)
+        for pk, score in Group.objects.values_list("pk", "hot_score"):
+            self.assertAlmostEqual(score, groups[pk], places=3)
+
+class GenerateDataTest(TestCase):
+    """проверка генератора синтетических данных"""
+    def test_generate(self):
+        call_command("generate_data", users=30, groups=3, posts=200, comments=300, follows=5, seed=1,
+                     stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(User.objects.count(), 30)
+        self.assertEqual(Post.objects.count(), 200)
+        self.assertEqual(Comment.objects.count(), 300)
+        #  даты постов разбросаны, а не проставлены auto_now_add
+        self.assertGreater(Post.objects.dates("pub_date", "day").count(), 1)
+        #  производные данные догнаны после bulk_create
+        self.assertEqual(sum(UserCounter.objects.values_list("posts", flat=True)), 200)
+        self.assertEqual(sum(UserCounter.objects.values_list("followers", flat=True)), Follow.objects.count())
+        self.assertEqual(sum(Post.objects.values_list("comment_count", flat=True)), 300)
+        #  в ленте каждого подписчика — все посты его авторов
+        followers = {}
+        for author_id in Follow.objects.values_list("author_id", flat=True):
+            followers[author_id] = followers.get(author_id, 0) + 1
+        expected = sum(followers.get(author_id, 0) for author_id in Post.objects.values_list("author_id", flat=True))
+        self.assertGreater(expected, 0)
+        self.assertEqual(Timeline.objects.count(), expected)
+
+
+class MetricsTest(TestCase):
+    """проверка метрик запросов"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = override_settings(METRICS_DIR=self.directory, METRICS_ALLOWED_IPS=["127.0.0.1"])
+        self.settings.enable()
+        #  счётчики процесса откроются заново во временном каталоге
+        metrics.registry.reset()
+        cache.clear()
+        self.user = User.objects.create_user(username="sarah", password="12345")
+
+    def tearDown(self):
+        self.settings.disable()
+        metrics.registry.reset()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_view_recorded(self):
+        Post.objects.create(text="Text", author=self.user)
+        self.client.get("/")
+        self.client.get("/")
+        self.client.get("/sarah/")
+        totals = metrics.snapshot()
+        index = totals["posts:index"]
+        self.assertEqual(index[metrics.REQUESTS], 2)
+        self.assertGreater(index[metrics.DB_QUERIES], 0)
+        self.assertGreater(index[metrics.TEMPLATE], 0)
+        #  второй запрос берёт фрагмент ленты из кэша
+        self.assertGreater(index[metrics.CACHE_HITS], 0)
+        self.assertGreater(index[metrics.CACHE_MISSES], 0)
+        self.assertEqual(sum(index[len(metrics.FIELDS):]), 2)
+        self.assertEqual(totals["posts:profile"][metrics.REQUESTS], 1)
+
+    def test_scrape(self):
+        self.client.get("/")
+        response = self.client.get("/_/metrics/")
+        self.assertContains(response, 'yatube_requests_total{view="posts:index"} 1')
+        self.assertContains(response, 'yatube_request_duration_seconds_bucket{view="posts:index",le="+Inf"} 1')
+        response = Client(REMOTE_ADDR="10.0.0.1").get("/_/metrics/")
+        self.assertEqual(response.status_code, 403)
+
+    def test_new_connections_wrapped(self):
+        #  обёртка ставится при открытии соединения, а не на каждом запросе
+        installed = []
+
+        def connect():
+            connections["default"].ensure_connection()
+            installed.append(metrics._count_query in connections["default"].execute_wrappers)
+            connections["default"].close()
+
+        thread = threading.Thread(target=connect)
+        thread.start()
+        thread.join()
+        self.assertEqual(installed, [True])
+
+    def test_threads(self):
+        def record():
+            for _ in range(2000):
+                metrics.registry.record("posts:index", 200, 100, metrics.stats)
+
+        #  у каждого потока свои счётчики запроса, ячейки слота — общие
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metrics.snapshot()["posts:index"][metrics.REQUESTS], 16000)
+
+
+class SharedCacheTest(TestCase):
+    """проверка общего для процессов кэша на SQLite"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cache.sqlite3")
+        self.cache = SQLiteCache(self.path, {"OPTIONS": {"MAX_ENTRIES": 20, "CULL_FREQUENCY": 4}})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_values(self):
+        self.cache.set("number", 5)
+        self.cache.set("flag", True)
+        self.cache.set("data", {"posts": [1, 2]})
+        self.assertEqual(self.cache.get_many(["number", "flag", "data", "missing"]),
+                         {"number": 5, "flag": True, "data": {"posts": [1, 2]}})
+        self.assertIs(self.cache.get("flag"), True)
+        self.assertFalse(self.cache.add("number", 6))
+        self.assertTrue(self.cache.add("other", 6))
+        self.cache.delete_many(["number", "other"])
+        self.assertIsNone(self.cache.get("number"))
+
+    def test_shared_between_instances(self):
+        other = SQLiteCache(self.path, {})
+        self.cache.set("key", "value")
+        self.assertEqual(other.get("key"), "value")
+        other.delete("key")
+        self.assertFalse(self.cache.has_key("key"))
+
+    def test_expiry(self):
+        self.cache.set("key", "value", 10)
+        with mock.patch("yatube.sharedcache.time.time", return_value=time.time() + 20):
+            self.assertIsNone(self.cache.get("key"))
+            self.assertTrue(self.cache.add("key", "new"))
+        self.cache.set("forever", 1, None)
+        self.assertTrue(self.cache.touch("forever", 10))
+
+    def test_incr_atomic(self):
+        self.cache.set("counter", 0, None)
+        children = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for j in range(50):
+                        self.cache.incr("counter")
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        for pid in children:
+            os.waitpid(pid, 0)
+        self.assertEqual(self.cache.get("counter"), 200)
+        self.assertEqual(self.cache.decr("counter", 10), 190)
+        with self.assertRaises(ValueError):
+            self.cache.incr("missing")
+
+    def test_cull_least_recent(self):
+        start = time.time()
+        for i in range(40):
+            with mock.patch("yatube.sharedcache.time.time", return_value=start + i * 100):
+                self.cache.set("key%s" % i, i, None)
+                #  первые ключи читаются постоянно и не вытесняются
+                self.cache.get_many(["key0", "key1"])
+        with mock.patch("yatube.sharedcache.time.time", return_value=start + 4000):
+            self.cache._cull()
+            self.assertEqual(self.cache.get_many(["key0", "key1"]), {"key0": 0, "key1": 1})
+            self.assertIsNone(self.cache.get("key5"))
+            self.assertEqual(self.cache.get("key39"), 39)
+
+
+class StampedeTest(TestCase):
+    """проверка защиты от одновременного пересчёта"""
+    def setUp(self):
+        cache.clear()
+        metrics.stats.reset()
+        self.calls = []
+
+    def compute(self, value, delay=0):
+        def compute():
+            time.sleep(delay)
+            self.calls.append(value)
+            return value
+        return compute
+
+    def test_stale_while_recomputing(self):
+        self.assertEqual(cache_scopes.get_or_compute("key", ["scope"], self.compute("old")), "old")
+        cache_scopes.bump("scope")
+        #  пересчёт уже идёт в другом процессе
+        cache.add("lock:key", 1)
+        self.assertEqual(cache_scopes.get_or_compute("key", ["scope"], self.compute("new")), "old")
+        self.assertEqual(metrics.stats.cache_stale, 1)
+        cache.delete("lock:key")
+        self.assertEqual(cache_scopes.get_or_compute("key", ["scope"], self.compute("new")), "new")
+        self.assertEqual(self.calls, ["old", "new"])
+
+    def test_collapsed(self):
+        leader = threading.Thread(
+            target=cache_scopes.get_or_compute, args=("key", ["scope"], self.compute("value", 0.3)))
+        leader.start()
+        time.sleep(0.1)
+        #  пересчёт идёт в этом же процессе: ждём события, не опрашивая кэш
+        with mock.patch.object(cache_scopes, "_poll", side_effect=AssertionError):
+            result = cache_scopes.get_or_compute("key", ["scope"], self.compute("mine"))
+        leader.join()
+        self.assertEqual(result, "value")
+        self.assertEqual(self.calls, ["value"])
+        self.assertEqual(metrics.stats.cache_collapsed, 1)
+
+    def test_collapsed_across_processes(self):
+        #  блокировку держит другой процесс; его значение появится в кэше
+        cache.add("lock:key", 1)
+        versions = cache_scopes.generations("scope")
+        writer = threading.Timer(0.1, cache.set, args=("key", (versions, "value", math.inf, 0)))
+        writer.start()
+        self.assertEqual(cache_scopes.get_or_compute("key", ["scope"], self.compute("mine")), "value")
+        writer.join()
+        self.assertEqual(self.calls, [])
+
+    def test_early_recompute(self):
+        #  пересчёт занял 0.05 с при сроке 0.2 с
+        cache_scopes.get_or_compute("key", ["scope"], self.compute("first", 0.05), timeout=0.2)
+        with mock.patch("posts.cache.random.random", return_value=0.5):
+            cache_scopes.get_or_compute("key", ["scope"], self.compute("second"), timeout=0.2)
+        self.assertEqual(self.calls, ["first"])
+        with mock.patch("posts.cache.random.random", return_value=0.99):
+            self.assertEqual(cache_scopes.get_or_compute("key", ["scope"], self.compute("second"), timeout=0.2),
+                             "second")
+        self.assertEqual(metrics.stats.cache_early, 1)
+
+    def test_stale_page(self):
+        user = User.objects.create_user(username="sarah", password="12345")
+        Post.objects.create(text="First post", author=user)
+        fresh = self.client.get("/")
+        Post.objects.create(text="Second post", author=user)
+        cache.add("lock:%s" % pagecache._page_key(fresh.wsgi_request), 1)
+        response = self.client.get("/")
+        self.assertEqual(response["X-Cache"], "STALE")
+        self.assertNotContains(response, "Second post")
+        self.assertEqual(response["ETag"], fresh["ETag"])
+        self.assertIn("max-age=0", response["Cache-Control"])
+
+
+class IdentityTest(TestCase):
+    """проверка кэша "имя пользователя -> пользователь" """
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="sarah", first_name="Sarah", password="12345")
+
+    def test_cached(self):
+        self.assertEqual(identity.get("sarah").id, self.user.id)
+        self.assertIsNone(identity.get("nobody"))
+        with self.assertNumQueries(0):
+            user = identity.get("sarah")
+            self.assertEqual((user.pk, user.username, user.first_name), (self.user.id, "sarah", "Sarah"))
+            self.assertIsNone(identity.get("nobody"))
+        #  остальные поля догружаются из базы
+        self.assertEqual(user.email, self.user.email)
+
+    def test_invalidated(self):
+        self.assertIsNone(identity.get("kyle"))
+        kyle = User.objects.create_user(username="kyle", password="12345")
+        self.assertEqual(identity.get("kyle").id, kyle.id)
+
+        identity.get("sarah")
+        self.user.username = "connor"
+        self.user.save()
+        self.assertIsNone(identity.get("sarah"))
+        self.assertEqual(identity.get("connor").id, self.user.id)
+
+        kyle.delete()
+        self.assertIsNone(identity.get("kyle"))
+
+    def test_login_keeps_entry(self):
+        identity.get("sarah")
+        self.client.login(username="sarah", password="12345")
+        with self.assertNumQueries(0):
+            identity.get("sarah")
+
+    def test_views(self):
+        post = Post.objects.create(text="First post", author=self.user)
+        self.assertContains(self.client.get("/sarah/"), "Sarah")
+        self.assertContains(self.client.get("/sarah/%s/" % post.id), "First post")
+        self.assertEqual(self.client.get("/nobody/").status_code, 404)
+        reader = User.objects.create_user(username="kyle", password="12345")
+        self.client.force_login(reader)
+        self.client.get("/sarah/follow/")
+        self.assertTrue(Follow.objects.filter(user=reader, author=self.user).exists())
+
+
+@override_settings(CACHES=TEST_CACHE)
+class TransferTest(TestCase):
+    """проверка выгрузки и загрузки NDJSON"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "dump.ndjson")
+        self.sarah = User.objects.create_user(username="sarah", first_name="Sarah", password="12345")
+        self.kyle = User.objects.create_user(username="kyle", password="12345")
+        self.group = Group.objects.create(title='super', slug='super', description='description')
+        self.post = Post.objects.create(text="First post", author=self.sarah, group=self.group)
+        Post.objects.create(text="Second post", author=self.kyle)
+        Comment.objects.create(post=self.post, author=self.kyle, text="comment")
+        follows.follow(self.kyle.id, self.sarah.id)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_round_trip(self):
+        call_command("export_content", output=self.path, batch=1, stderr=io.StringIO())
+        with open(self.path, encoding="utf-8") as fp:
+            records = [json.loads(line) for line in fp]
+        self.assertEqual([record["type"] for record in records],
+                         ["user", "user", "group", "post", "post", "comment", "follow"])
+
+        #  другие посты с теми же id уже заняли место в базе
+        Post.objects.all().delete()
+        Group.objects.all().delete()
+        self.kyle.delete()
+        Post.objects.create(text="Unrelated", author=self.sarah)
+        Post.objects.create(text="Unrelated", author=self.sarah)
+        call_command("import_content", self.path, batch=2, stdout=io.StringIO(), stderr=io.StringIO())
+
+        kyle = User.objects.get(username="kyle")
+        self.assertFalse(kyle.has_usable_password())
+        post = Post.objects.get(text="First post")
+        self.assertEqual(post.author, self.sarah)
+        self.assertEqual(post.group.slug, "super")
+        self.assertEqual(post.pub_date, self.post.pub_date)
+        comment = Comment.objects.get()
+        self.assertEqual((comment.post, comment.author), (post, kyle))
+        self.assertEqual(post.comment_count, 1)
+        self.assertTrue(Follow.objects.filter(user=kyle, author=self.sarah).exists())
+        self.assertEqual(UserCounter.objects.get(user=self.sarah).followers, 1)
+        self.assertEqual(Timeline.objects.filter(user=kyle).count(), 3)
+
+    def test_generated_file(self):
+        #  несколько тысяч строк в несколько порций: id постов из файла
+        #  заняты в базе, комментарии должны найти свои посты по новым id
+        users = ["user%s" % n for n in range(20)]
+        lines = [json.dumps({"type": "user", "username": name, "date_joined": "2020-01-01T00:00:00+00:00"})
+                 for name in users]
+        posts = {old_id: "post %s" % old_id for old_id in range(self.post.id, self.post.id + 1000)}
+        lines += [json.dumps({"type": "post", "id": old_id, "author": users[old_id % 20], "group": None,
+                              "text": text, "pub_date": "2020-01-02T03:04:05.%06d+00:00" % old_id, "image": ""})
+                  for old_id, text in posts.items()]
+        lines += [json.dumps({"type": "comment", "post": old_id, "author": users[n % 20],
+                              "text": "on %s" % text, "created": "2020-01-03T00:00:00+03:00"})
+                  for n, (old_id, text) in enumerate(list(posts.items()) * 2)]
+        lines += [json.dumps({"type": "follow", "user": users[n], "author": users[(n + 1) % 20],
+                              "created": None}) for n in range(20)]
+        with open(self.path, "w", encoding="utf-8") as fp:
+            fp.write("\n".join(lines) + "\n")
+        out = io.StringIO()
+        call_command("import_content", self.path, batch=300, stdout=out, stderr=io.StringIO())
+        self.assertIn("comment: загружено 2000, пропущено 0", out.getvalue())
+
+        imported = Post.objects.filter(text__startswith="post ")
+        self.assertEqual(imported.count(), 1000)
+        self.assertFalse(imported.filter(id__lte=Post.objects.filter(text="Second post").get().id).exists())
+        for post in imported.select_related("author"):
+            old_id = int(post.text.split()[1])
+            self.assertEqual(post.author.username, users[old_id % 20])
+            self.assertEqual(post.pub_date.microsecond, old_id)
+        for comment in Comment.objects.filter(text__startswith="on ").select_related("post"):
+            self.assertEqual(comment.text, "on %s" % comment.post.text)
+            self.assertEqual(comment.created.hour, 21)
+        self.assertEqual(Comment.objects.filter(text__startswith="on ").count(), 2000)
+        self.assertEqual(Follow.objects.filter(user__username__startswith="user").count(), 20)
+
+    def test_import_twice(self):
+        call_command("export_content", output=self.path, stderr=io.StringIO())
+        out = io.StringIO()
+        call_command("import_content", self.path, stdout=out, stderr=io.StringIO())
+        self.assertIn("user: загружено 0, пропущено 2", out.getvalue())
+        self.assertIn("follow: загружено 0, пропущено 1", out.getvalue())
+        #  посты не имеют естественного ключа и загружаются повторно
+        self.assertEqual(Post.objects.filter(text="First post").count(), 2)
+
+
+class DatabaseBackendTest(TestCase):
+    """проверка настроек соединения SQLite и повтора при блокировке"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "db.sqlite3")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def wrapper(self, **options):
+        settings_dict = dict(connection.settings_dict, NAME=self.path, OPTIONS=options)
+        wrapper = DatabaseWrapper(settings_dict, alias="tuning")
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def pragma(self, wrapper, name):
+        with wrapper.cursor() as cursor:
+            cursor.execute("PRAGMA %s" % name)
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        wrapper = self.wrapper(pragmas={"cache_size": -1000})
+        self.assertEqual(self.pragma(wrapper, "journal_mode"), "wal")
+        self.assertEqual(self.pragma(wrapper, "synchronous"), 1)
+        self.assertEqual(self.pragma(wrapper, "cache_size"), -1000)
+        self.assertEqual(self.pragma(wrapper, "busy_timeout"), 5000)
+
+    def test_begin_immediate(self):
+        wrapper = self.wrapper()
+        wrapper.ensure_connection()
+        wrapper._start_transaction_under_autocommit()
+        #  блокировка записи взята сразу, до первого изменения
+        other = sqlite3.connect(self.path, timeout=0)
+        with self.assertRaises(sqlite3.OperationalError):
+            other.execute("BEGIN IMMEDIATE")
+        other.close()
+        wrapper.connection.rollback()
+
+    def test_retry_when_locked(self):
+        wrapper = self.wrapper(pragmas={"busy_timeout": 0})
+        with wrapper.cursor() as cursor:
+            cursor.execute("CREATE TABLE item (id INTEGER PRIMARY KEY)")
+        other = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        other.execute("BEGIN IMMEDIATE")
+        threading.Timer(0.05, other.execute, ["COMMIT"]).start()
+        with wrapper.cursor() as cursor:
+            cursor.execute("INSERT INTO item (id) VALUES (1)")
+        other.close()
+        with wrapper.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM item")
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_no_retry_in_transaction(self):
+        wrapper = self.wrapper(pragmas={"busy_timeout": 0}, immediate=False)
+        with wrapper.cursor() as cursor:
+            cursor.execute("CREATE TABLE item (id INTEGER PRIMARY KEY)")
+        wrapper._start_transaction_under_autocommit()
+        with wrapper.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM item")
+        other = sqlite3.connect(self.path, isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+        #  повторять один запрос внутри транзакции бессмысленно
+        with self.assertRaises(Exception), mock.patch("yatube.db.base.time.sleep") as sleep:
+            with wrapper.cursor() as cursor:
+                cursor.execute("INSERT INTO item (id) VALUES (1)")
+        self.assertFalse(sleep.called)
+        other.rollback()
+        other.close()
+        wrapper.connection.rollback()
+
+
+class WriteBatchTest(TestCase):
+    """проверка записи комментариев и подписок партиями"""
+    def setUp(self):
+        self.sarah = User.objects.create_user(username="sarah", password="12345")
+        self.kyle = User.objects.create_user(username="kyle", password="12345")
+        self.post = Post.objects.create(text="Post", author=self.sarah)
+
+    def test_batch(self):
+        def fail():
+            Comment.objects.create(post=self.post, author=self.kyle, text="Lost")
+            raise ValueError("fail")
+
+        comment = Comment(post=self.post, author=self.kyle, text="Kept")
+        batch = [(func, args, writes.Future()) for func, args in (
+            (comment.save, ()),
+            (follows.follow, (self.kyle.id, self.sarah.id)),
+            (fail, ()),
+        )]
+        writes.run_batch(batch)
+
+        self.assertIsNone(batch[0][2].result())
+        self.assertEqual(batch[1][2].result(), True)
+        self.assertIsInstance(batch[2][2].exception(), ValueError)
+        #  ошибка одной записи откатила только её
+        self.assertEqual(list(Comment.objects.values_list("text", flat=True)), ["Kept"])
+        self.assertTrue(Follow.objects.filter(user=self.kyle, author=self.sarah).exists())
+
+    @override_settings(WRITE_COALESCING=True)
+    def test_direct_in_transaction(self):
+        #  внутри открытой транзакции запись выполняется сразу
+        with mock.patch("posts.writes._get_writer") as writer:
+            self.assertTrue(writes.submit(follows.follow, self.kyle.id, self.sarah.id))
+        self.assertFalse(writer.called)
+
+
+@override_settings(WRITE_COALESCING=True, WRITE_BATCH_LINGER=0.05)
+class WriteCoalescingTest(TransactionTestCase):
+    """проверка потока-писателя: параллельные запросы пишутся вместе"""
+    def setUp(self):
+        cache.clear()
+        self.sarah = User.objects.create_user(username="sarah", password="12345")
+        self.post = Post.objects.create(text="Post", author=self.sarah)
+        self.readers = [User.objects.create_user(username="reader%s" % number) for number in range(5)]
+        writes._writer = None
+
+    def test_concurrent_writes(self):
+        batches = []
+        run_batch = writes.run_batch
+
+        def counted(batch):
+            batches.append(len(batch))
+            run_batch(batch)
+
+        def write(reader):
+            comment = Comment(post=self.post, author=reader, text="From %s" % reader.username)
+            writes.submit(comment.save)
+            self.assertTrue(writes.submit(follows.follow, reader.id, self.sarah.id))
+
+        with mock.patch("posts.writes.run_batch", counted):
+            threads = [threading.Thread(target=write, args=(reader,)) for reader in self.readers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        #  submit возвращается после коммита — записи уже видны
+        self.assertEqual(Comment.objects.filter(post=self.post).count(), 5)
+        self.assertEqual(Follow.objects.filter(author=self.sarah).count(), 5)
+        self.assertEqual(UserCounter.objects.get(user=self.sarah).followers, 5)
+        self.assertEqual(sum(batches), 10)
+        self.assertLess(len(batches), 10)
+
+    def test_writer_survives_errors(self):
+        #  ошибка вне run_batch достаётся ожидающим, а поток продолжает работу
+        errors = [DatabaseError("gone")]
+
+        def close_old_connections():
+            if errors:
+                raise errors.pop()
+
+        with mock.patch("posts.writes.close_old_connections", close_old_connections):
+            with self.assertRaises(DatabaseError):
+                writes.submit(follows.follow, self.readers[0].id, self.sarah.id)
+            self.assertTrue(writes.submit(follows.follow, self.readers[1].id, self.sarah.id))
+        self.assertTrue(writes._writer.alive())
+
+    def test_dead_writer_replaced(self):
+        dead = writes._get_writer()
+        dead.thread = threading.Thread(target=lambda: None)
+        dead.thread.start()
+        dead.thread.join()
+        self.assertTrue(writes.submit(follows.follow, self.readers[0].id, self.sarah.id))
+        self.assertIsNot(writes._writer, dead)
+
+    @override_settings(WRITE_TIMEOUT=0.01)
+    def test_timeout(self):
+        #  запись, которую так и не начали, отменяется вместе с запросом
+        future = writes.Future()
+        with mock.patch("posts.writes._get_writer") as writer:
+            writer.return_value.submit.return_value = future
+            with self.assertRaises(writes.TimeoutError):
+                writes.submit(follows.follow, self.readers[0].id, self.sarah.id)
+        self.assertTrue(future.cancelled())
+        writes.run_batch([(follows.follow, (self.readers[0].id, self.sarah.id), future)])
+        self.assertFalse(Follow.objects.filter(user=self.readers[0]).exists())
+
+
+@override_settings(DATABASE_REPLICAS=["replica"])
+class ReplicaTest(TransactionTestCase):
+    """проверка чтения с реплики и чтения своих записей с основной базы"""
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        connections.databases["replica"] = dict(connection.settings_dict,
+                                                NAME=os.path.join(self.directory, "replica.sqlite3"))
+        self.addCleanup(self.drop_replica)
+        replicas.sync("replica")
+        self.sarah = User.objects.create_user(username="sarah", password="12345")
+        self.kyle = User.objects.create_user(username="kyle", password="12345")
+        self.post = Post.objects.create(text="Synced post", author=self.sarah)
+        self.client.force_login(self.kyle)
+        replicas.sync("replica")
+        #  этого поста на реплике ещё нет
+        Post.objects.create(text="Fresh post", author=self.sarah)
+
+    def drop_replica(self):
+        connections["replica"].close()
+        del connections.databases["replica"]
+        del connections._connections.replica
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_routing(self):
+        #  вне запросов к сайту чтения идут на основную базу
+        self.assertEqual(Post.objects.count(), 2)
+        with replicas.use_replicas():
+            self.assertEqual(Post.objects.count(), 1)
+            with replicas.use_primary():
+                self.assertEqual(Post.objects.count(), 2)
+            with transaction.atomic():
+                self.assertEqual(Post.objects.count(), 2)
+            replicas.sync("replica")
+            self.assertEqual(Post.objects.count(), 2)
+
+    @override_settings(REPLICA_PIN_SECONDS=0)
+    def test_reads_from_replica(self):
+        response = self.client.get(reverse("posts:profile", kwargs={"username": "sarah"}))
+        self.assertContains(response, "Synced post")
+        self.assertNotContains(response, "Fresh post")
+        self.assertNotIn(replicas.PIN_COOKIE, response.cookies)
+
+    def test_read_your_writes(self):
+        url = reverse("posts:post", kwargs={"username": "sarah", "post_id": self.post.id})
+        response = self.client.post(
+            reverse("posts:add_comment", kwargs={"username": "sarah", "post_id": self.post.id}),
+            {"text": "My comment"})
+        self.assertEqual(response.cookies[replicas.PIN_COOKIE]["max-age"], replicas.PIN_SECONDS)
+        self.assertContains(self.client.get(url), "My comment")
+
+        #  кука истекла, а реплику ещё не обновили
+        del self.client.cookies[replicas.PIN_COOKIE]
+        cache.clear()
+        with override_settings(REPLICA_PIN_SECONDS=0):
+            self.assertNotContains(self.client.get(url), "My comment")
+
+    def test_pin_after_follow(self):
+        #  подписка — GET-запрос, но тоже пишет
+        response = self.client.get(reverse("posts:profile_follow", kwargs={"username": "sarah"}))
+        self.assertIn(replicas.PIN_COOKIE, response.cookies)
+
+    def test_cache_fills_from_primary(self):
+        #  кэши живут дольше отставания реплики и заполняются с основной базы
+        User.objects.create_user(username="fresh", password="12345")
+        with replicas.use_replicas():
+            self.assertIsNotNone(identity.get("fresh"))
+            self.assertEqual(Post.objects.count(), 1)
+
+    def test_pull_from_primary(self):
+        follows.follow(self.kyle.id, self.sarah.id)
+        replicas.sync("replica")
+        fresh = Post.objects.create(text="Celebrity post", author=self.sarah)
+        #  как в начале запроса: ReplicaMiddleware сбрасывает отметку
+        replicas._state.wrote = False
+        with mock.patch.object(timeline, "CELEBRITY_FOLLOWERS", 0), replicas.use_replicas():
+            timeline.pull_celebrities(self.kyle.id)
+            #  дозапись ленты не закрепляет читателя за основной базой
+            self.assertFalse(replicas._state.wrote)
+        self.assertTrue(Timeline.objects.filter(user=self.kyle, post=fresh).exists())
+
+    @override_settings(REPLICA_PIN_SECONDS=0)
+    def test_metrics_count_replica_queries(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.addCleanup(metrics.registry.reset)
+        with override_settings(METRICS_DIR=directory):
+            metrics.registry.reset()
+            with CaptureQueriesContext(connection) as primary, \
+                    CaptureQueriesContext(connections["replica"]) as replica:
+                self.client.get(reverse("posts:profile", kwargs={"username": "sarah"}))
+            self.assertGreater(len(replica), 0)
+            self.assertEqual(metrics.snapshot()["posts:profile"][metrics.DB_QUERIES], len(primary) + len(replica))
+
+
+class QueryPlanTest(TestCase):
+    """ни один запрос страниц posts/views.py не должен читать таблицу
+    целиком или сортировать во временном B-дереве"""
+    #  эти адреса меняют данные
+    SKIP = {"profile_follow", "profile_unfollow", "follow_bulk", "add_comment"}
+
+    def setUp(self):
+        cache.clear()
+        #  bulk_create в SQLite не возвращает id — перечитываем
+        User.objects.bulk_create(User(username="user%s" % number) for number in range(20))
+        Group.objects.bulk_create(
+            Group(title="group%s" % number, slug="group%s" % number, description="group") for number in range(4))
+        users, groups = list(User.objects.order_by("id")), list(Group.objects.order_by("id"))
+        start = timezone.now() - timedelta(days=30)
+        with bulk.keep_auto_now(Post, "pub_date"), bulk.keep_auto_now(Comment, "created"):
+            Post.objects.bulk_create(
+                Post(text="post %s" % number, author=users[number % len(users)],
+                     group=groups[number % 5] if number % 5 < len(groups) else None,
+                     pub_date=start + timedelta(minutes=number)) for number in range(2000))
+            posts = list(Post.objects.order_by("id"))
+            Comment.objects.bulk_create(
+                Comment(post=posts[number % 50], author=users[number % len(users)], text="comment",
+                        created=start + timedelta(minutes=number)) for number in range(1000))
+        Follow.objects.bulk_create(Follow(user=user, author=author) for user in users for author in users[:5]
+                                   if user != author)
+        bulk.rebuild_derived()
+        self.reader = users[-1]
+        self.kwargs = {"username": users[0].username, "post_id": posts[0].id, "slug": groups[0].slug}
+
+    def plans(self, queries):
+        """строки плана, в которых таблица читается целиком или
+        результат сортируется, и запрос, к которому они относятся"""
+        for query in queries:
+            sql = query["sql"]
+            #  целиком читаются только запросы без условий — списки
+            #  сообществ в форме; результаты поиска сортируются по
+            #  релевантности, её не положить в индекс
+            if not sql.lstrip().upper().startswith(("SELECT", "WITH")) or " WHERE " not in sql:
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql)
+                plan = [row[-1] for row in cursor.fetchall()]
+            for line in plan:
+                if "TEMP B-TREE" in line and "bm25(" not in sql:
+                    yield line, sql
+                if not line.startswith("SCAN ") or "VIRTUAL TABLE" in line:
+                    continue
+                #  проход по индексу ключа сортировки до LIMIT годится для
+                #  лент "всё подряд", но условие на равенство должно
+                #  сужать выборку префиксом индекса (SEARCH), а не
+                #  отсеивать строки по дороге
+                table = line.split()[1]
+                if " USING " not in line or re.search(r'"%s"\."[^"]+" (= |IN \()' % re.escape(table), sql):
+                    yield line, sql
+
+    def check(self, url):
+        #  страницу из кэша база не собирает
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        #  страницы для авторов отвечают остальным перенаправлением
+        self.assertIn(response.status_code, (200, 302), url)
+        for line, sql in self.plans(queries.captured_queries):
+            self.fail("%s: %s\n%s" % (url, line, sql))
+        return response
+
+    def check_all(self):
+        for pattern in urlpatterns:
+            if not pattern.name or pattern.name in self.SKIP:
+                continue
+            kwargs = {name: self.kwargs[name] for name in pattern.pattern.converters}
+            url = reverse("%s:%s" % (app_name, pattern.name), kwargs=kwargs)
+            if pattern.name == "search":
+                url += "?q=post"
+            response = self.check(url)
+            #  и следующая страница: выборка от курсора
+            page = (response.context or {}).get("page") or (response.context or {}).get("comments")
+            if page is not None and page.next_cursor:
+                self.check("%s%safter=%s" % (url, "&" if "?" in url else "?", page.next_cursor))
+
+    def test_anonymous(self):
+        self.check_all()
+
+    def test_reader(self):
+        self.client.force_login(self.reader)
+        #  авторы с подписчиками подтягиваются в ленту при чтении
+        with mock.patch.object(timeline, "CELEBRITY_FOLLOWERS", 1):
+            self.check_all()
+
+    def test_analyzed(self):
+        #  со статистикой ANALYZE планировщик выбирает иначе
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        self.client.force_login(self.reader)
+        self.check_all()
+
+
+class PurgeTest(TestCase):
+    """проверка массового удаления пользователей, сообществ и постов"""
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media, THUMBNAIL_ASYNC=False)
+        self.settings_override.enable()
+        self.author = User.objects.create_user(username="sarah", email="connor.s@skynet.com", password="12345")
+        self.reader = User.objects.create_user(username="john", email="connor.j@skynet.com", password="12345")
+        self.group = Group.objects.create(title="Resistance", slug="resistance")
+        follows.follow(self.reader.id, self.author.id)
+        follows.follow(self.author.id, self.reader.id)
+        self.posts = [Post.objects.create(text="Post %s" % i, author=self.author, group=self.group)
+                      for i in range(7)]
+        self.own = Post.objects.create(text="John's", author=self.reader, group=self.group)
+        Comment.objects.create(post=self.own, author=self.author, text="Hi")
+        Comment.objects.create(post=self.posts[0], author=self.reader, text="Hello")
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media, ignore_errors=True)
+
+    def test_user(self):
+        self.assertEqual(identity.get("sarah").id, self.author.id)
+        [version] = cache_scopes.generations("profile:%s" % self.reader.id)
+        deleted = purge.purge(User, [self.author.pk], chunk_size=3)
+
+        self.assertFalse(User.objects.filter(username="sarah").exists())
+        self.assertEqual(list(Post.objects.all()), [self.own])
+        self.assertFalse(Comment.objects.exists())
+        self.assertFalse(Follow.objects.exists())
+        self.assertFalse(Timeline.objects.filter(author=self.author).exists())
+        self.assertEqual(deleted["posts.Post"], 7)
+        self.assertEqual(deleted["auth.User"], 1)
+        #  счётчики и кэш тех, кого удаление задело
+        counter = UserCounter.objects.get(user=self.reader)
+        self.assertEqual((counter.posts, counter.followers, counter.following), (1, 0, 0))
+        self.own.refresh_from_db()
+        self.assertEqual(self.own.comment_count, 0)
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.post_count, 1)
+        self.assertIsNone(identity.get("sarah"))
+        self.assertNotEqual(cache_scopes.generations("profile:%s" % self.reader.id), [version])
+
+    def test_group(self):
+        purge.purge(Group, [self.group.pk], chunk_size=3)
+        self.assertFalse(Group.objects.exists())
+        self.assertFalse(Post.objects.exists())
+        self.assertFalse(Timeline.objects.exists())
+        self.assertEqual(UserCounter.objects.get(user=self.author).posts, 0)
+        self.assertEqual(UserCounter.objects.get(user=self.author).followers, 1)
+
+    def test_count_matches_run(self):
+        job = purge.Purge(User, [self.author.pk])
+        counts = job.count()
+        self.assertTrue(User.objects.filter(pk=self.author.pk).exists())
+        deleted = job.run()
+        self.assertEqual({label: n for label, n in counts.items() if n}, deleted)
+
+    def test_files(self):
+        post = Post.objects.create(text="Photo", author=self.reader, image=make_image())
+        #  та же картинка у поста, который остаётся
+        Post.objects.create(text="Same photo", author=self.author, image=post.image.name)
+        other = Post.objects.create(text="Other photo", author=self.reader, image=make_image("other.png", color="blue"))
+        other.refresh_from_db()
+        purge.purge(Post, [post.pk, other.pk])
+        self.assertFalse(os.path.exists(os.path.join(self.media, other.image_thumb.name)))
+        #  картинку без ссылок стирает сборка мусора
+        self.assertEqual(Blob.objects.get(name=other.image.name).refs, 0)
+        self.assertEqual(Blob.objects.get(name=post.image.name).refs, 1)
+        blobs.collect(grace=0)
+        self.assertTrue(os.path.exists(os.path.join(self.media, post.image.name)))
+        self.assertFalse(os.path.exists(os.path.join(self.media, other.image.name)))
+
+    def test_admin(self):
+        User.objects.create_superuser(username="admin", email="admin@yatube.ru", password="12345")
+        self.client.login(username="admin", password="12345")
+        url = "/admin/auth/user/%s/delete/" % self.author.pk
+        response = self.client.get(url)
+        self.assertContains(response, "sarah")
+        self.assertNotContains(response, "Post 3")
+        self.client.post(url, {"post": "yes"})
+        self.assertFalse(User.objects.filter(pk=self.author.pk).exists())
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_admin_permissions(self):
+        #  права на удаление зависимых записей проверяются, как без purge
+        staff = User.objects.create_user(username="staff", password="12345", is_staff=True)
+        staff.user_permissions.add(Permission.objects.get(codename="delete_user"),
+                                   Permission.objects.get(codename="view_user"))
+        self.client.login(username="staff", password="12345")
+        url = "/admin/auth/user/%s/delete/" % self.author.pk
+        response = self.client.get(url)
+        self.assertIn(Post._meta.verbose_name, response.context["perms_lacking"])
+        self.assertEqual(self.client.post(url, {"post": "yes"}).status_code, 403)
+        self.assertTrue(User.objects.filter(pk=self.author.pk).exists())
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command("purge", "group", "resistance", "--dry-run", stdout=out)
+        self.assertIn("posts.Post: 8", out.getvalue())
+        self.assertTrue(Group.objects.exists())
+        call_command("purge", "group", "resistance", stdout=out, stderr=io.StringIO())
+        self.assertFalse(Group.objects.exists())
+
+
+class MediaStorageTest(TestCase):
+    """проверка хранилища картинок по содержимому и сборки мусора"""
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media, THUMBNAIL_ASYNC=False, CACHES=TEST_CACHE)
+        self.settings_override.enable()
+        self.user = User.objects.create_user(username="sarah", email="connor.s@skynet.com", password="12345")
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media, ignore_errors=True)
+
+    def upload(self, image):
+        self.client.post('/new/', {'text': 'Text', 'image': image})
+        return Post.objects.latest("id")
+
+    def files(self):
+        return sorted(os.path.relpath(os.path.join(root, name), self.media)
+                      for root, _, names in os.walk(self.media) for name in names)
+
+    def test_same_content_stored_once(self):
+        first = self.upload(make_image("meme.png"))
+        with mock.patch.object(thumbnails, "_encode", side_effect=AssertionError("rendered again")):
+            second = self.upload(make_image("meme-copy.png"))
+        self.assertEqual(first.image.name, second.image.name)
+        with open(first.image.path, "rb") as fp:
+            digest = hashlib.sha256(fp.read()).hexdigest()
+        self.assertEqual(first.image.name, "posts/%s/%s.png" % (digest[:2], digest))
+        #  миниатюры общие и готовы сразу
+        self.assertEqual(second.image_thumb.name, first.image_thumb.name)
+        self.assertEqual(Blob.objects.get(name=first.image.name).refs, 2)
+        self.assertEqual(len(self.files()), 4)
+
+    def test_content_not_from_upload(self):
+        name = post_images.save("posts/notes.PNG", io.BytesIO(b"not really a picture"))
+        self.assertEqual(name, post_images.save("posts/again.png", io.BytesIO(b"not really a picture")))
+        self.assertTrue(name.endswith(".png"))
+        self.assertEqual(self.files(), [name])
+
+    def test_refs_follow_edits_and_deletes(self):
+        post = self.upload(make_image())
+        old = post.image.name
+        self.client.post('/sarah/%s/edit/' % post.id, {'text': 'Text', 'image': make_image(color="blue")})
+        post.refresh_from_db()
+        self.assertEqual(Blob.objects.get(name=old).refs, 0)
+        self.assertEqual(Blob.objects.get(name=post.image.name).refs, 1)
+        post.delete()
+        self.assertEqual(Blob.objects.get(name=post.image.name).refs, 0)
+
+    def test_collect(self):
+        kept = self.upload(make_image())
+        gone = self.upload(make_image(color="blue"))
+        gone.delete()
+        untracked = post_images.save("posts/lost.png", io.BytesIO(b"lost"))
+        #  свежие файлы не трогаем
+        self.assertEqual(blobs.collect(), (0, 0))
+        removed, freed = blobs.collect(grace=0)
+        self.assertEqual(removed, 2)
+        self.assertGreater(freed, 0)
+        self.assertFalse(Blob.objects.filter(name=gone.image.name).exists())
+        self.assertEqual(self.files(), sorted([kept.image.name, *thumbnails.variant_names(kept.image.name).values()]))
+        self.assertNotIn(untracked, self.files())
+
+    def test_collect_rechecks(self):
+        post = self.upload(make_image())
+        post.delete()
+        #  ссылка появилась после пересчёта, а счётчик её не видел
+        Post.objects.bulk_create([Post(text="Copy", author=self.user, image=post.image.name)])
+        with mock.patch.object(blobs, "reconcile"):
+            self.assertEqual(blobs.collect(grace=0), (0, 0))
+        Post.objects.filter(image=post.image.name).update(image="")
+        #  загрузка того же содержимого обновила дату после обхода
+        with mock.patch.object(blobs, "_stale", return_value=True):
+            self.assertEqual(blobs.collect(grace=60), (0, 0))
+        self.assertTrue(os.path.exists(post.image.path))
+        self.assertTrue(Blob.objects.filter(name=post.image.name, refs=0).exists())
+        self.assertEqual(blobs.collect(grace=0)[0], 1)
+        self.assertFalse(os.path.exists(post.image.path))
+
+    def test_save_after_collect(self):
+        name = post_images.save("posts/notes.png", io.BytesIO(b"notes"))
+
+        def collected(path):
+            #  collect_media забрал файл между проверкой и обновлением даты
+            os.unlink(path)
+            raise FileNotFoundError(path)
+
+        with mock.patch("yatube.storage.os.utime", collected):
+            self.assertEqual(post_images.save("posts/again.png", io.BytesIO(b"notes")), name)
+        self.assertEqual(self.files(), [name])
+
+    def test_reconcile(self):
+        post = self.upload(make_image())
+        Post.objects.bulk_create([Post(text="Copy", author=self.user, image=post.image.name)] * 2)
+        Blob.objects.all().delete()
+        self.assertEqual(blobs.reconcile(), 1)
+        self.assertEqual(Blob.objects.get(name=post.image.name).refs, 3)
+        self.assertEqual(blobs.reconcile(), 0)
+        call_command("collect_media", "--grace", "0", stdout=io.StringIO())
+        self.assertTrue(os.path.exists(post.image.path))
@@ -0,0 +1,151 @@
+"""Фоновая подготовка картинок постов.
+
+После сохранения поста с новой картинкой пул потоков строит обрезанную
+миниатюру для ленты, её WebP-вариант и уменьшенный оригинал. Шаблоны
+берут готовые URL из полей поста и не обращаются к Pillow.
+"""
+import hashlib
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from PIL import Image, ImageOps
+
+from posts import cache
+from posts.models import Post
+from yatube.storage import HASHED_NAME, TEMP_PREFIX
+
+logger = logging.getLogger(__name__)
+
+#  размер карточки в ленте, как раньше в {% thumbnail %} post_item.html
+THUMB_SIZE = (960, 339)
+#  длинная сторона уменьшенного оригинала
+PREVIEW_SIZE = 1920
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+THUMBS_DIR = "posts/thumbs"
+#  длина полей image_thumb, image_webp и image_preview
+MAX_NAME_LENGTH = Post._meta.get_field("image_thumb").max_length
+
+_executor = None
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=getattr(settings, "THUMBNAIL_WORKERS", 2),
+                                       thread_name_prefix="thumbnails")
+    return _executor
+
+
+def variant_name(image_name, suffix, extension):
+    """имя производного файла выводится из полного имени оригинала вместе
+    с расширением: у разных оригиналов разные и миниатюры"""
+    stem = image_name[len("posts/"):] if image_name.startswith("posts/") else image_name
+    name = "%s/%s_%s.%s" % (THUMBS_DIR, stem, suffix, extension)
+    if len(name) > MAX_NAME_LENGTH:
+        #  длинное имя не влезает в поле поста — берём хэш имени
+        stem = hashlib.sha256(image_name.encode()).hexdigest()
+        name = "%s/%s_%s.%s" % (THUMBS_DIR, stem, suffix, extension)
+    return name
+
+
+def _encode(image, format, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **options)
+    return ContentFile(buffer.getvalue())
+
+
+def _store(name, content):
+    """пишет вариант под именем name, заменяя прежний файл: имя оригинала
+    могли занять заново после удаления"""
+    temp_name = default_storage.save(os.path.join(os.path.dirname(name), TEMP_PREFIX), content)
+    #  os.replace подменяет файл целиком — читатели не видят недописанного
+    os.replace(default_storage.path(temp_name), default_storage.path(name))
+    return name
+
+
+def variant_names(image_name):
+    """поле поста -> имя варианта картинки image_name"""
+    size = "%sx%s" % THUMB_SIZE
+    return {
+        "image_thumb": variant_name(image_name, size, "jpg"),
+        "image_webp": variant_name(image_name, size, "webp"),
+        "image_preview": variant_name(image_name, "preview", "jpg"),
+    }
+
+
+def cached_variants(image_name):
+    """готовые варианты, если все они уже построены для такой же картинки;
+    только у картинок с именем из хэша содержимого имя определяет байты"""
+    if not HASHED_NAME.search(image_name):
+        return None
+    names = variant_names(image_name)
+    if all(default_storage.exists(name) for name in names.values()):
+        return names
+    return None
+
+
+def render_variants(image_name):
+    """строит варианты картинки; возвращает значения полей поста"""
+    cached = cached_variants(image_name)
+    if cached is not None:
+        #  картинки в хранилище по содержимому: такую уже загружали
+        return cached
+    with default_storage.open(image_name) as fp:
+        image = Image.open(fp)
+        image = ImageOps.exif_transpose(image).convert("RGB")
+
+    thumb = ImageOps.fit(image, THUMB_SIZE, method=Image.LANCZOS, centering=(0.5, 0.5))
+    preview = image.copy()
+    preview.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE), Image.LANCZOS)
+
+    names = variant_names(image_name)
+    return {
+        "image_thumb": _store(names["image_thumb"],
+                              _encode(thumb, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)),
+        "image_webp": _store(names["image_webp"], _encode(thumb, "WEBP", quality=WEBP_QUALITY, method=4)),
+        "image_preview": _store(names["image_preview"],
+                                _encode(preview, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)),
+    }
+
+
+def build(post_id):
+    """готовит варианты картинки поста и записывает их в пост"""
+    try:
+        row = Post.objects.filter(pk=post_id).values_list("image", "author_id", "group_id").first()
+        if row is None or not row[0]:
+            return
+        image_name, author_id, group_id = row
+        fields = render_variants(image_name)
+        #  картинку могли заменить, пока шла обработка, — тогда не трогаем пост
+        if Post.objects.filter(pk=post_id, image=image_name).update(**fields):
+            #  закэшированные ленты показывают пост ещё без миниатюры
+            cache.bump(*cache.post_scopes(author_id, group_id, post_id))
+    except Exception:
+        logger.exception("Не удалось подготовить картинку поста %s", post_id)
+
+
+def _build_in_worker(post_id):
+    try:
+        build(post_id)
+    finally:
+        #  у потока пула своё соединение с базой
+        connection.close()
+
+
+def schedule(post):
+    """ставит пост в очередь на обработку после коммита транзакции"""
+    if not post.image:
+        return
+    #  у повторной загрузки варианты уже есть — пул не нужен
+    if not getattr(settings, "THUMBNAIL_ASYNC", True) or cached_variants(post.image.name):
+        build(post.pk)
+        return
+    post_id = post.pk
+    transaction.on_commit(lambda: _pool().submit(_build_in_worker, post_id))
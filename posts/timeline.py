@@ -0,0 +1,149 @@
+"""Материализованная лента подписок (fan-out on write).
+
+Новый пост сразу раскладывается в ленты подписчиков автора, поэтому
+страница /follow/ читается одним диапазоном по индексу Timeline.
+Посты "звёзд" (авторов с огромным числом подписчиков) не раскладываются
+при записи — подписчики подтягивают их к себе при чтении ленты, не чаще
+раза в PULL_INTERVAL секунд.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.db import connection
+from django.utils import timezone
+
+from posts import cache
+from posts.models import Post, Follow, Timeline, UserCounter
+from yatube import replicas
+
+CELEBRITY_FOLLOWERS = getattr(settings, "TIMELINE_CELEBRITY_FOLLOWERS", 10000)
+BACKFILL = getattr(settings, "TIMELINE_BACKFILL", 500)
+#  как часто чтение ленты подтягивает посты звёзд: между подтягиваниями
+#  /follow/ остаётся одним чтением диапазона
+PULL_INTERVAL = getattr(settings, "TIMELINE_PULL_INTERVAL", 30)
+BATCH_SIZE = 1000
+#  перекрытие окна подтягивания: пост мог получить pub_date раньше отметки,
+#  а закоммититься позже
+PULL_OVERLAP = timedelta(seconds=5)
+
+
+def _entries(user_ids, posts):
+    return [
+        Timeline(user_id=user_id, post_id=post.id, author_id=post.author_id, pub_date=post.pub_date)
+        for user_id in user_ids for post in posts
+    ]
+
+
+def _bulk_insert(entries):
+    #  повторная раскладка того же поста не должна падать на unique_together
+    Timeline.objects.bulk_create(entries, ignore_conflicts=True)
+
+
+def fan_out(post):
+    """раскладывает новый пост в ленты подписчиков автора"""
+    if UserCounter.objects.filter(user_id=post.author_id, followers__gt=CELEBRITY_FOLLOWERS).exists():
+        #  у звезды подписчики заберут пост сами при чтении
+        return
+    #  счётчик мог отстать — длину списка подписчиков всё равно ограничиваем
+    followers = list(Follow.objects.filter(author_id=post.author_id)
+                     .values_list("user_id", flat=True)[:CELEBRITY_FOLLOWERS + 1])
+    if len(followers) > CELEBRITY_FOLLOWERS:
+        #  у звезды подписчики заберут пост сами при чтении
+        return
+    for start in range(0, len(followers), BATCH_SIZE):
+        _bulk_insert(_entries(followers[start:start + BATCH_SIZE], [post]))
+
+
+BACKFILL_SQL = """
+    INSERT INTO posts_timeline (user_id, post_id, author_id, pub_date)
+    SELECT %%s, id, author_id, pub_date
+    FROM (SELECT id, author_id, pub_date,
+                 ROW_NUMBER() OVER (PARTITION BY author_id ORDER BY pub_date DESC) AS n
+          FROM posts_post WHERE author_id IN (%s)) p
+    WHERE n <= %%s
+    ON CONFLICT DO NOTHING
+"""
+
+
+def backfill(user_id, author_ids):
+    """после подписки докладывает в ленту последние посты авторов"""
+    if not author_ids:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(BACKFILL_SQL % ", ".join(["%s"] * len(author_ids)),
+                       [user_id, *author_ids, BACKFILL])
+
+
+def prune(user_id, author_ids):
+    """после отписки убирает посты авторов из ленты"""
+    Timeline.objects.filter(user_id=user_id, author_id__in=author_ids).delete()
+
+
+def celebrity_ids(user_id):
+    """авторы-звёзды, на которых подписан пользователь"""
+    return list(Follow.objects.filter(user_id=user_id, author__counter__followers__gt=CELEBRITY_FOLLOWERS)
+                .values_list("author_id", flat=True))
+
+
+def pull_celebrities(user_id):
+    """fan-out on read: подтягивает в ленту свежие посты звёзд"""
+    #  add атомарен: из параллельных чтений ленты подтягивает одно
+    if not django_cache.add("timeline:pulling:%s" % user_id, True, PULL_INTERVAL):
+        return
+    #  отметка сдвигается до now, поэтому посты читаются с основной базы:
+    #  отставание реплики больше PULL_OVERLAP, и пропущенные посты не
+    #  попали бы в ленту никогда; дозапись ленты не должна закреплять
+    #  читателя за основной базой
+    with replicas.housekeeping():
+        _pull(user_id)
+
+
+def _pull(user_id):
+    marker = "timeline:pulled:%s" % user_id
+    pulled = django_cache.get(marker)
+    now = timezone.now()
+    authors = celebrity_ids(user_id)
+    entries = []
+    for author_id in authors:
+        #  запрос на автора — диапазон индекса (author, pub_date); с IN по
+        #  всем звёздам SQLite сортировал бы их посты во временном B-дереве
+        posts = Post.objects.filter(author_id=author_id).order_by("-pub_date", "-id")
+        if pulled is not None:
+            posts = posts.filter(pub_date__gt=pulled - PULL_OVERLAP)
+        #  без отметки (новый пользователь или вытесненный ключ кэша)
+        #  докладываем окно последних постов, вставка идемпотентна
+        entries += _entries([user_id], posts.only("id", "author_id", "pub_date")[:BACKFILL])
+    if entries:
+        _bulk_insert(entries)
+        #  фрагмент ленты мог закэшироваться до подтягивания
+        cache.bump("follow:%s" % user_id)
+    django_cache.set(marker, now, None)
+
+
+def feed(user):
+    """лента подписок пользователя, новые записи сверху"""
+    pull_celebrities(user.id)
+    return (Timeline.objects.filter(user=user)
+            .select_related("post", "post__author", "post__group")
+            .order_by("-pub_date", "-post_id"))
+
+
+REBUILD_SQL = """
+    INSERT INTO posts_timeline (user_id, post_id, author_id, pub_date)
+    SELECT f.user_id, p.id, p.author_id, p.pub_date
+    FROM posts_follow f
+    JOIN (SELECT id, author_id, pub_date,
+                 ROW_NUMBER() OVER (PARTITION BY author_id ORDER BY pub_date DESC) AS n
+          FROM posts_post) p ON p.author_id = f.author_id AND p.n <= %s
+    WHERE true
+    ON CONFLICT DO NOTHING
+"""
+
+
+def rebuild():
+    """пересобирает все ленты одним запросом, например после массовой
+    загрузки данных в обход сигналов"""
+    Timeline.objects.all().delete()
+    with connection.cursor() as cursor:
+        cursor.execute(REBUILD_SQL, [BACKFILL])
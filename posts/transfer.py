@@ -0,0 +1,258 @@
+"""Выгрузка и загрузка содержимого сайта в формате NDJSON.
+
+Каждая строка — один JSON-объект с полем "type": user, group, post,
+comment или follow, в таком порядке, чтобы ссылки шли после того, на что
+они ссылаются. Пользователи и сообщества связываются по имени и slug,
+посты — по id из выгрузки: при загрузке в непустую базу они получают
+новые id, а соответствие старых и новых хранится во временной таблице
+SQLite, а не в памяти процесса. Файлы картинок не выгружаются — только
+их имена в хранилище.
+
+Выгрузка читает таблицы порциями по первичному ключу, загрузка пишет
+порциями, каждая порция — в своей транзакции, поэтому память не растёт с
+размером данных. Посты, комментарии и подписки вставляются одним
+executemany без создания объектов моделей: на сотнях тысяч строк именно
+они, а не база, занимали большую часть времени. Сигналы при этом не
+посылаются — после загрузки производные данные пересчитываются
+(posts.bulk).
+"""
+import json
+import re
+from datetime import datetime
+from itertools import groupby
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.utils import timezone
+
+from posts.bulk import batches
+from posts.models import Post, Group, Comment, Follow
+
+User = get_user_model()
+
+#  каждая порция — транзакция и fsync при коммите; 5000 строк — около
+#  мегабайта в памяти
+BATCH_SIZE = 5000
+TYPES = ("user", "group", "post", "comment", "follow")
+
+#  что и в каком порядке выгружается: тип, запрос, поля строки
+EXPORTS = (
+    ("user", User.objects.all(),
+     ("username", "first_name", "last_name", "email", "date_joined")),
+    ("group", Group.objects.all(),
+     ("slug", "title", "description")),
+    ("post", Post.objects.all(),
+     ("id", ("author", "author__username"), ("group", "group__slug"), "text", "pub_date", "image")),
+    ("comment", Comment.objects.all(),
+     (("post", "post_id"), ("author", "author__username"), "text", "created")),
+    ("follow", Follow.objects.all(),
+     (("user", "user__username"), ("author", "author__username"), "created")),
+)
+
+#  дата выгрузки в UTC (datetime.isoformat): в базу SQLite с USE_TZ она
+#  пишется той же строкой, только с пробелом вместо "T" и без смещения
+UTC_ISOFORMAT = re.compile(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d{6})?\+00:00\Z")
+
+MAP_TABLE = "transfer_post_ids"
+STAGE_TABLE = "transfer_rows"
+
+
+def _rows(queryset, lookups, batch_size):
+    #  порции по первичному ключу: не держим открытым курсор на всю таблицу
+    last = None
+    while True:
+        page = queryset.order_by("pk")
+        if last is not None:
+            page = page.filter(pk__gt=last)
+        rows = list(page.values_list("pk", *lookups)[:batch_size])
+        if not rows:
+            return
+        for row in rows:
+            yield row[1:]
+        last = rows[-1][0]
+
+
+def _value(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+def export(batch_size=BATCH_SIZE):
+    """строки NDJSON со всем содержимым сайта"""
+    for kind, queryset, fields in EXPORTS:
+        names = [field if isinstance(field, str) else field[0] for field in fields]
+        lookups = [field if isinstance(field, str) else field[1] for field in fields]
+        for row in _rows(queryset, lookups, batch_size):
+            record = {"type": kind}
+            record.update(zip(names, map(_value, row)))
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def _datetime_preparer():
+    """значение для базы из даты выгрузки (строки ISO 8601) — как
+    adapt_datetimefield_value, но без проверок на каждое значение, а даты
+    в UTC и вовсе без разбора: на сотнях тысяч дат разбор и пересчёт
+    занимали заметную долю загрузки"""
+    zone = connection.timezone if settings.USE_TZ else None
+    if connection.vendor != "sqlite" or zone is None:
+        return lambda value: connection.ops.adapt_datetimefield_value(value and datetime.fromisoformat(value))
+    utc = zone == timezone.utc
+
+    def prepare(value):
+        if value is None:
+            return None
+        if utc and UTC_ISOFORMAT.match(value):
+            return value[:-6].replace("T", " ", 1)
+        value = datetime.fromisoformat(value)
+        if value.tzinfo is not None:
+            value = value.astimezone(zone).replace(tzinfo=None)
+        return str(value)
+    return prepare
+
+
+def _insert(model, fields, rows, ignore_conflicts=False):
+    """вставляет строки (значения полей fields по порядку, даты — строками
+    ISO 8601 из выгрузки); остальные поля получают значения по умолчанию"""
+    given = [model._meta.get_field(name) for name in fields]
+    rest = [field for field in model._meta.concrete_fields
+            if field not in given and not field.primary_key]
+    defaults = [field.get_db_prep_save(field.get_default(), connection) for field in rest]
+    #  преобразовывать для базы нужно только даты, остальное уже готово
+    dates = [index for index, field in enumerate(given) if field.get_internal_type() == "DateTimeField"]
+    prepare = _datetime_preparer()
+    values = []
+    for row in rows:
+        if dates:
+            row = list(row)
+            for index in dates:
+                row[index] = prepare(row[index])
+        values.append(row)
+    stage = ["c%s" % index for index in range(len(given))]
+    columns = ", ".join(connection.ops.quote_name(field.column) for field in given + rest)
+    #  строки сначала ложатся во временную таблицу без индексов и триггеров,
+    #  а в основную переходят одним INSERT ... SELECT: индексы и триггер
+    #  полнотекстового поиска обновляются в одной инструкции, а не в
+    #  инструкции на строку
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS temp.%s" % STAGE_TABLE)
+        cursor.execute("CREATE TEMP TABLE %s (%s)" % (STAGE_TABLE, ", ".join(stage)))
+        cursor.executemany("INSERT INTO temp.%s VALUES (%s)" % (STAGE_TABLE, ", ".join(["%s"] * len(stage))),
+                           values)
+        #  порядок строк сохраняется: по нему _inserted_ids сопоставляет id
+        cursor.execute("INSERT %sINTO %s (%s) SELECT %s FROM temp.%s ORDER BY rowid" % (
+            "OR IGNORE " if ignore_conflicts else "", model._meta.db_table, columns,
+            ", ".join(stage + ["%s"] * len(rest)), STAGE_TABLE), defaults)
+
+
+def _inserted_ids(model, count):
+    """id только что вставленных строк по порядку вставки: SQLite не
+    возвращает их из bulk_create. Пока транзакция открыта, база заблокирована
+    на запись, и последние count строк — наши"""
+    ids = list(model.objects.order_by("-pk").values_list("pk", flat=True)[:count])
+    ids.reverse()
+    return ids
+
+
+class Importer:
+    """загрузка NDJSON; progress(kind, done) вызывается после каждой порции"""
+
+    def __init__(self, batch_size=BATCH_SIZE, progress=None):
+        self.batch_size = batch_size
+        self.progress = progress or (lambda kind, done: None)
+        self.created = dict.fromkeys(TYPES, 0)
+        self.skipped = dict.fromkeys(TYPES, 0)
+        #  у загруженных пользователей нет пароля, войти они не смогут
+        self.password = make_password(None)
+
+    def run(self, lines):
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS %s "
+                           "(old INTEGER PRIMARY KEY, new INTEGER NOT NULL)" % MAP_TABLE)
+        try:
+            records = (json.loads(line) for line in lines if line.strip())
+            for kind, group in groupby(records, key=lambda record: record.get("type")):
+                if kind not in TYPES:
+                    raise ValueError("неизвестный тип записи: %r" % kind)
+                done = 0
+                for batch in batches(group, self.batch_size):
+                    with transaction.atomic():
+                        created = getattr(self, "_" + kind)(batch)
+                    self.created[kind] += created
+                    self.skipped[kind] += len(batch) - created
+                    done += len(batch)
+                    self.progress(kind, done)
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("DROP TABLE IF EXISTS temp.%s" % MAP_TABLE)
+                cursor.execute("DROP TABLE IF EXISTS temp.%s" % STAGE_TABLE)
+        return self.created
+
+    def _users(self, usernames):
+        return dict(User.objects.filter(username__in=set(usernames)).values_list("username", "id"))
+
+    def _user(self, batch):
+        existing = self._users(record["username"] for record in batch)
+        users = [User(username=record["username"], first_name=record.get("first_name") or "",
+                      last_name=record.get("last_name") or "", email=record.get("email") or "",
+                      date_joined=datetime.fromisoformat(record["date_joined"]), password=self.password)
+                 for record in batch if record["username"] not in existing]
+        User.objects.bulk_create(users, ignore_conflicts=True)
+        return len(users)
+
+    def _group(self, batch):
+        existing = set(Group.objects.filter(slug__in=[record["slug"] for record in batch])
+                       .values_list("slug", flat=True))
+        groups = [Group(slug=record["slug"], title=record["title"], description=record["description"])
+                  for record in batch if record["slug"] not in existing]
+        Group.objects.bulk_create(groups, ignore_conflicts=True)
+        return len(groups)
+
+    def _post(self, batch):
+        authors = self._users(record["author"] for record in batch)
+        groups = dict(Group.objects.filter(slug__in={record["group"] for record in batch if record["group"]})
+                      .values_list("slug", "id"))
+        posts, old_ids = [], []
+        for record in batch:
+            author_id = authors.get(record["author"])
+            if author_id is None or (record["group"] and record["group"] not in groups):
+                continue
+            posts.append((author_id, groups.get(record["group"]), record["text"],
+                          record["pub_date"], record.get("image") or None))
+            old_ids.append(record["id"])
+        if not posts:
+            return 0
+        _insert(Post, ("author", "group", "text", "pub_date", "image"), posts)
+        with connection.cursor() as cursor:
+            cursor.executemany("INSERT OR REPLACE INTO temp.%s (old, new) VALUES (%%s, %%s)" % MAP_TABLE,
+                               list(zip(old_ids, _inserted_ids(Post, len(posts)))))
+        return len(posts)
+
+    def _post_ids(self, old_ids):
+        old_ids = list(set(old_ids))
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT old, new FROM temp.%s WHERE old IN (%s)"
+                           % (MAP_TABLE, ", ".join(["%s"] * len(old_ids))), old_ids)
+            return dict(cursor.fetchall())
+
+    def _comment(self, batch):
+        posts = self._post_ids(record["post"] for record in batch)
+        authors = self._users(record["author"] for record in batch)
+        comments = [(posts[record["post"]], authors[record["author"]], record["text"], record["created"])
+                    for record in batch if record["post"] in posts and record["author"] in authors]
+        _insert(Comment, ("post", "author", "text", "created"), comments)
+        return len(comments)
+
+    def _follow(self, batch):
+        users = self._users([record["user"] for record in batch] + [record["author"] for record in batch])
+        follows = {(users[record["user"]], users[record["author"]]): record.get("created") for record in batch
+                   if record["user"] in users and record["author"] in users and record["user"] != record["author"]}
+        existing = set(Follow.objects.filter(user_id__in={user for user, author in follows},
+                                             author_id__in={author for user, author in follows})
+                       .values_list("user_id", "author_id"))
+        rows = sorted((user, author, created or None)
+                      for (user, author), created in follows.items() if (user, author) not in existing)
+        _insert(Follow, ("user", "author", "created"), rows, ignore_conflicts=True)
+        return len(rows)
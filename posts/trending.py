@@ -0,0 +1,167 @@
+"""Горячие посты и сообщества.
+
+Популярность — сумма событий (публикация, комментарий, новый подписчик
+автора), каждое из которых затухает вдвое за TRENDING_HALF_LIFE. Хранится
+её логарифм, отсчитанный от общей точки EPOCH:
+
+    hot_score = ln Σ wᵢ·e^(λ·(tᵢ − EPOCH))
+
+У всех постов затухание в каждый момент одинаковое, поэтому порядок по
+hot_score совпадает с порядком по текущей популярности, а значение не
+нужно пересчитывать со временем. Новое событие прибавляется одним
+UPDATE (hot = logaddexp(hot, ln w + λ·t)), а первые K записей читаются
+по индексу на hot_score без агрегации комментариев.
+"""
+import bisect
+import math
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Count, F, Value
+from django.db.models.functions import Abs, Exp, Greatest, Ln
+from django.utils import timezone
+
+from posts.models import Post, Group, Comment, Follow
+
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+HALF_LIFE = getattr(settings, "TRENDING_HALF_LIFE", 24 * 60 * 60)
+DECAY = math.log(2) / HALF_LIFE
+
+#  веса событий
+POST_WEIGHT = 1.0
+COMMENT_WEIGHT = 2.0
+FOLLOW_WEIGHT = 3.0
+#  новый подписчик поднимает посты автора не старше этого
+FOLLOW_WINDOW = 2 * HALF_LIFE
+BATCH_SIZE = 1000
+
+
+def event_score(weight, when=None):
+    """логарифм вклада события в момент when"""
+    when = when or timezone.now()
+    return math.log(weight) + DECAY * (when - EPOCH).total_seconds()
+
+
+def logaddexp(a, b):
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+
+def _add(queryset, score):
+    #  logaddexp в SQL: max(a, b) + ln(1 + e^-|a - b|)
+    value = Value(score)
+    return queryset.update(hot_score=Greatest(F("hot_score"), value)
+                           + Ln(1 + Exp(-Abs(F("hot_score") - value))))
+
+
+def post_created(post):
+    """сам пост получает оценку ещё до сохранения (posts.signals),
+    здесь публикация засчитывается сообществу"""
+    if post.group_id is not None:
+        _add(Group.objects.filter(pk=post.group_id), post.hot_score)
+
+
+def comment_created(comment, group_id):
+    score = event_score(COMMENT_WEIGHT, comment.created)
+    _add(Post.objects.filter(pk=comment.post_id), score)
+    if group_id is not None:
+        _add(Group.objects.filter(pk=group_id), score)
+
+
+def authors_followed(author_ids):
+    """новые подписчики поднимают свежие посты авторов и их сообщества"""
+    now = timezone.now()
+    score = event_score(FOLLOW_WEIGHT, now)
+    posts = Post.objects.filter(author_id__in=author_ids, pub_date__gte=now - timedelta(seconds=FOLLOW_WINDOW))
+    _add(posts, score)
+    #  сообщество получает событие за каждый поднятый пост — как сумма
+    #  оценок его постов в rebuild
+    boosted = posts.exclude(group=None).order_by().values_list("group_id").annotate(n=Count("pk"))
+    for group_id, count in boosted:
+        _add(Group.objects.filter(pk=group_id), score + math.log(count))
+
+
+def trending_posts():
+    """посты по убыванию популярности"""
+    return Post.objects.select_related("author", "group").order_by("-hot_score", "-id")
+
+
+def hot_groups(limit=10):
+    return list(Group.objects.filter(post_count__gt=0).order_by("-hot_score")[:limit])
+
+
+def _seconds(when):
+    return (when - EPOCH).total_seconds()
+
+
+def _follows():
+    """даты подписок по авторам (секунды от EPOCH, по возрастанию) и
+    префиксные логарифмы сумм их вкладов"""
+    authors = {}
+    rows = (Follow.objects.exclude(created=None).order_by("author_id", "created")
+            .values_list("author_id", "created").iterator())
+    for author_id, created in rows:
+        times, prefix = authors.setdefault(author_id, ([], [None]))
+        times.append(_seconds(created))
+        score = math.log(FOLLOW_WEIGHT) + DECAY * times[-1]
+        prefix.append(score if prefix[-1] is None else logaddexp(prefix[-1], score))
+    return authors
+
+
+def _followed_score(times, prefix, pub_date):
+    """логарифм суммы вкладов подписок, которые подняли пост: сделанных не
+    позже FOLLOW_WINDOW после публикации; None, если таких нет"""
+    start = _seconds(pub_date)
+    lo = bisect.bisect_left(times, start)
+    hi = bisect.bisect_right(times, start + FOLLOW_WINDOW)
+    if lo == hi:
+        return None
+    if prefix[lo] is None:
+        return prefix[hi]
+    #  ln(e^b − e^a) = b + ln(1 − e^(a − b))
+    share = math.exp(prefix[lo] - prefix[hi])
+    if share < 1 - 1e-9:
+        return prefix[hi] + math.log1p(-share)
+    #  вклад отрезка теряется в округлении разности — складываем его сами
+    total = None
+    for when in times[lo:hi]:
+        score = math.log(FOLLOW_WEIGHT) + DECAY * when
+        total = score if total is None else logaddexp(total, score)
+    return total
+
+
+def rebuild():
+    """пересчитывает популярность по публикациям, комментариям и
+    подпискам, например после массовой загрузки данных; подписки без даты
+    не учитываются"""
+    follows = _follows()
+    scores = {}
+    groups = {}
+    rows = Post.objects.values_list("pk", "group_id", "pub_date", "author_id").iterator()
+    for pk, group_id, pub_date, author_id in rows:
+        scores[pk] = event_score(POST_WEIGHT, pub_date)
+        groups[pk] = group_id
+        if author_id in follows:
+            followed = _followed_score(*follows[author_id], pub_date)
+            if followed is not None:
+                scores[pk] = logaddexp(scores[pk], followed)
+    for post_id, created in Comment.objects.values_list("post_id", "created").iterator():
+        scores[post_id] = logaddexp(scores[post_id], event_score(COMMENT_WEIGHT, created))
+
+    group_scores = {}
+    for pk, score in scores.items():
+        group_id = groups[pk]
+        if group_id is not None:
+            group_scores[group_id] = (logaddexp(group_scores[group_id], score)
+                                      if group_id in group_scores else score)
+
+    _store(Post, scores)
+    Group.objects.update(hot_score=0)
+    _store(Group, group_scores)
+
+
+def _store(model, scores):
+    items = sorted(scores.items())
+    for start in range(0, len(items), BATCH_SIZE):
+        model.objects.bulk_update([model(pk=pk, hot_score=score) for pk, score in items[start:start + BATCH_SIZE]],
+                                  ["hot_score"])
@@ -6,14 +6,24 @@ app_name = 'posts'
 urlpatterns = [
     path("group/<slug>/", views.group_posts, name="group"),
     path("new/", views.new_post, name="new_post"),
+    # служебные страницы живут под "_/": адрес из двух частей не совпадёт
+    # с профилем, а "_/<слово>/" — с постом, у которого id число
+    # популярные посты и сообщества
+    path("_/trending/", views.trending_index, name="trending"),
+    # поиск по постам
+    path("_/search/", views.search, name="search"),
     # страница просмотра подписок
     path("follow/", views.follow_index, name="follow_index"),
+    # массовая подписка и отписка
+    path("follow/bulk/", views.follow_bulk, name="follow_bulk"),
     # Профайл пользователя
     path("<username>/", views.profile, name="profile"),
     # Просмотр записи
     path("<username>/<int:post_id>/", views.post_view, name="post"), 
     path("<username>/<int:post_id>/edit/", views.post_edit, name="post_edit"),
     path("<username>/<int:post_id>/comment/", views.add_comment, name="add_comment"),
+    # порция комментариев для "Показать ещё"
+    path("<username>/<int:post_id>/comments/", views.post_comments, name="post_comments"),
     path("", views.index, name="index"),
     path("<username>/follow/", views.profile_follow, name="profile_follow"), 
     path("<username>/unfollow/", views.profile_unfollow, name="profile_unfollow"),
@@ -1,38 +1,96 @@
 
 from django.shortcuts import render, get_object_or_404, redirect
-from django.contrib.auth import get_user_model
-from django.core.paginator import Paginator
-from posts.models import Post, Group, Comment, Follow
+from posts.models import Post, Group, Comment
 from .forms import PostForm, CommentForm
+from . import counters, follows, graph, identity, pagecache, recommendations, timeline, trending, writes
+from .paginator import CursorPaginator
+from .cache import feed_cache
+from .search import search as search_posts
 from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse
+from django.views.decorators.http import require_POST
+import json
 
-User = get_user_model()
 
+def feed_posts():
+    """посты вместе с автором и группой, которые показывает post_item.html;
+    число комментариев хранится в самом посте"""
+    return Post.objects.select_related("author", "group")
 
+
+def _user_id(username):
+    user = identity.get(username)
+    return user and user.id
+
+
+def _index_scopes(request):
+    return ["posts"]
+
+
+@pagecache.conditional(_index_scopes)
+@pagecache.anonymous_cache
 def index(request):
-    post_list = Post.objects.order_by("-pub_date").all()
+    post_list = feed_posts().order_by("-pub_date").all()
     follow = False
 
     if request.user.is_authenticated:
-        follow = Follow.objects.filter(user=request.user).exists() 
+        follow = graph.following_count(request.user.id) > 0
         
-    paginator = Paginator(post_list, 10) #  показывать по 10 записей на странице.
-    page_number = request.GET.get('page') #  переменная в URL с номером запрошенной страницы
-    page = paginator.get_page(page_number) #  получить записи с нужным смещением
+    paginator = CursorPaginator(post_list, 10) #  показывать по 10 записей на странице.
+    #  курсоры в URL: after — записи старше, before — новее
+    page = paginator.get_page(request.GET.get('after'), request.GET.get('before'))
 
-    return render(request, 'index.html', {'page': page, 'paginator': paginator, 'follow':follow})
+    return render(request, 'index.html', {'page': page, 'paginator': paginator, 'follow':follow,
+        'feed_cache': feed_cache(request, page, "index", "posts")})
 
 
+def _group_scopes(request, slug):
+    group_id = Group.objects.filter(slug=slug).values_list("id", flat=True).first()
+    if group_id is not None:
+        return ["group:%s" % group_id]
+
+
+@pagecache.conditional(_group_scopes)
+@pagecache.anonymous_cache
 def group_posts(request, slug):
     """view-функция для страницы сообщества"""
     group = get_object_or_404(Group, slug=slug) 
-    posts = Post.objects.filter(group=group).order_by("-pub_date").all()
+    posts = feed_posts().filter(group=group).order_by("-pub_date").all()
+
+    paginator = CursorPaginator(posts, 10) 
+    page = paginator.get_page(request.GET.get('after'), request.GET.get('before'))
+
+    return render(request, "group.html", {"group": group, "posts": posts, 'page': page, 'paginator': paginator,
+        'feed_cache': feed_cache(request, page, "group", "group:%s" % group.id)})
 
-    paginator = Paginator(posts, 10) 
-    page_number = request.GET.get('page') 
-    page = paginator.get_page(page_number)
 
-    return render(request, "group.html", {"group": group, "posts": posts, 'page': page, 'paginator': paginator})
+def search(request):
+    """поиск по постам с фильтрами по сообществу и автору"""
+    query = request.GET.get('q', '').strip()
+    group = author = None
+    if request.GET.get('group'):
+        group = get_object_or_404(Group, slug=request.GET['group'])
+    if request.GET.get('author'):
+        author = identity.get_or_404(request.GET['author'])
+
+    page = search_posts(feed_posts(), query, group_id=group and group.id, author_id=author and author.id,
+        per_page=10, after=request.GET.get('after'), before=request.GET.get('before'))
+
+    #  параметры поиска сохраняются в ссылках паджинатора
+    params = request.GET.copy()
+    params.pop('after', None)
+    params.pop('before', None)
+
+    return render(request, "search.html", {'query': query, 'group': group, 'author': author, 'page': page,
+        'query_string': params.urlencode()})
+
+
+def trending_index(request):
+    """популярные посты и сообщества"""
+    paginator = CursorPaginator(trending.trending_posts(), 10, ordering=("-hot_score", "-id"))
+    page = paginator.get_page(request.GET.get('after'), request.GET.get('before'))
+    return render(request, "trending.html", {'page': page, 'paginator': paginator,
+        'groups': trending.hot_groups()})
 
 
 @login_required
@@ -54,35 +112,73 @@ def new_post(request):
     return render(request, 'new.html', {'form': form, 'title':"Добавить запись", 'button':"Добавить"})
 
 
+def _profile_scopes(request, username):
+    author_id = _user_id(username)
+    if author_id is not None:
+        return ["author:%s" % author_id, "profile:%s" % author_id]
+
+
+@pagecache.conditional(_profile_scopes)
+@pagecache.anonymous_cache
 def profile(request, username):
-    author = get_object_or_404(User, username=username)
-    posts = Post.objects.filter(author=author).order_by("-pub_date").all()
+    author = identity.get_or_404(username)
+    posts = feed_posts().filter(author=author).order_by("-pub_date").all()
     following = False
 
     if request.user.is_authenticated:
-        following = Follow.objects.filter(user=request.user, author=author).exists()
+        following = graph.is_following(request.user.id, author.id)
     
-    paginator = Paginator(posts, 10) 
-    page_number = request.GET.get('page') 
-    page = paginator.get_page(page_number)
-    page_count = posts.count()
+    paginator = CursorPaginator(posts, 10) 
+    page = paginator.get_page(request.GET.get('after'), request.GET.get('before'))
+    counter = counters.for_user(author)
     
-    return render(request, "profile.html", {'posts':posts, 'page_count':page_count, 'page': page, 'paginator': paginator, 
-        'author':author, 'following':following})
+    return render(request, "profile.html", {'posts':posts, 'page_count':counter.posts, 'counter':counter,
+        'page': page, 'paginator': paginator, 'author':author, 'following':following,
+        'recommendations': recommendations.for_user(request.user, exclude={author.id}),
+        'feed_cache': feed_cache(request, page, "profile", "author:%s" % author.id)})
+
+
+def _post_scopes(request, username, post_id):
+    author_id = _user_id(username)
+    #  у несуществующего поста нет валидатора, иначе клиент с подходящим
+    #  If-None-Match получил бы 304 вместо 404
+    if author_id is not None and Post.objects.filter(id=post_id, author_id=author_id).exists():
+        return ["post:%s" % post_id, "author:%s" % author_id, "profile:%s" % author_id]
 
 
+@pagecache.conditional(_post_scopes)
+@pagecache.anonymous_cache
 def post_view(request, username, post_id):
-    post = get_object_or_404(Post, id=post_id)
-    author = get_object_or_404(User, username=username)
+    post = get_object_or_404(Post.objects.select_related("author", "group"), id=post_id)
+    author = identity.get_or_404(username)
 
     form = CommentForm()
-    comments = post.comment_post.all()
-    comment_count = comments.count()
-
-    page_count = Post.objects.filter(author=author).count()
+    comments = comments_page(post.id, request.GET.get('after'))
+    counter = counters.for_user(author)
     
-    return render(request, "post.html", {'post':post, 'page_count':page_count, 'post_id':post_id, 'author':author, 
-        'form':form, 'comments':comments, 'comment_count':comment_count})
+    return render(request, "post.html", {'post':post, 'page_count':counter.posts, 'counter':counter, 'post_id':post_id,
+        'author':author, 'form':form, 'comments':comments, 'comment_count':post.comment_count})
+
+
+#  сколько комментариев показывать за раз
+COMMENTS_PER_PAGE = 20
+
+
+def comments_page(post_id, after=None):
+    """страница комментариев поста, старые сверху; авторы загружаются
+    тем же запросом"""
+    comments = Comment.objects.filter(post_id=post_id).select_related("author")
+    paginator = CursorPaginator(comments, COMMENTS_PER_PAGE, ordering=("created", "id"))
+    return paginator.get_page(after)
+
+
+def post_comments(request, username, post_id):
+    """следующая порция комментариев для кнопки "Показать ещё" """
+    #  как и страница поста: 404, если поста нет или он не этого автора
+    author = identity.get_or_404(username)
+    get_object_or_404(Post.objects.only("id"), id=post_id, author_id=author.id)
+    comments = comments_page(post_id, request.GET.get('after'))
+    return render(request, "comment_list.html", {'comments':comments, 'username':username, 'post_id':post_id})
 
 
 def post_edit(request, username, post_id):
@@ -116,9 +212,9 @@ def server_error(request):
 
 @login_required
 def add_comment(request, username, post_id):
-    post = get_object_or_404(Post, pk=post_id)
+    post = get_object_or_404(Post.objects.select_related("author", "group"), pk=post_id)
     form = CommentForm(instance=post)
-    comments = post.comment_post.all()
+    comments = comments_page(post.id)
 
     if request.method == 'POST':
         form = CommentForm(request.POST)
@@ -127,7 +223,8 @@ def add_comment(request, username, post_id):
             comment = form.save(commit=False)
             comment.author = request.user
             comment.post = post
-            comment.save()
+            #  при WRITE_COALESCING комментарии пишутся партиями
+            writes.submit(comment.save)
             return redirect('posts:post', username=post.author, post_id=post_id)
         return render(request, 'post.html', {'form': form, 'post':post, 'comments':comments})
         
@@ -137,37 +234,65 @@ def add_comment(request, username, post_id):
 @login_required
 def follow_index(request):
     """страница просмотра подписок"""
-    follow = get_object_or_404(User, username=request.user.username) #кто подписывается
-    #  получаю посты авторов, на которых подписан user 
-    post_list = Post.objects.filter(author__following__user=follow).order_by("-pub_date").all()
+    follow = request.user #кто подписывается
+    #  материализованная лента: посты авторов, на которых подписан user
+    post_list = timeline.feed(follow)
 
-    paginator = Paginator(post_list, 10) 
-    page_number = request.GET.get('page') 
-    page = paginator.get_page(page_number)
+    paginator = CursorPaginator(post_list, 10, ordering=("-pub_date", "-post_id")) 
+    page = paginator.get_page(request.GET.get('after'), request.GET.get('before'))
 
-    return render(request, "follow.html", {'page': page, 'paginator': paginator})
+    return render(request, "follow.html", {'page': page, 'paginator': paginator,
+        'recommendations': recommendations.for_user(follow),
+        'feed_cache': feed_cache(request, page, "follow", "posts", "follow:%s" % follow.id)})
 
 
 @login_required
 def profile_follow(request, username):
-    follower = get_object_or_404(User, username=request.user.username) #  кто подписывается
-    follow = get_object_or_404(User, username=username) #  на кого подписывается
-
-    if follower != follow:
-
-        uniq = Follow.objects.filter(user=follower, author=follow).count()
-        if uniq:
-            return redirect('posts:profile', username=username)
-        Follow.objects.create(user=follower, author=follow)
-        
+    author = identity.get_or_404(username) #  на кого подписывается
+    #  один INSERT: повторная подписка и подписка на себя ничего не делают
+    writes.submit(follows.follow, request.user.id, author.id)
     return redirect('posts:profile', username=username)
 
 
 @login_required
 def profile_unfollow(request, username):
-    follower = get_object_or_404(User, username=request.user.username) #  кто отписывается
-    unfollow = get_object_or_404(User, username=username) #  от кого отписывается
-    
-    Follow.objects.filter(user=follower, author=unfollow).delete()
+    author = identity.get_or_404(username) #  от кого отписывается
+    writes.submit(follows.unfollow, request.user.id, author.id)
+    return redirect('posts:profile', username=username)
 
-    return redirect('posts:profile', username=username)
\ No newline at end of file
+
+#  сколько авторов можно передать в одном запросе follow_bulk
+FOLLOW_BULK_LIMIT = 500
+
+
+@login_required
+@require_POST
+def follow_bulk(request):
+    """подписка или отписка сразу от многих авторов (импорт при регистрации);
+    принимает JSON {"action": "follow"|"unfollow", "authors": [username, ...]}
+    или форму с теми же полями"""
+    if request.content_type == "application/json":
+        try:
+            data = json.loads(request.body.decode())
+            action, usernames = data.get("action", "follow"), data.get("authors", [])
+        except (ValueError, AttributeError):
+            return JsonResponse({"error": "некорректный JSON"}, status=400)
+    else:
+        action, usernames = request.POST.get("action", "follow"), request.POST.getlist("authors")
+    if action not in ("follow", "unfollow"):
+        return JsonResponse({"error": "action: follow или unfollow"}, status=400)
+    if not isinstance(usernames, list) or not all(isinstance(name, str) for name in usernames):
+        return JsonResponse({"error": "authors: список имён пользователей"}, status=400)
+    if len(usernames) > FOLLOW_BULK_LIMIT:
+        return JsonResponse({"error": "не больше %s авторов за раз" % FOLLOW_BULK_LIMIT}, status=400)
+
+    ids = {user.id: name for name, user in identity.get_many(usernames).items()}
+    if action == "follow":
+        changed = follows.follow_many(request.user.id, list(ids))
+    else:
+        changed = follows.unfollow_many(request.user.id, list(ids))
+    found = set(ids.values())
+    return JsonResponse({
+        action + "ed": sorted(ids[author_id] for author_id in changed),
+        "not_found": sorted(set(usernames) - found),
+    })
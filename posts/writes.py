@@ -0,0 +1,141 @@
+"""Объединение мелких записей в общие транзакции.
+
+В SQLite пишет один процесс за раз, и каждая транзакция заканчивается
+fsync. Когда комментарии и подписки приходят одновременно из многих
+запросов, они стоят в очереди к блокировке записи и каждый платит за
+свой коммит. При WRITE_COALESCING = True submit() передаёт запись
+потоку-писателю процесса: тот собирает до WRITE_BATCH_SIZE записей,
+пришедших за WRITE_BATCH_LINGER секунд, выполняет их в одной транзакции
+(каждую — в своей точке сохранения, чтобы ошибка одной не отменяла
+остальные) и после коммита возвращает результаты ожидающим запросам.
+
+Запрос ждёт результата не дольше WRITE_TIMEOUT секунд: если запись к
+этому времени не началась, она отменяется, а запрос получает
+TimeoutError. Умерший поток-писатель заменяется новым при следующей
+записи.
+
+Без настройки и внутри уже открытой транзакции запись выполняется сразу:
+объединять её не с чем, а ответ должен видеть свои изменения.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+from yatube import replicas
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+#  сколько ждать попутных записей после первой, секунд
+LINGER = 0.002
+#  сколько запрос ждёт своей записи, секунд
+TIMEOUT = 30
+
+_lock = threading.Lock()
+_writer = None
+
+
+class Writer:
+    def __init__(self, batch_size, linger):
+        self.batch_size = batch_size
+        self.linger = linger
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.loop, name="writes", daemon=True)
+        self.thread.start()
+
+    def alive(self):
+        return self.pid == os.getpid() and self.thread.is_alive()
+
+    def submit(self, func, args):
+        future = Future()
+        self.queue.put((func, args, future))
+        return future
+
+    def collect(self):
+        """первая запись — без ограничения ожидания, остальные — пока не
+        наберётся партия или не пройдёт linger"""
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def loop(self):
+        while True:
+            batch = self.collect()
+            try:
+                close_old_connections()
+                run_batch(batch)
+                #  сломанное соединение закроется и откроется к следующей партии
+                close_old_connections()
+            except Exception as error:
+                #  поток не должен умирать: его очереди ждут другие запросы
+                logger.exception("Поток-писатель не обработал партию из %s записей", len(batch))
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+
+def run_batch(batch):
+    """выполняет записи [(func, args, future)] в одной транзакции; future
+    получают результат только после коммита"""
+    done = []
+    try:
+        with transaction.atomic():
+            for func, args, future in batch:
+                #  запрос перестал ждать и отменил запись
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with transaction.atomic():
+                        result = func(*args)
+                except Exception as error:
+                    future.set_exception(error)
+                else:
+                    done.append((future, result))
+    except Exception as error:
+        #  не удался сам коммит — не записалось ничего
+        logger.exception("Не удалось записать партию из %s записей", len(batch))
+        for future, result in done:
+            future.set_exception(error)
+        return
+    for future, result in done:
+        future.set_result(result)
+
+
+def _get_writer():
+    global _writer
+    with _lock:
+        #  после fork поток родителя в дочернем процессе не работает, а
+        #  упавший поток не разберёт свою очередь
+        if _writer is None or not _writer.alive():
+            _writer = Writer(getattr(settings, "WRITE_BATCH_SIZE", BATCH_SIZE),
+                             getattr(settings, "WRITE_BATCH_LINGER", LINGER))
+        return _writer
+
+
+def submit(func, *args):
+    """выполняет func(*args) — сразу или в общей транзакции потока-писателя —
+    и возвращает результат"""
+    #  запрос, который пишет, следующие чтения делает с основной базы
+    replicas.mark_written()
+    if not getattr(settings, "WRITE_COALESCING", False) or connection.in_atomic_block:
+        return func(*args)
+    future = _get_writer().submit(func, args)
+    try:
+        return future.result(getattr(settings, "WRITE_TIMEOUT", TIMEOUT))
+    except TimeoutError:
+        #  не начатая запись не выполнится позже, когда запрос уже ответил
+        future.cancel()
+        raise
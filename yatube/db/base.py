@@ -0,0 +1,86 @@
+"""Бэкенд SQLite с настройками для работы под нагрузкой.
+
+Тот же django.db.backends.sqlite3, но каждое соединение при открытии
+получает PRAGMA из OPTIONS["pragmas"] (по умолчанию PRAGMAS):
+
+* journal_mode=WAL — читатели не ждут писателя и друг друга;
+* synchronous=NORMAL — в режиме WAL fsync только при checkpoint, после
+  сбоя питания теряются последние транзакции, но база остаётся целой;
+* cache_size, mmap_size, temp_store — страницы и временные таблицы в
+  памяти;
+* busy_timeout — сколько ждать чужую блокировку записи.
+
+Транзакции начинаются с BEGIN IMMEDIATE: блокировка записи берётся сразу,
+и два писателя не упираются друг в друга при повышении блокировки чтения
+до записи (такой SQLITE_BUSY busy_timeout не лечит). Отдельные запросы
+вне транзакции при "database is locked" повторяются с растущей паузой.
+"""
+import random
+import time
+
+from django.db.backends.sqlite3 import base
+
+Database = base.Database
+
+PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    #  отрицательное значение — в килобайтах: 64 МБ страничного кэша
+    "cache_size": -64000,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "memory",
+    "busy_timeout": 5000,
+}
+#  повторы запроса вне транзакции, пауза удваивается от RETRY_DELAY
+RETRIES = 5
+RETRY_DELAY = 0.01
+
+
+def _busy(error):
+    message = str(error)
+    return "database is locked" in message or "database is busy" in message
+
+
+class CursorWrapper(base.SQLiteCursorWrapper):
+    def _retry(self, method, *args):
+        delay = RETRY_DELAY
+        for attempt in range(RETRIES + 1):
+            try:
+                return method(self, *args)
+            except Database.OperationalError as error:
+                #  внутри транзакции повтор одного запроса ничего не даст:
+                #  её целиком откатит и повторит вызывающий код
+                if attempt == RETRIES or self.connection.in_transaction or not _busy(error):
+                    raise
+            time.sleep(delay * (1 + random.random()))
+            delay *= 2
+
+    def execute(self, query, params=None):
+        return self._retry(base.SQLiteCursorWrapper.execute, query, params)
+
+    def executemany(self, query, param_list):
+        return self._retry(base.SQLiteCursorWrapper.executemany, query, param_list)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        params.pop("pragmas", None)
+        params.pop("immediate", None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        pragmas = dict(PRAGMAS, **self.settings_dict["OPTIONS"].get("pragmas", {}))
+        for name, value in pragmas.items():
+            connection.execute("PRAGMA %s = %s" % (name, value))
+        return connection
+
+    def create_cursor(self, name=None):
+        return self.connection.cursor(factory=CursorWrapper)
+
+    def _start_transaction_under_autocommit(self):
+        if self.settings_dict["OPTIONS"].get("immediate", True):
+            self.cursor().execute("BEGIN IMMEDIATE")
+        else:
+            super()._start_transaction_under_autocommit()
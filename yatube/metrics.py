@@ -0,0 +1,378 @@
+"""Лёгкие метрики запросов для продакшена.
+
+MetricsMiddleware для каждого view (posts:index, posts:profile, ...)
+считает запросы, гистограмму времени ответа, число и время SQL-запросов,
+попадания и промахи кэша, время рендера шаблонов и работу защиты от
+одновременных пересчётов (posts.cache.get_or_compute).
+
+Каждый процесс пишет свои счётчики в собственный файл, отображённый в
+память (mmap), в каталоге METRICS_DIR — без блокировок между воркерами и
+без системных вызовов на запрос. Адрес /_/metrics/ складывает файлы всех
+процессов и отдаёт результат в текстовом формате Prometheus.
+"""
+import bisect
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from time import perf_counter_ns
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template.backends.django import DjangoTemplates
+from django.utils.module_loading import import_string
+
+MAGIC = b"YTM1"
+MAX_VIEWS = 128
+NAME_SIZE = 64
+#  границы корзин гистограммы времени ответа, в микросекундах
+BUCKETS = (1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000, 2500000)
+FIELDS = ("requests", "errors", "latency_us", "db_queries", "db_time_us",
+          "cache_hits", "cache_misses", "template_us",
+          "cache_stale", "cache_collapsed", "cache_early")
+#  счётчики слота: FIELDS, затем корзины гистограммы (последняя — +Inf)
+SLOT_FIELDS = len(FIELDS) + len(BUCKETS) + 1
+HEADER = struct.Struct("<4sII")
+NAMES_OFFSET = HEADER.size
+VALUES_OFFSET = NAMES_OFFSET + MAX_VIEWS * NAME_SIZE
+FILE_SIZE = VALUES_OFFSET + MAX_VIEWS * SLOT_FIELDS * 8
+
+(REQUESTS, ERRORS, LATENCY, DB_QUERIES, DB_TIME,
+ CACHE_HITS, CACHE_MISSES, TEMPLATE,
+ CACHE_STALE, CACHE_COLLAPSED, CACHE_EARLY) = range(len(FIELDS))
+
+
+def metrics_dir():
+    return getattr(settings, "METRICS_DIR", os.path.join(tempfile.gettempdir(), "yatube-metrics"))
+
+
+class Segment:
+    """файл счётчиков одного процесса"""
+
+    def __init__(self, path, create=False):
+        self.path = path
+        mode = "w+b" if create else "rb"
+        with open(path, mode) as fp:
+            if create:
+                fp.truncate(FILE_SIZE)
+                fp.write(HEADER.pack(MAGIC, MAX_VIEWS, SLOT_FIELDS))
+                fp.flush()
+            access = mmap.ACCESS_WRITE if create else mmap.ACCESS_READ
+            self.buffer = mmap.mmap(fp.fileno(), FILE_SIZE, access=access)
+        self.values = memoryview(self.buffer)[VALUES_OFFSET:].cast("Q")
+
+    def valid(self):
+        return HEADER.unpack_from(self.buffer) == (MAGIC, MAX_VIEWS, SLOT_FIELDS)
+
+    def name(self, slot):
+        raw = self.buffer[NAMES_OFFSET + slot * NAME_SIZE:NAMES_OFFSET + (slot + 1) * NAME_SIZE]
+        return raw.rstrip(b"\0").decode("utf-8", "replace")
+
+    def set_name(self, slot, name):
+        raw = name.encode()[:NAME_SIZE]
+        start = NAMES_OFFSET + slot * NAME_SIZE
+        self.buffer[start:start + NAME_SIZE] = raw.ljust(NAME_SIZE, b"\0")
+
+    def close(self):
+        self.values.release()
+        self.buffer.close()
+
+
+class Registry:
+    """счётчики текущего процесса"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.segment = None
+        self.slots = {}
+
+    def _open(self):
+        directory = metrics_dir()
+        os.makedirs(directory, exist_ok=True)
+        _remove_dead(directory)
+        self.pid = os.getpid()
+        self.segment = Segment(os.path.join(directory, "metrics-%s.bin" % self.pid), create=True)
+        self.slots = {}
+
+    def slot(self, view):
+        slot = self.slots.get(view)
+        if slot is None:
+            with self.lock:
+                slot = self.slots.get(view)
+                if slot is None:
+                    #  свободные слоты кончились — копим в последнем
+                    slot = min(len(self.slots), MAX_VIEWS - 1)
+                    self.segment.set_name(slot, view if slot < MAX_VIEWS - 1 else "<other>")
+                    self.slots[view] = slot
+        return slot
+
+    def reset(self):
+        self.pid = None
+
+    def record(self, view, status, latency_us, stats):
+        if self.pid is None:
+            with self.lock:
+                if self.pid is None:
+                    self._open()
+        slot = self.slots.get(view)
+        if slot is None:
+            slot = self.slot(view)
+        base = slot * SLOT_FIELDS
+        bucket = base + len(FIELDS) + bisect.bisect_left(BUCKETS, latency_us)
+        #  словарь потока читается один раз, а не на каждый счётчик
+        counts = stats.__dict__
+        queries, db_ns, hits, misses, template_ns = (
+            counts["queries"], counts["db_ns"], counts["cache_hits"], counts["cache_misses"], counts["template_ns"])
+        stale, collapsed, early = counts["cache_stale"], counts["cache_collapsed"], counts["cache_early"]
+        values = self.segment.values
+        #  += над ячейкой — чтение и запись в несколько шагов байткода: без
+        #  блокировки параллельные потоки теряют обновления; нулевые
+        #  прибавки пропускаем — проверка дешевле записи в файл
+        with self.lock:
+            values[base + REQUESTS] += 1
+            values[base + LATENCY] += latency_us
+            values[bucket] += 1
+            if queries:
+                values[base + DB_QUERIES] += queries
+                values[base + DB_TIME] += db_ns // 1000
+            if hits:
+                values[base + CACHE_HITS] += hits
+            if misses:
+                values[base + CACHE_MISSES] += misses
+            if template_ns:
+                values[base + TEMPLATE] += template_ns // 1000
+            if status >= 500:
+                values[base + ERRORS] += 1
+            if stale or collapsed or early:
+                values[base + CACHE_STALE] += stale
+                values[base + CACHE_COLLAPSED] += collapsed
+                values[base + CACHE_EARLY] += early
+
+
+registry = Registry()
+#  после fork у воркера свой файл; проверять pid на каждом запросе дорого
+os.register_at_fork(after_in_child=registry.reset)
+
+
+def _remove_dead(directory):
+    """файлы завершившихся процессов больше не растут — убираем их"""
+    for name in os.listdir(directory):
+        if not (name.startswith("metrics-") and name.endswith(".bin")):
+            continue
+        try:
+            os.kill(int(name[8:-4]), 0)
+        except (ValueError, ProcessLookupError):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+        except PermissionError:
+            pass
+
+
+def snapshot():
+    """сумма счётчиков всех процессов: {view: [значения слота]}"""
+    totals = {}
+    directory = metrics_dir()
+    if not os.path.isdir(directory):
+        return totals
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith("metrics-") and name.endswith(".bin")):
+            continue
+        try:
+            segment = Segment(os.path.join(directory, name))
+        except (OSError, ValueError):
+            continue
+        try:
+            if not segment.valid():
+                continue
+            for slot in range(MAX_VIEWS):
+                view = segment.name(slot)
+                if not view:
+                    continue
+                row = totals.setdefault(view, [0] * SLOT_FIELDS)
+                base = slot * SLOT_FIELDS
+                for index in range(SLOT_FIELDS):
+                    row[index] += segment.values[base + index]
+        finally:
+            segment.close()
+    return totals
+
+
+_ZERO = {
+    "queries": 0,
+    "db_ns": 0,
+    "cache_hits": 0,
+    "cache_misses": 0,
+    "template_ns": 0,
+    #  отдано устаревшее значение, пока его пересчитывает другой запрос
+    "cache_stale": 0,
+    #  дождались значения, которое считал другой запрос
+    "cache_collapsed": 0,
+    #  значение пересчитано заранее, до истечения срока
+    "cache_early": 0,
+}
+
+
+class _Stats(threading.local):
+    """счётчики текущего запроса в текущем потоке"""
+
+    def __init__(self):
+        #  вызывается в каждом потоке при первом обращении
+        self.reset()
+
+    def reset(self):
+        #  одна запись в словарь потока дешевле восьми присваиваний
+        self.__dict__.update(_ZERO)
+
+
+stats = _Stats()
+
+
+def _count_query(execute, sql, params, many, context):
+    started = perf_counter_ns()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_ns += perf_counter_ns() - started
+
+
+def _install(sender, connection, **kwargs):
+    """считает запросы каждого нового соединения — у каждого потока и
+    каждой базы (в том числе реплик, yatube.replicas) оно своё"""
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+connection_created.connect(_install)
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        #  соединения, открытые до загрузки middleware
+        for connection in connections.all():
+            _install(None, connection)
+
+    def __call__(self, request):
+        stats.reset()
+        started = perf_counter_ns()
+        response = self.get_response(request)
+        latency_us = (perf_counter_ns() - started) // 1000
+        match = request.resolver_match
+        registry.record(match.view_name if match else "<unresolved>", response.status_code, latency_us, stats)
+        return response
+
+
+class MeteredTemplates(DjangoTemplates):
+    """шаблонный движок Django, замеряющий время рендера страниц"""
+
+    def from_string(self, template_code):
+        return _MeteredTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return _MeteredTemplate(super().get_template(template_name))
+
+
+class _MeteredTemplate:
+    def __init__(self, template):
+        self.template = template
+
+    @property
+    def origin(self):
+        return self.template.origin
+
+    def render(self, context=None, request=None):
+        started = perf_counter_ns()
+        try:
+            return self.template.render(context, request)
+        finally:
+            stats.template_ns += perf_counter_ns() - started
+
+
+_MISSING = object()
+
+
+class MeteredCache:
+    """обёртка над бэкендом кэша, считающая попадания и промахи;
+    настоящий бэкенд указывается в OPTIONS["BACKEND"]"""
+
+    def __init__(self, location, params):
+        params = dict(params)
+        options = dict(params.pop("OPTIONS", {}))
+        backend = options.pop("BACKEND")
+        params["OPTIONS"] = options
+        self._cache = import_string(backend)(location, params)
+
+    def get(self, key, default=None, version=None):
+        value = self._cache.get(key, _MISSING, version=version)
+        if value is _MISSING:
+            stats.cache_misses += 1
+            return default
+        stats.cache_hits += 1
+        return value
+
+    def get_many(self, keys, version=None):
+        found = self._cache.get_many(keys, version=version)
+        stats.cache_hits += len(found)
+        stats.cache_misses += len(keys) - len(found)
+        return found
+
+    def __getattr__(self, name):
+        return getattr(self._cache, name)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def render_prometheus(totals):
+    lines = []
+
+    def counter(name, help_text, index, scale=1):
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s counter" % name)
+        for view, row in sorted(totals.items()):
+            value = row[index] / scale if scale != 1 else row[index]
+            lines.append('%s{view="%s"} %s' % (name, _escape(view), value))
+
+    counter("yatube_requests_total", "Обработанные запросы", REQUESTS)
+    counter("yatube_errors_total", "Ответы с кодом 5xx", ERRORS)
+    counter("yatube_db_queries_total", "SQL-запросы", DB_QUERIES)
+    counter("yatube_db_seconds_total", "Время SQL-запросов", DB_TIME, 1e6)
+    counter("yatube_cache_hits_total", "Попадания в кэш", CACHE_HITS)
+    counter("yatube_cache_misses_total", "Промахи кэша", CACHE_MISSES)
+    counter("yatube_template_seconds_total", "Время рендера шаблонов", TEMPLATE, 1e6)
+    counter("yatube_cache_stale_total", "Отдано устаревших значений во время пересчёта", CACHE_STALE)
+    counter("yatube_cache_collapsed_total", "Запросы, дождавшиеся чужого пересчёта", CACHE_COLLAPSED)
+    counter("yatube_cache_early_total", "Пересчёты до истечения срока", CACHE_EARLY)
+
+    name = "yatube_request_duration_seconds"
+    lines.append("# HELP %s Время ответа" % name)
+    lines.append("# TYPE %s histogram" % name)
+    for view, row in sorted(totals.items()):
+        label = _escape(view)
+        cumulative = 0
+        for index, bound in enumerate(BUCKETS + (None,)):
+            cumulative += row[len(FIELDS) + index]
+            le = "+Inf" if bound is None else repr(bound / 1e6)
+            lines.append('%s_bucket{view="%s",le="%s"} %s' % (name, label, le, cumulative))
+        lines.append('%s_sum{view="%s"} %s' % (name, label, row[LATENCY] / 1e6))
+        lines.append('%s_count{view="%s"} %s' % (name, label, row[REQUESTS]))
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    """страница для сборщика метрик (Prometheus)"""
+    allowed = getattr(settings, "METRICS_ALLOWED_IPS", settings.INTERNAL_IPS)
+    if request.META.get("REMOTE_ADDR") not in allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(render_prometheus(snapshot()), content_type="text/plain; version=0.0.4; charset=utf-8")
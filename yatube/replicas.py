@@ -0,0 +1,152 @@
+"""Чтение с реплик базы.
+
+ReplicaRouter отправляет на одну из реплик DATABASE_REPLICAS чтения
+запросов к сайту, которые ничего не меняют, — ленты, профили, посты.
+Записи и всё остальное (команды, фоновые потоки) идут на основную базу
+"default": код, который читает и затем пишет, не должен видеть отставшую
+копию. Реплика отстаёт, поэтому с основной базы читают и:
+
+* запросы, которые пишут (POST и т. п.), и ещё REPLICA_PIN_SECONDS после
+  них: ReplicaMiddleware ставит пользователю короткоживущую куку, и он
+  сразу видит свой пост или комментарий;
+* транзакции — они должны видеть свои изменения;
+* пересчёт общего кэша для областей, изменившихся за последние
+  REPLICA_PIN_SECONDS (posts.cache), — иначе старые данные реплики
+  попали бы в кэш под ключом нового поколения;
+* блок use_primary() — например, чтения, которыми заполняются общие
+  кэши: отставшие данные пережили бы в кэше само отставание;
+* блок housekeeping() — служебная запись во время чтения страницы
+  (дозапись ленты); она не закрепляет пользователя за основной базой.
+
+Без DATABASE_REPLICAS всё идёт на "default". Реплики — файлы SQLite,
+которые manage.py sync_replicas копирует с основной базы (sync()),
+или копии, которые поддерживает внешний инструмент. REPLICA_PIN_SECONDS
+должен быть больше их отставания.
+"""
+import random
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = "yatube_primary"
+PIN_SECONDS = 10
+#  эти методы не меняют данные
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE")
+
+
+class _State(threading.local):
+    #  сколько вложенных use_replicas() и use_primary() открыто и была ли
+    #  запись
+    replicas = 0
+    primary = 0
+    wrote = False
+
+
+_state = _State()
+
+
+def aliases():
+    return list(getattr(settings, "DATABASE_REPLICAS", ()))
+
+
+def pin_seconds():
+    return getattr(settings, "REPLICA_PIN_SECONDS", PIN_SECONDS)
+
+
+@contextmanager
+def use_replicas():
+    """внутри блока чтения идут на реплики, если они есть"""
+    _state.replicas += 1
+    try:
+        yield
+    finally:
+        _state.replicas -= 1
+
+
+@contextmanager
+def use_primary():
+    """внутри блока чтения идут на основную базу"""
+    _state.primary += 1
+    try:
+        yield
+    finally:
+        _state.primary -= 1
+
+
+@contextmanager
+def housekeeping():
+    """служебная работа запроса: читает с основной базы, а её записи не
+    считаются записями запроса и не ставят куку REPLICA_PIN_SECONDS"""
+    wrote = _state.wrote
+    try:
+        with use_primary():
+            yield
+    finally:
+        _state.wrote = wrote
+
+
+def mark_written():
+    """сообщает, что запрос записал данные, хотя и не через роутер этого
+    потока (например, через поток-писатель posts.writes)"""
+    _state.wrote = True
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = aliases()
+        if (not replicas or not _state.replicas or _state.primary
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        #  на репликах те же данные, что и в основной базе
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        #  схема приходит на реплики вместе с данными
+        return db not in aliases()
+
+
+class ReplicaMiddleware:
+    """пишущие запросы и запросы в течение REPLICA_PIN_SECONDS после них
+    читают с основной базы"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not aliases():
+            return self.get_response(request)
+        safe = request.method in SAFE_METHODS
+        _state.wrote = False
+        try:
+            if safe and PIN_COOKIE not in request.COOKIES:
+                with use_replicas():
+                    response = self.get_response(request)
+            else:
+                response = self.get_response(request)
+        finally:
+            wrote, _state.wrote = _state.wrote, False
+        if wrote or not safe:
+            response.set_cookie(PIN_COOKIE, "1", max_age=pin_seconds(), httponly=True, samesite="Lax")
+        return response
+
+
+def sync(alias):
+    """копирует основную базу в файл реплики alias (SQLite backup API);
+    читатели реплики в это время видят прежнюю копию"""
+    source = connections[DEFAULT_DB_ALIAS]
+    source.ensure_connection()
+    target = sqlite3.connect(connections.databases[alias]["NAME"])
+    try:
+        source.connection.backup(target)
+    finally:
+        target.close()
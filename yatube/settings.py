@@ -25,6 +25,9 @@ SECRET_KEY = '+1&qruvzeh^%=1_dn&ek#tpv_%cj5r_x5jjlst1vg8pn1x9ve!'
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+#  панель отладки замедляет каждый запрос — только для разработки
+DEBUG_TOOLBAR = DEBUG and os.environ.get("YATUBE_DEBUG_TOOLBAR", "1") == "1"
+
 ALLOWED_HOSTS = [
     "localhost",
     "127.0.0.1",
@@ -48,10 +51,13 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'sorl.thumbnail',
-    'debug_toolbar'
 ]
 
 MIDDLEWARE = [
+    #  первым, чтобы время ответа включало остальные middleware
+    'yatube.metrics.MetricsMiddleware',
+    #  до сессий: после записи и сессия читается с основной базы
+    'yatube.replicas.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -59,9 +65,12 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'debug_toolbar.middleware.DebugToolbarMiddleware'
 ]
 
+if DEBUG_TOOLBAR:
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE.append('debug_toolbar.middleware.DebugToolbarMiddleware')
+
 INTERNAL_IPS = [
         "127.0.0.1",
 ]
@@ -71,7 +80,7 @@ ROOT_URLCONF = 'yatube.urls'
 TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'yatube.metrics.MeteredTemplates',
         'DIRS': [TEMPLATES_DIR],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -94,11 +103,25 @@ WSGI_APPLICATION = 'yatube.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        #  sqlite3 с WAL, настроенными PRAGMA и повтором при блокировке
+        'ENGINE': os.environ.get('YATUBE_DB_ENGINE', 'yatube.db'),
+        'NAME': os.environ.get('YATUBE_DB_PATH', os.path.join(BASE_DIR, 'db.sqlite3')),
     }
 }
 
+#  реплики только для чтения: файлы SQLite через запятую, их обновляет
+#  manage.py sync_replicas. Чтения идут на реплики, записи и чтения сразу
+#  после записи — на default (yatube.replicas)
+DATABASE_REPLICAS = []
+for number, path in enumerate(filter(None, os.environ.get('YATUBE_DB_REPLICAS', '').split(',')), 1):
+    alias = 'replica%s' % number
+    DATABASES[alias] = dict(DATABASES['default'], NAME=path, TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['yatube.replicas.ReplicaRouter']
+#  сколько после записи читать с основной базы; больше отставания реплик
+REPLICA_PIN_SECONDS = 10
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -141,6 +164,9 @@ STATIC_ROOT = os.path.join(BASE_DIR, "static")
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
+#  загрузки пишутся на диск частями и сразу хэшируются для хранилища
+#  картинок по содержимому (yatube.storage)
+FILE_UPLOAD_HANDLERS = ["yatube.storage.HashingUploadHandler"]
 
 # Login
 
@@ -157,8 +183,56 @@ SITE_ID = 1
 
 CACHES = {
         'default': {
-                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                #  считает попадания и промахи для метрик
+                'BACKEND': 'yatube.metrics.MeteredCache',
+                #  файл SQLite, общий для всех воркеров на машине
+                'LOCATION': os.environ.get("YATUBE_CACHE_PATH", os.path.join(BASE_DIR, "cache", "cache.sqlite3")),
+                'OPTIONS': {
+                        'BACKEND': 'yatube.sharedcache.SQLiteCache',
+                        'MAX_ENTRIES': 100000,
+                },
         }
 }
 
-
+#  тесты чистят кэш — им отдаётся временный файл вместо общего
+TEST_RUNNER = "yatube.test_runner.TemporaryCacheRunner"
+
+#  лента подписок: авторы с большим числом подписчиков не раскладываются
+#  по лентам при публикации, их посты подтягиваются при чтении
+TIMELINE_CELEBRITY_FOLLOWERS = 10000
+#  сколько последних постов автора докладывать в ленту после подписки
+TIMELINE_BACKFILL = 500
+#  посты звёзд подтягиваются в ленту не чаще раза в столько секунд
+TIMELINE_PULL_INTERVAL = 30
+
+#  фрагменты лент хранятся долго: ключ меняется при изменении данных
+FEED_CACHE_TIMEOUT = 60 * 60
+
+#  страницы для анонимных читателей: сколько хранить у себя и сколько
+#  разрешать держать прокси перед сайтом
+PAGE_CACHE_TIMEOUT = 10 * 60
+PAGE_CACHE_MAX_AGE = 30
+
+#  комментарии и подписки из параллельных запросов пишутся одной
+#  транзакцией (posts.writes): до WRITE_BATCH_SIZE записей, пришедших за
+#  WRITE_BATCH_LINGER секунд; запрос ждёт своей записи не дольше
+#  WRITE_TIMEOUT секунд
+WRITE_COALESCING = os.environ.get("YATUBE_WRITE_COALESCING") == "1"
+WRITE_BATCH_SIZE = 50
+WRITE_BATCH_LINGER = 0.002
+WRITE_TIMEOUT = 30
+
+#  миниатюры картинок постов готовятся пулом потоков после коммита
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_ASYNC = True
+
+#  метрики запросов: файлы счётчиков процессов и кому отдавать /_/metrics/
+METRICS_DIR = os.environ.get("YATUBE_METRICS_DIR", os.path.join(BASE_DIR, "metrics"))
+METRICS_ALLOWED_IPS = INTERNAL_IPS
+
+#  файл, через который воркеры делят одну копию графа подписок
+#  (manage.py build_graph); без него каждый процесс собирает граф сам
+GRAPH_SNAPSHOT = os.environ.get("YATUBE_GRAPH_SNAPSHOT")
+#  запросы не ждут сборки графа из базы: он собирается в фоновом потоке,
+#  а до тех пор ответы дают индексы таблицы подписок
+GRAPH_ASYNC = True
@@ -0,0 +1,206 @@
+"""Кэш, общий для всех процессов на одной машине.
+
+LocMemCache у каждого воркера свой: фрагменты лент, страницы и поколения
+posts.cache считаются в каждом процессе заново и теряются при его
+перезапуске. Этот бэкенд хранит записи в файле SQLite (LOCATION) в режиме
+WAL: читатели не блокируют друг друга и писателя, а страницы файла живут
+в общем страничном кэше ОС. Внешний сервис не нужен.
+
+* Срок жизни — колонка expires, просроченные записи не видны и удаляются
+  при очистке.
+* Вытеснение — приближённый LRU: время обращения обновляется не чаще раза
+  в ACCESS_RESOLUTION секунд, при превышении MAX_ENTRIES удаляется доля
+  1/CULL_FREQUENCY давно не читанных записей.
+* Целые числа хранятся как INTEGER, поэтому incr — один UPDATE, атомарный
+  между процессами; остальное хранится в pickle.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+#  как часто обновлять время обращения к записи
+ACCESS_RESOLUTION = 10
+#  как часто (в записях процесса) проверять размер кэша
+CULL_CHECK_EVERY = 100
+BUSY_TIMEOUT = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires REAL,
+    accessed REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires);
+"""
+
+ALIVE = "(expires IS NULL OR expires > ?)"
+
+
+def _encode(value):
+    #  bool — подкласс int, но должен вернуться bool
+    if type(value) is int and -2 ** 63 <= value < 2 ** 63:
+        return value
+    return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def _decode(value):
+    if isinstance(value, int):
+        return value
+    return pickle.loads(value)
+
+
+class SQLiteCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        self.path = location
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+    def _connection(self):
+        #  соединение на поток; после fork открывается новое
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            #  потеря последних записей при сбое питания для кэша не страшна
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            local.connection, local.pid = connection, os.getpid()
+        return local.connection
+
+    def _key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def _fetch(self, keys):
+        """живые записи: ключ -> значение; время обращения обновляется
+        только у давно не читанных"""
+        now = time.time()
+        found, stale = {}, []
+        connection = self._connection()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = connection.execute(
+                "SELECT key, value, accessed FROM cache WHERE key IN (%s) AND %s"
+                % (", ".join("?" * len(chunk)), ALIVE), [*chunk, now])
+            for key, value, accessed in rows:
+                found[key] = _decode(value)
+                if accessed < now - ACCESS_RESOLUTION:
+                    stale.append((now, key))
+        if stale:
+            connection.executemany("UPDATE cache SET accessed = ? WHERE key = ?", stale)
+        return found
+
+    def _store(self, rows, timeout):
+        now = time.time()
+        expires = self.get_backend_timeout(timeout)
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "INSERT INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires, "
+                "accessed = excluded.accessed",
+                [(key, _encode(value), expires, now) for key, value in rows])
+        self._written(len(rows))
+
+    def _written(self, count):
+        #  экземпляр кэша общий для потоков процесса
+        with self._writes_lock:
+            self._writes += count
+            cull = self._writes >= CULL_CHECK_EVERY
+            if cull:
+                self._writes = 0
+        if cull:
+            self._cull()
+
+    def _cull(self):
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("DELETE FROM cache WHERE expires <= ?", [time.time()])
+            [count] = connection.execute("SELECT count(*) FROM cache").fetchone()
+            if count > self._max_entries:
+                connection.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)",
+                    [max(count // self._cull_frequency, count - self._max_entries)])
+
+    def get(self, key, default=None, version=None):
+        key = self._key(key, version)
+        return self._fetch([key]).get(key, default)
+
+    def get_many(self, keys, version=None):
+        keys = {self._key(key, version): key for key in keys}
+        return {keys[key]: value for key, value in self._fetch(list(keys)).items()}
+
+    def has_key(self, key, version=None):
+        key = self._key(key, version)
+        return self._connection().execute(
+            "SELECT 1 FROM cache WHERE key = ? AND %s" % ALIVE, [key, time.time()]).fetchone() is not None
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._store([(self._key(key, version), value)], timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self._store([(self._key(key, version), value) for key, value in data.items()], timeout)
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        now = time.time()
+        #  просроченную запись add перезаписывает, живую — нет
+        cursor = self._connection().execute(
+            "INSERT INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires, "
+            "accessed = excluded.accessed WHERE cache.expires <= ?",
+            [key, _encode(value), self.get_backend_timeout(timeout), now, now])
+        added = cursor.rowcount > 0
+        if added:
+            self._written(1)
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        cursor = self._connection().execute(
+            "UPDATE cache SET expires = ? WHERE key = ? AND %s" % ALIVE,
+            [self.get_backend_timeout(timeout), key, time.time()])
+        return cursor.rowcount > 0
+
+    def incr(self, key, delta=1, version=None):
+        key = self._key(key, version)
+        row = self._connection().execute(
+            "UPDATE cache SET value = value + ? WHERE key = ? AND typeof(value) = 'integer' AND %s "
+            "RETURNING value" % ALIVE, [delta, key, time.time()]).fetchone()
+        if row is None:
+            raise ValueError("Key '%s' not found" % key)
+        return row[0]
+
+    def delete(self, key, version=None):
+        key = self._key(key, version)
+        self._connection().execute("DELETE FROM cache WHERE key = ?", [key])
+
+    def delete_many(self, keys, version=None):
+        keys = [self._key(key, version) for key in keys]
+        connection = self._connection()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            connection.execute("DELETE FROM cache WHERE key IN (%s)" % ", ".join("?" * len(chunk)), chunk)
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache")
+
+    def close(self, **kwargs):
+        #  соединение переиспользуется между запросами потока
+        pass
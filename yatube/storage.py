@@ -0,0 +1,129 @@
+"""Хранилище файлов по содержимому.
+
+Файл сохраняется под именем из SHA-256 своих байтов:
+posts/ab/ab12...ef.png. Одинаковые загрузки — один файл на диске, сколько
+бы постов его ни использовали, а миниатюры, имена которых выводятся из
+имени оригинала (posts.thumbnails), тоже общие.
+
+Загрузка не собирается в памяти: HashingUploadHandler пишет её во
+временный файл и считает хэш по мере прихода частей, хранилище потом
+только переносит файл на место. Содержимое из других источников
+копируется во временный файл в каталоге хранилища с хэшированием по
+частям. На место файл встаёт через os.replace, поэтому читатели не видят
+недописанный файл, а две одинаковые загрузки одновременно не мешают друг
+другу.
+
+Хранилище файлы не удаляет: на один файл ссылаются несколько постов,
+ссылки считает posts.blobs, а ненужное стирает manage.py collect_media.
+"""
+import hashlib
+import os
+import re
+import tempfile
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.utils.deconstruct import deconstructible
+
+#  временные файлы лежат рядом с готовыми, чтобы os.replace не пересекал
+#  границу файловой системы
+TEMP_PREFIX = ".upload-"
+HASHED_NAME = re.compile(r"(^|/)([0-9a-f]{2})/\2[0-9a-f]{62}\.\w+$")
+
+
+class HashingUploadHandler(TemporaryFileUploadHandler):
+    """пишет каждую загрузку во временный файл и считает её хэш"""
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hash = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.hash.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.content_hash = self.hash.hexdigest()
+        return file
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage, которое именует файлы по хэшу содержимого и
+    сохраняет одинаковое содержимое один раз"""
+
+    def get_available_name(self, name, max_length=None):
+        #  имя всё равно заменит хэш, занятое имя значит то же содержимое
+        return name
+
+    def hashed_name(self, directory, digest, extension):
+        return "/".join(part for part in (directory, digest[:2], digest + extension.lower()) if part)
+
+    def _spool(self, directory, content):
+        """копирует содержимое во временный файл хранилища; (путь, хэш)"""
+        os.makedirs(directory, exist_ok=True)
+        digest = hashlib.sha256()
+        descriptor, path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=directory)
+        try:
+            with os.fdopen(descriptor, "wb") as out:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    out.write(chunk)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return path, digest.hexdigest()
+
+    def _adopt(self, directory, content):
+        """забирает временный файл загрузки, не читая его заново"""
+        os.makedirs(directory, exist_ok=True)
+        descriptor, path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=directory)
+        os.close(descriptor)
+        #  переименование или, с другого диска, копирование
+        file_move_safe(content.temporary_file_path(), path, allow_overwrite=True)
+        return path, content.content_hash
+
+    def _save(self, name, content):
+        directory, extension = os.path.dirname(name), os.path.splitext(name)[1]
+        full_directory = self.path(directory)
+        if getattr(content, "content_hash", None) and hasattr(content, "temporary_file_path"):
+            temp_path, digest = self._adopt(full_directory, content)
+        else:
+            temp_path, digest = self._spool(full_directory, content)
+        name = self.hashed_name(directory, digest, extension)
+        path = self.path(name)
+        if os.path.exists(path):
+            #  свежая дата защищает файл от collect_media, пока пост,
+            #  который на него сошлётся, ещё не сохранён
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                #  файл только что забрал collect_media — кладём свой
+                pass
+            else:
+                os.unlink(temp_path)
+                return name
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        #  mkstemp создаёт файл с правами 0600
+        os.chmod(temp_path, self.file_permissions_mode or 0o644)
+        os.replace(temp_path, path)
+        return name
+
+    def hashed_files(self, directory=""):
+        """(имя, время изменения) файлов каталога, сохранённых по хэшу, и
+        временных файлов, оставшихся от прерванных загрузок"""
+        root = self.path(directory)
+        for current, _, files in os.walk(root):
+            for file in files:
+                path = os.path.join(current, file)
+                name = os.path.relpath(path, self.location).replace(os.sep, "/")
+                if HASHED_NAME.search(name) or file.startswith(TEMP_PREFIX):
+                    try:
+                        yield name, os.path.getmtime(path)
+                    except FileNotFoundError:
+                        continue
+
+
+post_images = ContentAddressedStorage()
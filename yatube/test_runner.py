@@ -0,0 +1,33 @@
+"""Запуск тестов с отдельным файлом кэша.
+
+Кэш по умолчанию — файл SQLite, общий для воркеров сервера
+(yatube.sharedcache). Тесты чистят кэш, поэтому получают временный файл,
+который удаляется после прогона: кэш разработчика или сервера они не
+трогают, и прогоны не видят данных друг друга.
+
+Граф подписок (posts.graph) в тестах собирается сразу: фоновый поток
+сборки не видит данных незакоммиченной транзакции теста.
+"""
+import copy
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TemporaryCacheRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.cache_directory = tempfile.mkdtemp(prefix="yatube-cache-")
+        caches = copy.deepcopy(settings.CACHES)
+        caches["default"]["LOCATION"] = os.path.join(self.cache_directory, "cache.sqlite3")
+        self.cache_override = override_settings(CACHES=caches, GRAPH_ASYNC=False)
+        self.cache_override.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.cache_override.disable()
+        shutil.rmtree(self.cache_directory, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
@@ -6,6 +6,8 @@ from django.conf.urls import handler404, handler500
 from django.conf import settings
 from django.conf.urls.static import static
 
+from yatube.metrics import metrics_view
+
 urlpatterns = [
 
     # раздел администратора
@@ -21,6 +23,10 @@ urlpatterns = [
     # ищем совпадения в файле django.contrib.auth.urls
     path("auth/", include("django.contrib.auth.urls")),
 
+    # метрики для Prometheus; под "_/", как служебные страницы posts.urls,
+    # чтобы не занять адрес профиля пользователя "metrics"
+    path("_/metrics/", metrics_view, name="metrics"),
+
     # обработчик для главной страницы ищем в urls.py приложения posts
     path("", include("posts.urls")),
 
@@ -40,7 +46,9 @@ handler404 = "posts.views.page_not_found"
 handler500 = "posts.views.server_error"
 
 if settings.DEBUG:
-    import debug_toolbar
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
+
+if settings.DEBUG_TOOLBAR:
+    import debug_toolbar
     urlpatterns += (path("__debug__/", include(debug_toolbar.urls)),)